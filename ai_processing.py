@@ -5,11 +5,15 @@ import re
 import random
 import httpx
 from google import genai
+from types import SimpleNamespace
 from typing import Dict, Any, List
 from datetime import datetime
 
 import config
-from utils import make_async_client
+import cassette
+import metrics
+import tracing
+from utils import client_for, ClientRegistry, PERPLEXITY
 
 log = logging.getLogger(__name__)
 
@@ -35,22 +39,30 @@ async def gemini_api_call_with_retry(prompt_parts, max_retries=4):
     Handles 429 (Too Many Requests) and 503 (Service Unavailable) errors.
     """
     client = get_gemini_client()
-    if not client:
+    if not client and not cassette.replaying():
         log.error("Gemini client not available to retry function.")
         return None
 
+    async def _generate() -> Dict[str, Any]:
+        response = await client.aio.models.generate_content(
+            model='gemini-2.5-flash',
+            contents=prompt_parts,
+            config={
+                "response_mime_type": "application/json",
+                "temperature": 0.2,
+                "safety_settings": config.SAFETY_SETTINGS
+            }
+        )
+        return {"text": response.text}
+
     for attempt in range(max_retries):
         try:
-            response = await client.aio.models.generate_content(
-                model='gemini-2.5-flash',
-                contents=prompt_parts,
-                config={
-                    "response_mime_type": "application/json",
-                    "temperature": 0.2,
-                    "safety_settings": config.SAFETY_SETTINGS
-                }
-            )
-            return response
+            # Only the response text is used downstream, which keeps the call recordable.
+            with metrics.timed("gemini"):
+                result = await cassette.recorded_call("gemini", prompt_parts, _generate)
+            return SimpleNamespace(text=result["text"])
+        except cassette.ReplayMiss:
+            raise
         except Exception as e:
             error_str = str(e).lower()
             if ("429" in error_str and "resource has been exhausted" in error_str) or "503" in error_str or "service unavailable" in error_str:
@@ -66,10 +78,11 @@ async def gemini_api_call_with_retry(prompt_parts, max_retries=4):
                 return None
     return None
 
-async def run_batch_perplexity_audit(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+async def run_batch_perplexity_audit(batch: List[Dict[str, Any]], clients: ClientRegistry | None = None) -> List[Dict[str, Any]]:
     """
     Uses Perplexity API to perform a batch audit of up to 3 offers in a single request.
     Uses the ENTERPRISE PROMPT 2.1 (Fact Enforcement + New Telegram Style).
+    All retries share one connection (the run's Perplexity client when a ClientRegistry is passed).
     """
     if not config.PERPLEXITY_API_KEY:
         log.warning("PERPLEXITY_API_KEY not set. Cannot perform audit.")
@@ -210,38 +223,48 @@ Stwórz post gotowy do publikacji.
     }
 
     max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            async with make_async_client() as client:
-                response = await client.post("https://api.perplexity.ai/chat/completions", json=payload, headers=headers, timeout=120.0)
-                response.raise_for_status()
+    with tracing.span("perplexity", keys=[c.get("dedup_key") for c in batch if c.get("dedup_key")]):
+        async with client_for(clients, PERPLEXITY) as client:
+            for attempt in range(max_retries):
+                try:
+                    with metrics.timed("perplexity"):
+                        response = await client.post("https://api.perplexity.ai/chat/completions", json=payload, headers=headers, timeout=120.0,
+                                                     extensions={"cassette_strict": True}) # verdicts are per candidate id
+                    response.raise_for_status()
                 
-                content = response.json().get('choices', [{}])[0].get('message', {}).get('content')
-                if not content: raise ValueError("Empty content from AI")
+                    content = response.json().get('choices', [{}])[0].get('message', {}).get('content')
+                    if not content: raise ValueError("Empty content from AI")
                 
-                result_data = json.loads(content)
-                audits = result_data.get('audits', [])
+                    result_data = json.loads(content)
+                    audits = result_data.get('audits', [])
                 
-                # Clean citations and ensure Polish
-                for audit in audits:
-                    if audit.get('telegram_message'):
-                        # Usuwanie cytatów [1] itp.
-                        audit['telegram_message'] = re.sub(r'\[\d+\]', '', audit['telegram_message']).strip()
+                    # Clean citations and ensure Polish
+                    for audit in audits:
+                        if audit.get('telegram_message'):
+                            # Usuwanie cytatów [1] itp.
+                            audit['telegram_message'] = re.sub(r'\[\d+\]', '', audit['telegram_message']).strip()
                 
-                log.info(f"Perplexity batch audit successful. Processed {len(audits)} offers.")
-                return audits
+                    log.info(f"Perplexity batch audit successful. Processed {len(audits)} offers.")
+                    return audits
 
-        except Exception as e:
-            log.warning(f"Batch audit attempt {attempt+1} failed: {e}")
-            await asyncio.sleep(1 * (attempt + 1))
+                except cassette.ReplayMiss:
+                    raise
+                except Exception as e:
+                    log.warning(f"Batch audit attempt {attempt+1} failed: {e}")
+                    await asyncio.sleep(1 * (attempt + 1))
 
     log.error("Batch audit failed after retries.")
     # Return failure dummy results
     return [{'id': c.get('id'), 'verdict': 'ERROR'} for c in batch]
 
 
+def serialize_batch(candidates: List[Dict[str, Any]]) -> str:
+    """The user message sent to Gemini for a batch."""
+    # OPTYMALIZACJA KOSZTÓW: Kompresja JSON (usuwamy spacje i nowe linie)
+    return json.dumps(candidates, separators=(',', ':'))
+
 async def analyze_batch(candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    if not get_gemini_client():
+    if not get_gemini_client() and not cassette.replaying():
         log.error("Gemini AI client not initialized. Skipping AI analysis.")
         return []
 
@@ -289,14 +312,14 @@ INSTRUKCJA TECHNICZNA:
 - Zwracaj WYŁĄCZNIE czysty JSON. Żadnych wstępów, żadnych markdownów (```).
 - Jeśli brakuje kluczowych danych (cena/kierunek), a tytuł nie sugeruje błędu cenowego -> Kategoria IGNORE.
 """
-    # OPTYMALIZACJA KOSZTÓW: Kompresja JSON (usuwamy spacje i nowe linie)
-    user_message = json.dumps(candidates, separators=(',', ':'))
+    user_message = serialize_batch(candidates)
 
     log.info(f"Sending a batch of {len(candidates)} candidates to Gemini AI with 'Sztos vs Reszta' prompt.")
     
     full_prompt = [system_prompt, user_message]
 
-    response = await gemini_api_call_with_retry(full_prompt)
+    with tracing.span("gemini", keys=[c.get("dedup_key") for c in candidates]):
+        response = await gemini_api_call_with_retry(full_prompt)
 
     if not response or not response.text:
         log.warning("Gemini API returned no response for batch after retries.")
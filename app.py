@@ -1,16 +1,24 @@
 # app.py - Main Flask Application
 import logging
 import asyncio
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from datetime import datetime, timezone
 
 # Local module imports
 import config
 from gcs_state import load_state, save_state_atomic, sanitizing_startup_check, prune_sent_links, remember_for_deletion, perform_delete_sweep
-from feed_parser import process_all_sources
+from feed_parser import stream_candidates
+from near_dup import RunCollapser
 from ai_processing import analyze_batch, run_batch_perplexity_audit # Updated import
 from publishing import publish_digest_async, send_telegram_message_async
-from utils import make_async_client 
+from utils import ClientRegistry
+from run_budget import RunBudget
+from profiling import run_profiled
+from state_codec import LazyQueue
+import cassette
+import host_health
+import metrics
+import tracing
 
 # ---------- LOGGING ----------
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,119 +34,209 @@ app = Flask(__name__)
 
 # ---------- CORE APPLICATION LOGIC ----------
 
-async def process_and_publish_offers(state: dict, generation: int) -> bool:
+PERPLEXITY_BATCH_SIZE = 3
+
+def _mark_near_duplicates(state: dict, duplicates: list, run: dict):
+    """Marks collapsed copies as seen, so later runs do not pick them up again."""
+    if not duplicates:
+        return
+    seen_at = datetime.now(timezone.utc).isoformat()
+    for duplicate in duplicates:
+        state["sent_links"][duplicate['dedup_key']] = seen_at
+    run["state_modified"] = True
+    metrics.count("near_duplicate", len(duplicates))
+
+async def _analysis_stage(candidates_in: asyncio.Queue, audits_out: asyncio.Queue, state: dict, budget: RunBudget, run: dict):
+    """
+    Pipeline stage 2: consumes candidates from stream_candidates() and sends a Gemini batch as
+    soon as AI_BATCH_SIZE candidates are waiting (or the stream ends). Near-duplicates are
+    collapsed on arrival, against the index and every other candidate of the run
+    (near_dup.RunCollapser); a copy held back behind a pending one is only marked seen once
+    that one has been analyzed. High scorers go straight to `audits_out`.
+    After a failed Gemini batch (an error or no results) or when the budget runs out, the rest is only drained (left unmarked,
+    duplicates included, for the next run). Puts None on `audits_out` at the end.
+    """
+    batches_sent = 0
+    stopped = False
+    collapser = RunCollapser(state)
+    if collapser.pruned:
+        run["state_modified"] = True
+    while True:
+        candidate = await candidates_in.get()
+        if candidate is not None and not stopped:
+            # Collapse the same deal published by several sources before paying for AI on each copy
+            if not collapser.add(candidate):
+                _mark_near_duplicates(state, [candidate], run)
+        if stopped or not collapser or (candidate is not None and len(collapser) < config.AI_BATCH_SIZE):
+            if candidate is None:
+                break
+            continue
+
+        chunk = collapser.take()
+        run["candidates"].update((c['id'], c) for c in chunk)
+        if budget.allows("gemini", units=len(chunk)):
+            if batches_sent:
+                wait_time = config.AI_BATCH_WAIT_SECONDS
+                log.info(f"Processed chunk {batches_sent}. Waiting {wait_time}s.")
+                await asyncio.sleep(wait_time)
+            batches_sent += 1
+            try:
+                with budget.track("gemini"):
+                    results = await analyze_batch(chunk)
+            except cassette.ReplayMiss:
+                raise # the replay diverged from the recording; an empty analysis would hide it
+            except Exception as e:
+                log.error(f"Error during AI batch analysis {batches_sent}: {e}")
+                results = []
+            if not results:
+                # analyze_batch() logs its failures and returns [] (a real answer has a result per candidate)
+                log.warning(f"AI batch {batches_sent} returned no results. Leaving it and the rest of the run for the next one.")
+                collapser.release()
+                stopped = True
+            else:
+                run["state_modified"] = True # the near-duplicate index was updated
+                _mark_near_duplicates(state, collapser.commit(), run)
+                run["ai_results"].extend(results)
+                metrics.count("analyzed", len(chunk))
+                for result in results:
+                    # High-value candidates go to the Perplexity audit
+                    if result.get('score') and int(result.get('score', 0)) >= 9 and int(result.get('conviction', 10)) >= 7:
+                        await audits_out.put(result)
+        else:
+            collapser.release()
+            stopped = True
+        if candidate is None:
+            break
+    if collapser.collapsed:
+        log.info(f"Near-duplicate index: collapsed {collapser.collapsed} candidates ({len(collapser.index.entries)} fingerprints indexed).")
+    await audits_out.put(None)
+
+async def _audit_stage(audits_in: asyncio.Queue, state: dict, clients: ClientRegistry, budget: RunBudget, run: dict, now_utc_iso: str):
+    """
+    Pipeline stage 3: audits high scorers with Perplexity in batches of PERPLEXITY_BATCH_SIZE
+    while Gemini is still working on later batches, collecting GEMs and FAIRs into `run`.
+    """
+    batch = []
+    audited_batches = 0
+    stopped = False
+    while True:
+        candidate = await audits_in.get()
+        if candidate is not None:
+            batch.append(candidate)
+            run["audit_candidates"] += 1
+            metrics.count("audit")
+        if batch and (candidate is None or len(batch) >= PERPLEXITY_BATCH_SIZE):
+            if not stopped and budget.allows("perplexity", units=len(batch)):
+                if audited_batches:
+                    # Rate limit safety sleep
+                    wait_time = 2
+                    log.info(f"Perplexity batch finished. Sleeping {wait_time}s to respect rate limits.")
+                    await asyncio.sleep(wait_time)
+                audited_batches += 1
+                with budget.track("perplexity"):
+                    await _audit_batch(batch, state, clients, run, now_utc_iso)
+            else:
+                stopped = True
+            batch = []
+        if candidate is None:
+            break
+
+async def _audit_batch(p_batch: list, state: dict, clients: ClientRegistry, run: dict, now_utc_iso: str):
+    log.info(f"Running Perplexity batch audit for {len(p_batch)} candidates.")
+    candidates_by_id = run["candidates"]
+    
+    # Prepare data for the audit call
+    batch_to_audit = []
+    for candidate in p_batch:
+        original_candidate = candidates_by_id.get(candidate.get("id"))
+        if not original_candidate: continue
+        
+        offer_price = original_candidate.get('price') or candidate.get('price', 'Brak ceny')
+        batch_to_audit.append({
+            "id": candidate.get("id"),
+            "title": candidate.get("title"),
+            "price": offer_price,
+            "link": original_candidate['link'],
+            "dedup_key": original_candidate['dedup_key'] # for tracing only, not part of the prompt
+        })
+
+    # Call the batch audit
+    batch_results = await run_batch_perplexity_audit(batch_to_audit, clients)
+    
+    # Process results
+    results_by_id = {str(r.get('id')): r for r in batch_results}
+    
+    for candidate in p_batch:
+        original_candidate = candidates_by_id.get(candidate.get("id"))
+        if not original_candidate: continue
+
+        audit_result = results_by_id.get(str(candidate.get("id")))
+        if not audit_result or audit_result.get('verdict') == 'ERROR':
+            log.error(f"Audit failed or missing for ID {candidate.get('id')}. Skipping.")
+            continue
+
+        state["sent_links"][original_candidate['dedup_key']] = now_utc_iso
+        run["state_modified"] = True
+
+        full_offer_details = {**original_candidate, **candidate, **audit_result, 'ai_score': candidate.get('score')}
+
+        metrics.count(f"verdict_{str(full_offer_details.get('verdict')).lower()}")
+        if full_offer_details.get("verdict") == "GEM":
+            run["gems"].append(full_offer_details)
+        elif full_offer_details.get("verdict") == "FAIR":
+            run["fairs"].append(full_offer_details)
+        else:
+            reason = full_offer_details.get('internal_log', 'Brak uzasadnienia')
+            link = full_offer_details.get('link', 'Brak linku')
+            log.warning(f"⛔ REJECTED '{candidate.get('title')}'. Verdict: {full_offer_details.get('verdict')}. Reason: {reason} | Link: {link}")
+
+async def process_and_publish_offers(state: dict, generation: int, clients: ClientRegistry | None = None, budget: RunBudget | None = None) -> bool:
     """
     Main orchestration function.
     Accepts the state and generation, modifies the state, and returns True if modified.
+    HTTP clients come from the run's ClientRegistry so connections are reused across stages.
+    Fetching, scraping, Gemini and Perplexity run as a staged pipeline with bounded queues
+    (PIPELINE_QUEUE_SIZE), so slow stages overlap; routing starts once all audits are done.
+    Every stage draws from the run budget; candidates that are not analyzed or audited in
+    time are left unmarked, so the next run picks them up again.
     """
-    log.info("Starting a full processing run...")
-    state_modified = False
+    if clients is None:
+        async with ClientRegistry() as own_clients:
+            return await process_and_publish_offers(state, generation, own_clients, budget)
 
-    # 1. Fetch and Prepare Candidates
-    detailed_candidates = await process_all_sources()
-    
-    if not detailed_candidates:
+    log.info("Starting a full processing run...")
+    budget = budget or RunBudget()
+    now_utc = datetime.now(timezone.utc)
+    now_utc_iso = now_utc.isoformat()
+    run = {"candidates": {}, "ai_results": [], "audit_candidates": 0, "gems": [], "fairs": [], "state_modified": False}
+
+    # 1-2. Fetch -> scrape -> AI analysis -> audit, all streaming
+    candidate_queue = asyncio.Queue(maxsize=max(1, config.PIPELINE_QUEUE_SIZE))
+    audit_queue = asyncio.Queue(maxsize=max(1, config.PIPELINE_QUEUE_SIZE))
+    metrics.watch_queue("candidates", candidate_queue)
+    metrics.watch_queue("audits", audit_queue)
+    async with asyncio.TaskGroup() as pipeline:
+        pipeline.create_task(stream_candidates(candidate_queue, clients, state, budget))
+        pipeline.create_task(_analysis_stage(candidate_queue, audit_queue, state, budget, run))
+        pipeline.create_task(_audit_stage(audit_queue, state, clients, budget, run, now_utc_iso))
+    state_modified = run["state_modified"]
+
+    if not run["candidates"]:
         log.info("No new candidates to process. Pruning old links.")
         pruned_count = prune_sent_links(state)
-        return pruned_count > 0
-
-    # 2. AI Analysis
-    log.info(f"Proceeding with AI analysis for {len(detailed_candidates)} candidates.")
-    
-    candidate_chunks = [detailed_candidates[i:i + config.AI_BATCH_SIZE] for i in range(0, len(detailed_candidates), config.AI_BATCH_SIZE)]
-    all_ai_results = []
-    for i, chunk in enumerate(candidate_chunks):
-        try:
-            results = await analyze_batch(chunk)
-            all_ai_results.extend(results)
-        except Exception as e:
-            log.error(f"Error during AI batch analysis {i+1}/{len(candidate_chunks)}: {e}")
-            break
-
-        if i < len(candidate_chunks) - 1:
-            wait_time = config.AI_BATCH_WAIT_SECONDS
-            log.info(f"Processed chunk {i+1}/{len(candidate_chunks)}. Waiting {wait_time}s.")
-            await asyncio.sleep(wait_time)
+        return state_modified or pruned_count > 0
 
+    all_ai_results = run["ai_results"]
     if not all_ai_results:
         log.warning("AI analysis returned no results for any batch. Pruning and finishing.")
-        pruned_count = prune_sent_links(state)
-        return pruned_count > 0
+        prune_sent_links(state)
+        return state_modified
 
     # 3. Process AI Results and Distribute Content (Audit-Then-Route Logic)
-    candidates_by_id = {c['id']: c for c in detailed_candidates}
-    now_utc = datetime.now(timezone.utc)
-    now_utc_iso = now_utc.isoformat()
-    
-    # --- New Audit-Then-Route Logic ---
-
-    # 1. Identify all high-value candidates for Perplexity audit
-    perplexity_candidates = [
-        r for r in all_ai_results
-        if r.get('score') and int(r.get('score', 0)) >= 9
-        and int(r.get('conviction', 10)) >= 7
-    ]
-    log.info(f"Found {len(perplexity_candidates)} candidates (Score >= 9 & Conviction >= 7) requiring Perplexity audit.")
-
-    # 2. Audit all candidates and collect GEMs and FAIRs in batches of 3
-    gem_offers = []
-    fair_offers = []
-
-    # Prepare batches of 3
-    PERPLEXITY_BATCH_SIZE = 3
-    candidate_batches = [perplexity_candidates[i:i + PERPLEXITY_BATCH_SIZE] for i in range(0, len(perplexity_candidates), PERPLEXITY_BATCH_SIZE)]
-
-    for p_batch in candidate_batches:
-        log.info(f"Running Perplexity batch audit for {len(p_batch)} candidates.")
-        
-        # Prepare data for the audit call
-        batch_to_audit = []
-        for candidate in p_batch:
-            original_candidate = candidates_by_id.get(candidate.get("id"))
-            if not original_candidate: continue
-            
-            offer_price = original_candidate.get('price') or candidate.get('price', 'Brak ceny')
-            batch_to_audit.append({
-                "id": candidate.get("id"),
-                "title": candidate.get("title"),
-                "price": offer_price,
-                "link": original_candidate['link']
-            })
-
-        # Call the batch audit
-        batch_results = await run_batch_perplexity_audit(batch_to_audit)
-        
-        # Process results
-        results_by_id = {str(r.get('id')): r for r in batch_results}
-        
-        for candidate in p_batch:
-            original_candidate = candidates_by_id.get(candidate.get("id"))
-            if not original_candidate: continue
-
-            audit_result = results_by_id.get(str(candidate.get("id")))
-            if not audit_result or audit_result.get('verdict') == 'ERROR':
-                log.error(f"Audit failed or missing for ID {candidate.get('id')}. Skipping.")
-                continue
-
-            state["sent_links"][original_candidate['dedup_key']] = now_utc_iso
-            state_modified = True
-
-            full_offer_details = {**original_candidate, **candidate, **audit_result, 'ai_score': candidate.get('score')}
-
-            if full_offer_details.get("verdict") == "GEM":
-                gem_offers.append(full_offer_details)
-            elif full_offer_details.get("verdict") == "FAIR":
-                fair_offers.append(full_offer_details)
-            else:
-                reason = full_offer_details.get('internal_log', 'Brak uzasadnienia')
-                link = full_offer_details.get('link', 'Brak linku')
-                log.warning(f"⛔ REJECTED '{candidate.get('title')}'. Verdict: {full_offer_details.get('verdict')}. Reason: {reason} | Link: {link}")
-
-        # Rate limit safety sleep
-        if p_batch != candidate_batches[-1]:
-            wait_time = 2
-            log.info(f"Perplexity batch finished. Sleeping {wait_time}s to respect rate limits.")
-            await asyncio.sleep(wait_time)
+    candidates_by_id = run["candidates"]
+    log.info(f"Analyzed {len(all_ai_results)} candidates; {run['audit_candidates']} (Score >= 9 & Conviction >= 7) went to the Perplexity audit.")
+    gem_offers = run["gems"]
+    fair_offers = run["fairs"]
 
     # 3. Decide on the 'Sztos Alert' from the collected GEMs
     today_str = now_utc.date().isoformat()
@@ -169,12 +267,14 @@ async def process_and_publish_offers(state: dict, generation: int) -> bool:
         message = f"🔥 **SZTOS ALERT!** 🔥\n\n{best_european_gem.get('telegram_message', best_european_gem.get('title'))}"
         
         if config.TELEGRAM_CHANNEL_ID:
-            message_id = await send_telegram_message_async(message_content=message, link=best_european_gem['link'], chat_id=config.TELEGRAM_CHANNEL_ID)
+            message_id = await send_telegram_message_async(message_content=message, link=best_european_gem['link'], chat_id=config.TELEGRAM_CHANNEL_ID, clients=clients,
+                                                           dedup_key=best_european_gem['dedup_key'])
             if message_id:
                 remember_for_deletion(state, config.TELEGRAM_CHANNEL_ID, message_id, best_european_gem['source_url'])
                 state.setdefault('sztos_slots_used_today', []).append(time_slot)
                 state_modified = True
                 sztos_published = True
+                metrics.count("published")
                 log.info(f"Sztos Alert slot '{time_slot}' used. Used slots today: {state['sztos_slots_used_today']}")
         
         # The rest of the European GEMs go to the digest
@@ -193,11 +293,18 @@ async def process_and_publish_offers(state: dict, generation: int) -> bool:
         log.info(f"Routing {len(offers_for_digest)} offers to the digest queue.")
         target_queue_name = 'evening_digest_queue' if 10 <= now_utc.hour < 20 else 'morning_digest_queue'
         
+        target_queue = state.setdefault(target_queue_name, [])
+        # A lazily loaded queue (binary state) has the keys without decoding the queued offers.
+        if isinstance(target_queue, LazyQueue):
+            existing_keys = set(target_queue.dedup_keys())
+        else:
+            existing_keys = {c.get('dedup_key') for c in target_queue}
         for offer in offers_for_digest:
-            existing_keys = {c.get('dedup_key') for c in state.get(target_queue_name, [])}
             if offer['dedup_key'] not in existing_keys:
-                state.setdefault(target_queue_name, []).append(offer)
+                target_queue.append(offer)
+                existing_keys.add(offer['dedup_key'])
                 state_modified = True
+                metrics.count("digest")
             else:
                 log.info(f"Offer '{offer.get('title')}' already in '{target_queue_name}'. Skipping add.")
 
@@ -218,8 +325,42 @@ async def process_and_publish_offers(state: dict, generation: int) -> bool:
     return state_modified or (pruned_count > 0)
 
 
+async def run_scheduled_tasks(state: dict, generation: int, now_utc: datetime, budget: RunBudget) -> bool:
+    """Ingestion, delete sweep and digests for one run. Returns True if the state was modified."""
+    state_was_modified = False
+    # One set of long-lived HTTP clients for the whole run.
+    async with ClientRegistry() as clients:
+        # Run ingestion and processing. This function will now modify the state object directly.
+        log.info("Scheduler: Kicking off ingestion and processing.")
+        processed_new = await process_and_publish_offers(state, generation, clients, budget)
+        state_was_modified = state_was_modified or processed_new
+
+        # Perform delete sweep. This also modifies the state object.
+        if budget.allows("delete sweep", estimate=config.HTTP_TIMEOUT):
+            with budget.track("delete sweep"):
+                deleted_count = await perform_delete_sweep(state, clients)
+            if deleted_count > 0:
+                state_was_modified = True
+                log.info(f"Scheduler: Performed delete sweep, {deleted_count} messages processed.")
+            else:
+                log.info("Scheduler: Delete sweep found no messages to process.")
+
+        # Digest publication twice a day.
+        digest_queue = {10: 'morning_digest_queue', 20: 'evening_digest_queue'}.get(now_utc.hour)
+        if digest_queue is None:
+            log.info("Scheduler: Not a digest hour. Skipping digest.")
+        elif budget.allows("digest", estimate=2 * config.HTTP_TIMEOUT):
+            log.info(f"Scheduler: It's a digest hour ({now_utc.hour}:00 UTC). Publishing {digest_queue.split('_')[0]} digest.")
+            with budget.track("digest"):
+                await publish_digest_async(state, generation, digest_queue, clients)
+            state_was_modified = True
+    return state_was_modified
+
+
 async def master_scheduler():
     """Coordinates the main tasks based on a schedule."""
+    budget = RunBudget()
+    tracing.start_run()
     now_utc = datetime.now(timezone.utc)
     log.info(f"Master scheduler running at {now_utc.isoformat()}")
 
@@ -240,31 +381,20 @@ async def master_scheduler():
             log.critical(f"CRITICAL FAILURE: Could not save repaired state file. Aborting run. Error: {e}")
             return "Critical: State repair failed during save."
 
-    # --- CORE LOGIC ---
-    # Run ingestion and processing. This function will now modify the state object directly.
-    log.info("Scheduler: Kicking off ingestion and processing.")
-    processed_new = await process_and_publish_offers(state, generation)
-    state_was_modified = state_was_modified or processed_new
-
-    # Perform delete sweep. This also modifies the state object.
-    deleted_count = await perform_delete_sweep(state)
-    if deleted_count > 0:
+    # Persist one-off upgrades applied by load_state (canonical dedup keys, compact sent_links).
+    if state["sent_links"].upgraded:
         state_was_modified = True
-        log.info(f"Scheduler: Performed delete sweep, {deleted_count} messages processed.")
-    else:
-        log.info("Scheduler: Delete sweep found no messages to process.")
 
-    # Digest publication twice a day.
-    if now_utc.hour == 10: # Morning digest publication hour
-        log.info(f"Scheduler: It's a digest hour ({now_utc.hour}:00 UTC). Publishing morning digest.")
-        await publish_digest_async(state, generation, 'morning_digest_queue')
-        state_was_modified = True
-    elif now_utc.hour == 20: # Evening digest publication hour
-        log.info(f"Scheduler: It's a digest hour ({now_utc.hour}:00 UTC). Publishing evening digest.")
-        await publish_digest_async(state, generation, 'evening_digest_queue')
+    # --- CORE LOGIC ---
+    # The whole core is bounded by the run budget, so a slow run is cut short with time
+    # left to save whatever it changed instead of being killed by gunicorn's timeout.
+    try:
+        processed = await asyncio.wait_for(run_scheduled_tasks(state, generation, now_utc, budget), timeout=budget.remaining())
+        state_was_modified = state_was_modified or processed
+    except asyncio.TimeoutError:
+        log.error(f"Run budget of {budget.total:.0f}s exhausted after {budget.elapsed():.0f}s. Cancelled the remaining work; saving state.")
         state_was_modified = True
-    else:
-        log.info("Scheduler: Not a digest hour. Skipping digest.")
+    log.info(f"Run budget: {budget.summary()}")
     
     # --- FINAL STATE SAVE ---
     # Save the state once at the end if any of the above functions modified it.
@@ -277,6 +407,7 @@ async def master_scheduler():
     else:
         log.info("No changes to state were made during this run. Skipping final save.")
 
+    await tracing.finish_run(elapsed_s=round(budget.elapsed(), 1))
     log.info("Master scheduler run finished.")
     return "Scheduler run complete."
 
@@ -286,14 +417,31 @@ async def master_scheduler():
 def index():
     return "Travel-Bot v7.0 (Modular) is running.", 200
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint (see metrics.py)."""
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
 @app.route("/run", methods=['POST'])
 def run_main_scheduler():
-    """Main endpoint to be triggered by a scheduler."""
+    """
+    Main endpoint to be triggered by a scheduler.
+    With ?profile=1 (and the X-Bot-Secret-Token header) the run is profiled, see profiling.py.
+    """
+    profile = config.to_bool(request.args.get("profile", "0"))
+    if profile and (not config.TELEGRAM_SECRET or request.headers.get("X-Bot-Secret-Token") != config.TELEGRAM_SECRET):
+        log.warning("Unauthorized attempt to run a profiled scheduler run.")
+        return "Unauthorized", 401
+
     # We will implement proper async handling for Flask later if needed.
     # For now, we run the async loop to completion for each request.
     try:
+        if profile:
+            result, profile_summary = run_profiled(master_scheduler)
+            return jsonify({"status": "ok", "result": result, "hosts": host_health.last_summary(), "profile": profile_summary}), 200
         result = asyncio.run(master_scheduler())
-        return jsonify({"status": "ok", "result": result}), 200
+        return jsonify({"status": "ok", "result": result, "hosts": host_health.last_summary()}), 200
     except Exception as e:
         log.exception("Error in /run (master_scheduler) endpoint")
         return jsonify({"status": "error", "message": str(e)}), 500
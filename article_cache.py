@@ -0,0 +1,65 @@
+# article_cache.py
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any
+
+import config
+from gcs_state import load_aux_json, save_aux_json
+from url_canon import canonical_url
+
+log = logging.getLogger(__name__)
+
+# The cache document looks like:
+# {"articles": {canonical_url: {"text": ..., "status": 200, "fetched_at": iso}}}
+# Entries are kept in least-recently-used order (oldest first), which JSON preserves.
+
+def cache_key(url: str) -> str:
+    """Key under which an article is cached, so tracking variants of a link share one entry."""
+    return canonical_url(url)
+
+def load_article_cache() -> Dict[str, Any]:
+    """Loads the scraped-article cache, dropping entries older than ARTICLE_CACHE_TTL_HOURS."""
+    data = load_aux_json(config.ARTICLE_CACHE_FILE)
+    articles = data.get("articles") if isinstance(data.get("articles"), dict) else {}
+
+    expire_before = datetime.now(timezone.utc) - timedelta(hours=config.ARTICLE_CACHE_TTL_HOURS)
+    fresh = {}
+    for key, entry in articles.items():
+        try:
+            if datetime.fromisoformat(entry["fetched_at"]) >= expire_before:
+                fresh[key] = entry
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    expired = len(articles) - len(fresh)
+    if expired:
+        log.info(f"Article cache: expired {expired} entries.")
+    return {"articles": fresh, "hits": 0, "misses": 0}
+
+def save_article_cache(cache: Dict[str, Any]):
+    """Persists the article cache (without the run counters)."""
+    save_aux_json(config.ARTICLE_CACHE_FILE, {"articles": cache.get("articles", {})})
+
+def get_article(cache: Dict[str, Any], url: str) -> Dict[str, Any] | None:
+    """Returns the cached entry for url and marks it as most recently used, or None on a miss."""
+    articles = cache["articles"]
+    entry = articles.pop(cache_key(url), None)
+    if entry is None:
+        cache["misses"] += 1
+        return None
+    articles[cache_key(url)] = entry
+    cache["hits"] += 1
+    return entry
+
+def put_article(cache: Dict[str, Any], url: str, text: str | None, status: int):
+    """Stores an extraction result, evicting least recently used entries above ARTICLE_CACHE_MAX_ENTRIES."""
+    articles = cache["articles"]
+    key = cache_key(url)
+    articles.pop(key, None)
+    articles[key] = {
+        "text": text,
+        "status": status,
+        "fetched_at": datetime.now(timezone.utc).isoformat(),
+    }
+    while len(articles) > max(1, config.ARTICLE_CACHE_MAX_ENTRIES):
+        articles.pop(next(iter(articles)))
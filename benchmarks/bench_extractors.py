@@ -0,0 +1,85 @@
+# benchmarks/bench_extractors.py
+"""
+Compares the HTML extraction engines on the article fixture corpus.
+
+Usage: python -m benchmarks.bench_extractors [--rounds N]
+
+Every engine must produce exactly the same text as the BeautifulSoup reference
+on every fixture, apart from the KNOWN_DIFFERENCES below; the script exits non-zero
+if they differ anywhere else.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from statistics import median
+
+from extractors import EXTRACTORS
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "articles")
+
+# (engine, fixture) -> why the outputs differ. html.parser does not apply HTML5's implied end
+# tags: an unclosed <p> or <li> contains its following siblings, so the fallback vacuum (text per
+# tag) repeats their text, while libxml2 closes them. This is why HTML_EXTRACTOR defaults to bs4.
+KNOWN_DIFFERENCES = {
+    ("lxml", "html5_optional_end_tags_vacuum.html"): "unclosed <p>/<li> in the fallback vacuum",
+}
+
+def load_fixtures():
+    fixtures = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".html"):
+            with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+                fixtures[name] = f.read()
+    return fixtures
+
+def check_parity(fixtures) -> bool:
+    ok = True
+    for name, content in fixtures.items():
+        reference = EXTRACTORS["bs4"](content, name)
+        for engine, extractor in EXTRACTORS.items():
+            if engine == "bs4":
+                continue
+            result = extractor(content, name)
+            if result != reference and (engine, name) in KNOWN_DIFFERENCES:
+                print(f"KNOWN DIFFERENCE [{engine}] {name}: {KNOWN_DIFFERENCES[engine, name]}")
+            elif result != reference:
+                ok = False
+                print(f"MISMATCH [{engine}] {name}:\n  bs4:     {str(reference)[:200]!r}\n  {engine}: {str(result)[:200]!r}")
+    return ok
+
+def bench(fixtures, rounds: int):
+    print(f"{'fixture':<32}{'KB':>8}" + "".join(f"{engine + ' ms':>12}" for engine in EXTRACTORS) + f"{'speedup':>10}")
+    totals = {engine: 0.0 for engine in EXTRACTORS}
+    for name, content in fixtures.items():
+        row = {}
+        for engine, extractor in EXTRACTORS.items():
+            samples = []
+            for _ in range(rounds):
+                started = time.perf_counter()
+                extractor(content, name)
+                samples.append((time.perf_counter() - started) * 1000)
+            row[engine] = median(samples)
+            totals[engine] += row[engine]
+        speedup = row["bs4"] / row["lxml"] if "lxml" in row and row["lxml"] else float("nan")
+        print(f"{name:<32}{len(content) / 1024:>8.0f}" + "".join(f"{row[e]:>12.2f}" for e in EXTRACTORS) + f"{speedup:>9.1f}x")
+    speedup = totals["bs4"] / totals["lxml"] if totals.get("lxml") else float("nan")
+    print(f"{'TOTAL':<40}" + "".join(f"{totals[e]:>12.2f}" for e in EXTRACTORS) + f"{speedup:>9.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING) # extractor progress logs would swamp the table
+    fixtures = load_fixtures()
+    if len(EXTRACTORS) < 2:
+        print("Only the bs4 engine is available (lxml not installed); nothing to compare.")
+    if not check_parity(fixtures):
+        sys.exit(1)
+    print(f"Parity OK on {len(fixtures)} fixtures.\n")
+    bench(fixtures, args.rounds)
+
+if __name__ == "__main__":
+    main()
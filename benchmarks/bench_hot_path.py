@@ -0,0 +1,245 @@
+# benchmarks/bench_hot_path.py
+"""
+Benchmarks the ingestion hot path on the fixture corpus at 1x/10x/100x scale.
+
+Usage: python -m benchmarks.bench_hot_path [--scales 1,10,100] [--rounds N] [--save-baseline] [--tolerance 0.25]
+                                          [--timing-tolerance 1.0] [--gate-timing]
+A full run at the default scales takes a few minutes; use --scales 1,10 for a quick check.
+
+Stages:
+  feed_parse   body hash, parse_feed_entries and cursor walk for every feed fixture (what fetch_feed does per feed)
+  extract      extract_description on every article fixture
+  dedup        filter_new_posts against a seen-set of sent links
+  prune        prune_sent_links on a state with a mix of fresh and expired links
+  payload      serialize_batch for every AI_BATCH_SIZE chunk of candidates
+
+Reports throughput, p50/p95 per round and peak traced memory for every stage and scale.
+Compares against benchmarks/baseline.json and exits non-zero when the peak memory (deterministic
+for a given corpus and code) grew by more than --tolerance. Timings swing by tens of percent
+between identical runs on shared machines, so a p50 slower than --timing-tolerance is only
+reported, unless --gate-timing makes it fail too. The baseline is machine-specific: re-record it
+with --save-baseline after changing hardware or the corpus (see fixtures/MANIFEST.json).
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone, timedelta
+from statistics import median, quantiles
+from typing import Any, Callable, Dict, List, Tuple
+
+import config
+from ai_processing import serialize_batch
+from extractors import extract_description, parse_feed_entries
+from feed_cache import body_hash
+from feed_parser import filter_new_posts, _collect_new_entries
+from gcs_state import prune_sent_links
+from seen_set import SeenSet
+
+BENCH_DIR = os.path.dirname(__file__)
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+MANIFEST_FILE = os.path.join(FIXTURES_DIR, "MANIFEST.json")
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+
+# Workload sizes at 1x; every stage is multiplied by the scale.
+SEEN_LINKS_PER_SCALE = 10_000
+PRUNE_LINKS_PER_SCALE = 10_000
+PAYLOAD_CANDIDATES_PER_SCALE = 100
+
+# ---------- CORPUS ----------
+
+def load_corpus() -> Tuple[int, Dict[str, bytes], Dict[str, bytes]]:
+    """Loads the fixtures listed in the manifest, refusing to run if any file changed without a version bump."""
+    with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    feeds, articles = {}, {}
+    for rel_path, digest in manifest["files"].items():
+        with open(os.path.join(FIXTURES_DIR, rel_path), "rb") as f:
+            content = f.read()
+        if hashlib.sha256(content).hexdigest() != digest:
+            sys.exit(f"Fixture {rel_path} does not match MANIFEST.json. Bump the corpus version and re-record the baseline.")
+        (feeds if rel_path.startswith("feeds/") else articles)[rel_path] = content
+    return manifest["version"], feeds, articles
+
+def _posts(feeds: Dict[str, bytes]) -> List[Tuple[str, str, str, str]]:
+    posts = []
+    for name, content in feeds.items():
+        for entry in parse_feed_entries(content):
+            posts.append((entry["title"], entry["link"], entry["guid"], name))
+    return posts
+
+def _scaled_posts(posts, scale: int) -> List[Tuple[str, str, str, str]]:
+    """The corpus posts repeated `scale` times with distinct links (tracking params kept)."""
+    scaled = []
+    for copy in range(scale):
+        for title, link, guid, source in posts:
+            scaled.append((title, f"{link}{'&' if '?' in link else '?'}copy={copy}", f"{guid}#{copy}" if copy else guid, source))
+    return scaled
+
+def _seen_set(keys: List[str], hours_ago: Callable[[int], int]) -> Dict[str, str]:
+    """Persisted seen-set (as stored in the state) for keys, aged by hours_ago(i)."""
+    now = datetime.now(timezone.utc)
+    seen = SeenSet()
+    for i, key in enumerate(keys):
+        seen[key] = (now - timedelta(hours=hours_ago(i))).isoformat()
+    return seen.to_json()
+
+# ---------- STAGES ----------
+# Each builder returns (prepare, op, items): prepare() makes fresh arguments for a round
+# (not timed), op(*args) is the timed work, items is the amount of work per round.
+
+def stage_feed_parse(corpus, scale: int):
+    feeds = list(corpus["feeds"].items()) * scale
+    def op():
+        for name, content in feeds:
+            body_hash(content)
+            _collect_new_entries(parse_feed_entries(content), name, SeenSet(), None)
+    return (lambda: ()), op, sum(len(parse_feed_entries(c)) for _, c in feeds)
+
+def stage_extract(corpus, scale: int):
+    articles = list(corpus["articles"].items()) * scale
+    def op():
+        for name, content in articles:
+            extract_description(content, name)
+    return (lambda: ()), op, len(articles)
+
+def stage_dedup(corpus, scale: int):
+    posts = _scaled_posts(corpus["posts"], scale)
+    # Half of the corpus posts were already sent, plus unrelated history.
+    sent = [link for _, link, _, _ in posts[::2]] + [f"https://example.com/old/{i}" for i in range(SEEN_LINKS_PER_SCALE * scale)]
+    persisted = _seen_set(sent, lambda i: i % 300)
+    def op(sent_links):
+        return sum(1 for _ in filter_new_posts(posts, sent_links, set()))
+    return (lambda: (SeenSet.from_json(persisted),)), op, len(posts)
+
+def stage_prune(corpus, scale: int):
+    count = PRUNE_LINKS_PER_SCALE * scale
+    # Ages spread over 0-450 h, so about a quarter is older than DEDUP_TTL_HOURS (336).
+    persisted = _seen_set([f"https://example.com/deal/{i}" for i in range(count)], lambda i: i % 450)
+    def op(state):
+        prune_sent_links(state)
+    return (lambda: ({"sent_links": SeenSet.from_json(persisted)},)), op, count
+
+def stage_payload(corpus, scale: int):
+    articles = [extract_description(content, name) for name, content in corpus["articles"].items()]
+    posts = corpus["posts"]
+    candidates = []
+    for i in range(PAYLOAD_CANDIDATES_PER_SCALE * scale):
+        title, link, guid, source = posts[i % len(posts)]
+        candidates.append({"id": i, "title": title, "link": link, "dedup_key": guid, "source_url": source,
+                           "description": articles[i % len(articles)], "host": source, "source_name": source})
+    chunks = [candidates[i:i + config.AI_BATCH_SIZE] for i in range(0, len(candidates), config.AI_BATCH_SIZE)]
+    def op():
+        for chunk in chunks:
+            serialize_batch(chunk)
+    return (lambda: ()), op, len(candidates)
+
+STAGES: Dict[str, Callable] = {
+    "feed_parse": stage_feed_parse,
+    "extract": stage_extract,
+    "dedup": stage_dedup,
+    "prune": stage_prune,
+    "payload": stage_payload,
+}
+
+# ---------- RUNNER ----------
+
+def measure(prepare, op, items: int, rounds: int) -> Dict[str, Any]:
+    samples = []
+    for _ in range(rounds):
+        args = prepare()
+        started = time.perf_counter()
+        op(*args)
+        samples.append((time.perf_counter() - started) * 1000)
+
+    # Peak memory in a separate round: tracing slows the code down and would skew the timings.
+    args = prepare()
+    tracemalloc.start()
+    op(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    p50 = median(samples)
+    p95 = quantiles(samples, n=20, method="inclusive")[-1] if len(samples) > 1 else samples[0]
+    return {
+        "items": items,
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "throughput_per_s": round(items / (p50 / 1000), 1) if p50 else None,
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+def compare(results, baseline, metric: str, tolerance: float) -> List[str]:
+    """Rows whose `metric` exceeds the baseline by more than `tolerance`."""
+    regressions = []
+    for stage, by_scale in results.items():
+        for scale, row in by_scale.items():
+            base = baseline.get("results", {}).get(stage, {}).get(scale)
+            if base and base.get(metric) and row[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{stage} @ {scale}x: {metric} {row[metric]} vs baseline {base[metric]} (+{row[metric] / base[metric] - 1:.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", default="1,10,100")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed peak memory growth before failing")
+    parser.add_argument("--timing-tolerance", type=float, default=1.0, help="p50 slowdown reported (1.0 = twice the baseline)")
+    parser.add_argument("--gate-timing", action="store_true", help="also fail on p50 slowdowns beyond --timing-tolerance")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING) # extractor progress logs would swamp the table
+    version, feeds, articles = load_corpus()
+    corpus = {"feeds": feeds, "articles": articles, "posts": _posts(feeds)}
+    scales = [int(s) for s in args.scales.split(",")]
+
+    print(f"Corpus v{version}: {len(feeds)} feeds ({len(corpus['posts'])} posts), {len(articles)} articles. Extractor: {config.HTML_EXTRACTOR}.\n")
+    print(f"{'stage':<12}{'scale':>6}{'items':>9}{'p50 ms':>11}{'p95 ms':>11}{'items/s':>12}{'peak KB':>11}")
+    results: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for stage in args.stages.split(","):
+        for scale in scales:
+            prepare, op, items = STAGES[stage](corpus, scale)
+            row = measure(prepare, op, items, args.rounds)
+            results.setdefault(stage, {})[str(scale)] = row
+            print(f"{stage:<12}{scale:>5}x{row['items']:>9}{row['p50_ms']:>11.2f}{row['p95_ms']:>11.2f}{row['throughput_per_s'] or 0:>12.0f}{row['peak_kb']:>11.0f}")
+
+    if args.save_baseline:
+        document = {"corpus_version": version, "python": platform.python_version(), "machine": platform.machine(),
+                    "extractor": config.HTML_EXTRACTOR, "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "results": results}
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=2)
+            f.write("\n")
+        print(f"\nBaseline saved to {BASELINE_FILE}.")
+        return
+
+    if not os.path.exists(BASELINE_FILE):
+        print("\nNo baseline recorded yet. Run with --save-baseline to create one.")
+        return
+    with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("corpus_version") != version:
+        sys.exit(f"\nBaseline was recorded on corpus v{baseline.get('corpus_version')}, not v{version}. Re-record it with --save-baseline.")
+    regressions = compare(results, baseline, "peak_kb", args.tolerance)
+    slower = compare(results, baseline, "p50_ms", args.timing_tolerance)
+    if slower:
+        print(f"\n{'REGRESSIONS' if args.gate_timing else 'Slower than the baseline (not gated)'} (timing tolerance {args.timing_tolerance:.0%}):")
+        for line in slower:
+            print(f"  {line}")
+    if regressions:
+        print(f"\nREGRESSIONS (memory tolerance {args.tolerance:.0%}):")
+        for line in regressions:
+            print(f"  {line}")
+    if regressions or (slower and args.gate_timing):
+        sys.exit(1)
+    print(f"\nNo regressions against the baseline (memory tolerance {args.tolerance:.0%}{f', timing tolerance {args.timing_tolerance:.0%}' if args.gate_timing else ''}).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# cassette.py
+import asyncio
+import base64
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Tuple
+
+import httpx
+
+import config
+
+log = logging.getLogger(__name__)
+
+# Record/replay of everything the run talks to, for offline and reproducible runs:
+# - httpx clients (feeds, articles, Telegram, Perplexity) via CassetteTransport,
+# - curl_cffi impersonated fetches via CassetteSession,
+# - SDK calls without an httpx client (Gemini, Telegraph) via recorded_call(),
+# - GCS: with a cassette active the state and auxiliary documents live in LOCAL_STATE_DIR
+#   (see gcs_state), seeded from the cassette's state/ snapshot on replay.
+#
+# CASSETTE_MODE=record appends every exchange (with its duration) to CASSETTE_DIR/exchanges.jsonl;
+# CASSETTE_MODE=replay answers from that file without touching the network. Requests are matched
+# on (channel, method, url, body) first, then on (channel, method, url) in recorded order, so runs
+# whose requests differ only in timestamps or random picks still replay. Requests whose answer is
+# about their body (the Gemini and Perplexity batches: scores and verdicts per candidate id) are
+# strict and only match exactly: a batch made up differently than when recording must not get
+# another batch's answers, and a strict request without one raises ReplayMiss, which fails the run.
+# Other unmatched requests fail like a network error. While a cassette is active the feed pipeline
+# admits posts and hands out candidates in source order (see feed_parser.stream_candidates), so the
+# run makes up the same batches on every replay. CASSETTE_SIMULATE_LATENCY=1 sleeps for the recorded duration (scaled
+# by CASSETTE_LATENCY_SCALE) before answering.
+# Secrets in URLs (the Telegram bot token) are masked before anything is written.
+#
+# Full offline run:  python cassette.py record cassettes/today   then   python cassette.py replay cassettes/today
+
+EXCHANGES_FILE = "exchanges.jsonl"
+STATE_SNAPSHOT_DIR = "state"
+# Headers describing the wire encoding; recorded bodies are stored decoded.
+_WIRE_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+_replay_index: Dict[str, Dict[str, deque]] | None = None
+_last_loose: Dict[str, Dict[str, Any]] = {}
+
+class ReplayMiss(ConnectionError):
+    """A strict request (an AI batch) has no recorded answer: the replay no longer matches the recording."""
+
+def mode() -> str:
+    return config.CASSETTE_MODE if config.CASSETTE_MODE in ("record", "replay") else "off"
+
+def active() -> bool:
+    return mode() != "off"
+
+def replaying() -> bool:
+    return mode() == "replay"
+
+# ---------- STORAGE ----------
+
+def _mask(url: str) -> str:
+    if config.TG_TOKEN:
+        url = url.replace(config.TG_TOKEN, "<TG_TOKEN>")
+    return url
+
+def _keys(channel: str, method: str, url: str, body: bytes) -> Tuple[str, str]:
+    loose = f"{channel} {method.upper()} {_mask(url)}"
+    exact = hashlib.sha256(loose.encode("utf-8") + b"\n" + body).hexdigest()
+    return exact, loose
+
+def _record(channel: str, method: str, url: str, body: bytes, response: Dict[str, Any], elapsed: float):
+    exact, loose = _keys(channel, method, url, body)
+    entry = {"exact": exact, "loose": loose, "elapsed": round(elapsed, 4), **response}
+    os.makedirs(config.CASSETTE_DIR, exist_ok=True)
+    with open(os.path.join(config.CASSETTE_DIR, EXCHANGES_FILE), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+def _load_index() -> Dict[str, Dict[str, deque]]:
+    global _replay_index
+    if _replay_index is None:
+        _replay_index = {"exact": {}, "loose": {}}
+        path = os.path.join(config.CASSETTE_DIR, EXCHANGES_FILE)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    _replay_index["exact"].setdefault(entry["exact"], deque()).append(entry)
+                    _replay_index["loose"].setdefault(entry["loose"], deque()).append(entry)
+        except FileNotFoundError:
+            log.error(f"Cassette {path} not found. Every request will fail.")
+        log.info(f"Cassette: loaded {sum(len(q) for q in _replay_index['exact'].values())} recorded exchanges from {path}.")
+    return _replay_index
+
+def _lookup(channel: str, method: str, url: str, body: bytes, strict: bool = False) -> Dict[str, Any] | None:
+    """
+    Next recorded answer for a request: exact match first, then by URL in recorded order (the last one repeats).
+    A strict request only takes exact matches.
+    """
+    index = _load_index()
+    exact, loose = _keys(channel, method, url, body)
+    queue = index["exact"].get(exact)
+    if strict:
+        return queue.popleft() if queue else None
+    for queue in (queue, index["loose"].get(loose)):
+        if queue:
+            entry = queue.popleft()
+            _last_loose[entry["loose"]] = entry
+            return entry
+    return _last_loose.get(loose)
+
+async def _simulate_latency(entry: Dict[str, Any]):
+    if config.CASSETTE_SIMULATE_LATENCY:
+        await asyncio.sleep(entry.get("elapsed", 0) * config.CASSETTE_LATENCY_SCALE)
+
+def _encode_body(content: bytes) -> str:
+    return base64.b64encode(content).decode("ascii")
+
+def _decode_body(entry: Dict[str, Any]) -> bytes:
+    return base64.b64decode(entry.get("body", ""))
+
+# ---------- HTTPX ----------
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps an httpx transport; records its exchanges or replays them without the network.
+    A request sent with extensions={"cassette_strict": True} is replayed only on an exact match
+    (ReplayMiss otherwise).
+    """
+
+    def __init__(self, inner: httpx.AsyncBaseTransport | None):
+        self.inner = inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        url = str(request.url)
+        if replaying():
+            strict = bool(request.extensions.get("cassette_strict"))
+            entry = _lookup("http", request.method, url, body, strict)
+            if entry is None:
+                if strict:
+                    raise ReplayMiss(f"No recorded response for {request.method} {_mask(url)} with this body")
+                raise httpx.ConnectError(f"No recorded response for {request.method} {_mask(url)}", request=request)
+            await _simulate_latency(entry)
+            return httpx.Response(entry["status"], headers=entry["headers"], content=_decode_body(entry), request=request)
+
+        started = time.monotonic()
+        response = await self.inner.handle_async_request(request)
+        try:
+            content = await response.aread()
+        finally:
+            await response.aclose()
+        headers = [(k, v) for k, v in response.headers.multi_items() if k.lower() not in _WIRE_HEADERS]
+        _record("http", request.method, url, body, {"status": response.status_code, "headers": headers, "body": _encode_body(content)},
+                time.monotonic() - started)
+        return httpx.Response(response.status_code, headers=headers, content=content, request=request, extensions=response.extensions)
+
+    async def aclose(self):
+        if self.inner is not None:
+            await self.inner.aclose()
+
+def wrap_transport(transport: httpx.AsyncBaseTransport | None, **transport_kwargs) -> httpx.AsyncBaseTransport | None:
+    """
+    Returns the transport to hand to httpx.AsyncClient: unchanged when no cassette is active,
+    otherwise a CassetteTransport (around `transport`, or a default one built from transport_kwargs).
+    """
+    if not active():
+        return transport
+    if replaying():
+        return CassetteTransport(None)
+    return CassetteTransport(transport or httpx.AsyncHTTPTransport(**transport_kwargs))
+
+# ---------- CURL_CFFI ----------
+
+class CassetteResponse:
+    """The subset of a curl_cffi response the fetchers use."""
+    def __init__(self, status_code: int, headers: Dict[str, str], content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+class CassetteSession:
+    """Stands in for a curl_cffi AsyncSession: records real impersonated GETs or replays them."""
+
+    def __init__(self, session_factory: Callable[[], Any]):
+        self._factory = session_factory
+        self._session = None
+
+    async def get(self, url: str, **kwargs) -> CassetteResponse:
+        if replaying():
+            entry = _lookup("cffi", "GET", url, b"")
+            if entry is None:
+                raise ConnectionError(f"No recorded response for GET {_mask(url)}")
+            await _simulate_latency(entry)
+            return CassetteResponse(entry["status"], dict(entry["headers"]), _decode_body(entry))
+
+        if self._session is None:
+            self._session = self._factory()
+        started = time.monotonic()
+        response = await self._session.get(url, **kwargs)
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() not in _WIRE_HEADERS]
+        _record("cffi", "GET", url, b"", {"status": response.status_code, "headers": headers, "body": _encode_body(response.content)},
+                time.monotonic() - started)
+        return response
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self) -> "CassetteSession":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+# ---------- SDK CALLS ----------
+
+async def recorded_call(channel: str, request: Any, fn: Callable[[], Any], strict: bool = True) -> Any:
+    """
+    Records or replays one SDK call whose result is JSON-serializable. `request` (JSON-serializable)
+    identifies the call; `fn` performs it and may return a value or an awaitable.
+    Replay needs an identical request (ReplayMiss otherwise) unless strict=False (then the channel's
+    calls are also answered in recorded order). Without an active cassette this is just `fn()`.
+    """
+    body = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    if replaying():
+        entry = _lookup(channel, "CALL", channel, body, strict)
+        if entry is None:
+            if strict:
+                raise ReplayMiss(f"No recorded {channel} call matches this request")
+            raise ConnectionError(f"No recorded {channel} call matches this request")
+        await _simulate_latency(entry)
+        return entry["result"]
+
+    started = time.monotonic()
+    result = fn()
+    if inspect.isawaitable(result):
+        result = await result
+    if mode() == "record":
+        _record(channel, "CALL", channel, body, {"result": result}, time.monotonic() - started)
+    return result
+
+# ---------- STATE ----------
+
+def prepare_state():
+    """
+    Record: snapshots LOCAL_STATE_DIR into the cassette, so the replay starts from the same state.
+    Replay: resets LOCAL_STATE_DIR to that snapshot. Call once before the run.
+    """
+    snapshot = os.path.join(config.CASSETTE_DIR, STATE_SNAPSHOT_DIR)
+    if mode() == "record":
+        if os.path.exists(snapshot):
+            shutil.rmtree(snapshot)
+        if os.path.isdir(config.LOCAL_STATE_DIR):
+            shutil.copytree(config.LOCAL_STATE_DIR, snapshot)
+        exchanges = os.path.join(config.CASSETTE_DIR, EXCHANGES_FILE)
+        if os.path.exists(exchanges):
+            os.remove(exchanges)
+    elif mode() == "replay":
+        if os.path.exists(config.LOCAL_STATE_DIR):
+            shutil.rmtree(config.LOCAL_STATE_DIR)
+        if os.path.isdir(snapshot):
+            shutil.copytree(snapshot, config.LOCAL_STATE_DIR)
+        else:
+            os.makedirs(config.LOCAL_STATE_DIR, exist_ok=True)
+
+def reset():
+    """Forgets the loaded replay index, so the next replay starts from the first recorded exchange."""
+    global _replay_index
+    _replay_index = None
+    _last_loose.clear()
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("record", "replay"):
+        sys.exit("usage: python cassette.py record|replay [cassette_dir]")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    config.CASSETTE_MODE = sys.argv[1]
+    if len(sys.argv) > 2:
+        config.CASSETTE_DIR = sys.argv[2]
+    prepare_state()
+
+    from app import master_scheduler
+    started = time.monotonic()
+    result = asyncio.run(master_scheduler())
+    log.info(f"Cassette {config.CASSETTE_MODE} finished in {time.monotonic() - started:.1f}s: {result}")
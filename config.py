@@ -21,8 +21,30 @@ GEMINI_API_KEY = env("GEMINI_API_KEY")
 PERPLEXITY_API_KEY = env("PERPLEXITY_API_KEY")
 BUCKET_NAME = env("BUCKET_NAME")
 SENT_LINKS_FILE = env("SENT_LINKS_FILE", "sent_links.json")
+STATE_ENCODING = env("STATE_ENCODING", "json") # "binary": versioned msgpack/zstd with lazily decoded digest queues, see state_codec.py
+STATE_LAYOUT = env("STATE_LAYOUT", "single") # "sharded" (separately locked objects) or "journal" (snapshot + deltas), see gcs_state.py
+STATE_SHARD_PREFIX = env("STATE_SHARD_PREFIX", "state/")
+STATE_JOURNAL_PREFIX = env("STATE_JOURNAL_PREFIX", "journal/")
+STATE_JOURNAL_MAX_DELTAS = int(env("STATE_JOURNAL_MAX_DELTAS", "50")) # compact the journal into a new snapshot after this many deltas
+STATE_JOURNAL_MAX_BYTES = int(env("STATE_JOURNAL_MAX_BYTES", "1000000")) # ... or once the deltas add up to this size
 TELEGRAM_SECRET = env("TELEGRAM_SECRET")
 PORT = env("PORT", "8080")
+LOCAL_STATE_DIR = env("LOCAL_STATE_DIR", ".state")
+FEED_CACHE_FILE = env("FEED_CACHE_FILE", "feed_cache.json")
+ARTICLE_CACHE_FILE = env("ARTICLE_CACHE_FILE", "article_cache.json")
+RATE_LIMITS_FILE = env("RATE_LIMITS_FILE", "host_rates.json")
+HOST_HEALTH_FILE = env("HOST_HEALTH_FILE", "host_health.json")
+FEED_SCHEDULE_FILE = env("FEED_SCHEDULE_FILE", "feed_schedule.json")
+CASSETTE_MODE = env("CASSETTE_MODE", "off") # "record" or "replay" for offline runs (see cassette.py)
+CASSETTE_DIR = env("CASSETTE_DIR", "cassettes/default")
+CASSETTE_SIMULATE_LATENCY = to_bool(env("CASSETTE_SIMULATE_LATENCY", "0"))
+CASSETTE_LATENCY_SCALE = float(env("CASSETTE_LATENCY_SCALE", "1.0"))
+TRACE_EXPORT = env("TRACE_EXPORT", "off") # "jsonl" or "otlp" to export per-candidate spans (see tracing.py)
+TRACE_FILE = env("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = env("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+PROFILE_PREFIX = env("PROFILE_PREFIX", "profiles") # where /run?profile=1 stores its artifacts (see profiling.py)
+PROFILE_LOOP_LAG_INTERVAL = float(env("PROFILE_LOOP_LAG_INTERVAL", "0.05"))
+PROFILE_TRACEMALLOC_FRAMES = int(env("PROFILE_TRACEMALLOC_FRAMES", "10"))
 
 # --- NordVPN Proxy Credentials ---
 NORD_USER = env("NORD_USER")
@@ -30,16 +52,48 @@ NORD_PASS = env("NORD_PASS")
 
 # ---------- RUN BEHAVIOR PARAMS ----------
 HTTP_TIMEOUT = float(env("HTTP_TIMEOUT", "15.0"))
+HTTP_MAX_CONNECTIONS = int(env("HTTP_MAX_CONNECTIONS", "32"))
+HTTP_MAX_KEEPALIVE = int(env("HTTP_MAX_KEEPALIVE", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(env("HTTP_KEEPALIVE_EXPIRY", "60"))
 DEBUG_FEEDS = to_bool(env("DEBUG_FEEDS", "0"))
 MAX_POSTS_PER_RUN = int(env("MAX_POSTS_PER_RUN", "0"))
 DELETE_AFTER_HOURS = int(env("DELETE_AFTER_HOURS", "48"))
 DEDUP_TTL_HOURS = int(env("DEDUP_TTL_HOURS", "336"))
 MAX_PER_DOMAIN = int(env("MAX_PER_DOMAIN", "8"))
 PER_HOST_CONCURRENCY = int(env("PER_HOST_CONCURRENCY", "2"))
-JITTER_MIN_MS = int(env("JITTER_MIN_MS", "120"))
-JITTER_MAX_MS = int(env("JITTER_MAX_MS", "400"))
+RATE_LIMIT_INITIAL_RPS = float(env("RATE_LIMIT_INITIAL_RPS", "2.0"))
+RATE_LIMIT_MIN_RPS = float(env("RATE_LIMIT_MIN_RPS", "0.1"))
+RATE_LIMIT_MAX_RPS = float(env("RATE_LIMIT_MAX_RPS", "10.0"))
+RATE_LIMIT_STEP_RPS = float(env("RATE_LIMIT_STEP_RPS", "0.25"))
+RATE_LIMIT_BURST = int(env("RATE_LIMIT_BURST", "2"))
+RATE_LIMIT_MAX_WAIT_SECONDS = float(env("RATE_LIMIT_MAX_WAIT_SECONDS", "30"))
+RATE_LIMIT_MAX_BACKOFF_SECONDS = float(env("RATE_LIMIT_MAX_BACKOFF_SECONDS", "3600"))
+CIRCUIT_FAILURE_THRESHOLD = int(env("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_OPEN_SECONDS = int(env("CIRCUIT_OPEN_SECONDS", "3600"))
 AI_BATCH_SIZE = int(env("AI_BATCH_SIZE", "5"))
 AI_BATCH_WAIT_SECONDS = int(env("AI_BATCH_WAIT_SECONDS", "1"))
+SCRAPE_CONCURRENCY = int(env("SCRAPE_CONCURRENCY", "8"))
+SCRAPE_DEADLINE_SECONDS = float(env("SCRAPE_DEADLINE_SECONDS", "240"))
+PIPELINE_QUEUE_SIZE = int(env("PIPELINE_QUEUE_SIZE", "100")) # max in-flight items between pipeline stages
+FEED_FETCH_DEADLINE_SECONDS = float(env("FEED_FETCH_DEADLINE_SECONDS", "180"))
+RUN_BUDGET_SECONDS = float(env("RUN_BUDGET_SECONDS", "840")) # must stay below gunicorn's --timeout (900)
+RUN_BUDGET_RESERVE_SECONDS = float(env("RUN_BUDGET_RESERVE_SECONDS", "45")) # always kept for saving state
+SCRAPE_STREAMING = to_bool(env("SCRAPE_STREAMING", "1"))
+SCRAPE_MAX_BYTES = int(env("SCRAPE_MAX_BYTES", "1500000"))
+ARTICLE_CACHE_TTL_HOURS = int(env("ARTICLE_CACHE_TTL_HOURS", "72"))
+ARTICLE_CACHE_MAX_ENTRIES = int(env("ARTICLE_CACHE_MAX_ENTRIES", "1500"))
+HTML_EXTRACTOR = env("HTML_EXTRACTOR", "bs4") # "bs4" (reference) or "lxml" (fast; differs on unclosed <p>/<li>, see benchmarks/bench_extractors.py)
+PARSE_POOL = env("PARSE_POOL", "process") # "process", "thread" or "off" (parse inline on the event loop)
+PARSE_POOL_WORKERS = int(env("PARSE_POOL_WORKERS", "2"))
+PARSE_POOL_MAX_QUEUE = int(env("PARSE_POOL_MAX_QUEUE", "16"))
+FEED_POLL_ADAPTIVE = to_bool(env("FEED_POLL_ADAPTIVE", "1"))
+FEED_POLL_MIN_SECONDS = int(env("FEED_POLL_MIN_SECONDS", "900"))
+FEED_POLL_MAX_SECONDS = int(env("FEED_POLL_MAX_SECONDS", "21600")) # longest a feed may go unpolled
+FEED_POLL_FACTOR = float(env("FEED_POLL_FACTOR", "0.5")) # poll interval as a fraction of the typical gap between posts
+FEED_POLL_GRACE_SECONDS = int(env("FEED_POLL_GRACE_SECONDS", "300")) # feeds due this soon are fetched in the current run
+NEAR_DUP_ENABLED = to_bool(env("NEAR_DUP_ENABLED", "1"))
+NEAR_DUP_MAX_DISTANCE = int(env("NEAR_DUP_MAX_DISTANCE", "5")) # max differing SimHash bits (of 64) for a near-duplicate
+NEAR_DUP_TTL_HOURS = int(env("NEAR_DUP_TTL_HOURS", "168"))
 
 # ---------- HARDCODED CONSTANTS & DICTIONARIES ----------
 
@@ -55,6 +109,12 @@ DROP_PARAMS: set = {
     "fbclid", "gclid", "igshid", "mc_cid", "mc_eid", "ref", "ref_src", "src"
 }
 
+# --- NEAR-DUPLICATES ---
+# When several sources publish the same deal, the copy from the earliest host in this list is kept.
+NEAR_DUP_SOURCE_PRIORITY: List[str] = [
+    "fly4free.pl", "wakacyjnipiraci.pl", "fly4free.com", "holidaypirates.com",
+]
+
 # --- DIGEST ---
 DIGEST_IMAGE_URLS: List[str] = [
     "https://images.unsplash.com/photo-1516483638261-f4dbaf036963?q=80&w=2800&auto=format&fit=crop&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D",
@@ -0,0 +1,277 @@
+# extractors.py
+import logging
+import re
+import calendar
+import feedparser
+from html.parser import HTMLParser
+from typing import Any, Callable, Dict, List, Tuple
+from bs4 import BeautifulSoup, UnicodeDammit
+
+import config
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError: # lxml is optional, the BeautifulSoup engine always works
+    lxml = None
+
+log = logging.getLogger(__name__)
+
+# ---------- SHARED EXTRACTION RULES ----------
+# Zmienione selektory na kontenery, aby łapać też listy <li>, nagłówki itp.
+CONTAINER_SELECTORS: List[str] = ['article', '.entry-content', '.post-content', '.post-body', 'main', '#content', '.content']
+CONTAINER_GARBAGE: List[str] = ['script', 'style', 'nav', 'footer', 'form', 'iframe', '.share-buttons', '.related-posts', '.comments', '.sidebar', '.ads', 'header']
+BODY_GARBAGE: List[str] = ['script', 'style', 'nav', 'footer', 'form', 'iframe', 'header', 'aside', '.sidebar', '.menu', '.ads', '.cookie-banner', '.popup', '.comments']
+VALUABLE_TAGS: List[str] = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li']
+DESCRIPTION_LIMIT = 2000 # Zwiększamy limit dla bezpieczeństwa AI
+
+def _truncate(extracted_text: str) -> str | None:
+    """Final processing shared by all engines: cut to DESCRIPTION_LIMIT on a word boundary."""
+    if not extracted_text:
+        return None
+    if len(extracted_text) > DESCRIPTION_LIMIT:
+        last_space = extracted_text.rfind(' ', 0, DESCRIPTION_LIMIT)
+        return extracted_text[:last_space] + '...' if last_space != -1 else extracted_text[:DESCRIPTION_LIMIT] + '...'
+    return extracted_text
+
+# ---------- BEAUTIFULSOUP ENGINE (REFERENCE) ----------
+
+def extract_with_bs4(content: bytes, url: str) -> str | None:
+    """Reference extractor: full BeautifulSoup tree with html.parser."""
+    soup = BeautifulSoup(content, "html.parser")
+
+    # --- PHASE 1: Targeted Extraction (Preferred) ---
+    extracted_text = ""
+    for sel in CONTAINER_SELECTORS:
+        container = soup.select_one(sel)
+        if container:
+            # OPTYMALIZACJA: Usuwamy śmieci ZANIM pobierzemy tekst
+            for garbage in container.select(', '.join(CONTAINER_GARBAGE)):
+                garbage.decompose()
+
+            text = container.get_text(separator=' ', strip=True)
+            if len(text) > 100: # Minimum sensownej treści
+                extracted_text = text
+                log.info(f"Scraped content using selector '{sel}': {len(text)} chars.")
+                break
+
+    # --- PHASE 2: Fallback "Vacuum" (If Phase 1 failed) ---
+    if len(extracted_text) < 100:
+        log.info(f"Targeted scraping failed for {url} (found {len(extracted_text)} chars). Initiating Fallback Vacuum...")
+        if soup.body:
+            # 1. Clean the entire body
+            for garbage in soup.body.select(', '.join(BODY_GARBAGE)):
+                garbage.decompose()
+
+            # 2. Gather text from content-heavy tags
+            # Szukamy akapitów, nagłówków i elementów list
+            valuable_tags = soup.body.find_all(VALUABLE_TAGS)
+            vacuumed_text = " ".join([tag.get_text(strip=True) for tag in valuable_tags])
+
+            if len(vacuumed_text) > 50:
+                extracted_text = vacuumed_text
+                log.info(f"Fallback Vacuum recovered {len(extracted_text)} chars from {url}.")
+            else:
+                log.warning(f"Fallback Vacuum also failed for {url}.")
+
+    return _truncate(extracted_text)
+
+# ---------- LXML ENGINE (FAST) ----------
+
+# BeautifulSoup's get_text() ignores comments and the bodies of these elements.
+_NON_TEXT_TAGS = {'script', 'style', 'template'}
+_BODY_TAG_RE = re.compile(rb'<body[\s>/]', re.IGNORECASE)
+
+def _css_to_xpath(selector: str, scope: str) -> str:
+    """Translates the simple selectors used above (tag, .class, #id) to XPath."""
+    if selector.startswith('.'):
+        return f"{scope}*[contains(concat(' ', normalize-space(@class), ' '), ' {selector[1:]} ')]"
+    if selector.startswith('#'):
+        return f"{scope}*[@id='{selector[1:]}']"
+    return f"{scope}{selector}"
+
+if lxml is not None:
+    _CONTAINER_XPATHS = [(sel, etree.XPath(f"({_css_to_xpath(sel, '//')})[1]")) for sel in CONTAINER_SELECTORS]
+    _CONTAINER_GARBAGE_XPATH = etree.XPath(' | '.join(_css_to_xpath(sel, './/') for sel in CONTAINER_GARBAGE))
+    _BODY_GARBAGE_XPATH = etree.XPath(' | '.join(_css_to_xpath(sel, './/') for sel in BODY_GARBAGE))
+    _VALUABLE_XPATH = etree.XPath(' | '.join(f'.//{tag}' for tag in VALUABLE_TAGS))
+
+def _iter_strings(element):
+    """Yields text nodes under element in document order, like BeautifulSoup's _all_strings()."""
+    if not isinstance(element.tag, str) or element.tag in _NON_TEXT_TAGS:
+        return
+    if element.text:
+        yield element.text
+    for child in element:
+        yield from _iter_strings(child)
+        if child.tail:
+            yield child.tail
+
+def _get_text(element, separator: str = '') -> str:
+    return separator.join(s for s in (s.strip() for s in _iter_strings(element)) if s)
+
+def _vacuum_text(tag) -> str:
+    """get_text() of one valuable tag; BeautifulSoup gives '' for a tag inside a <template> (TemplateString content)."""
+    return '' if next(tag.iterancestors('template'), None) is not None else _get_text(tag)
+
+def _parse_lxml(content: bytes):
+    try:
+        markup = content.decode('utf-8')
+    except UnicodeDecodeError:
+        markup = UnicodeDammit(content, is_html=True).unicode_markup
+    try:
+        return lxml.html.document_fromstring(markup)
+    except ValueError: # unicode input with an XML encoding declaration
+        return lxml.html.document_fromstring(content)
+
+def extract_with_lxml(content: bytes, url: str) -> str | None:
+    """
+    Fast extractor: libxml2 tree with precompiled XPath, same rules and output as extract_with_bs4,
+    except in the fallback vacuum of pages with unclosed <p>/<li> (libxml2 closes them, html.parser nests them).
+    """
+    root = _parse_lxml(content)
+
+    # --- PHASE 1: Targeted Extraction (Preferred) ---
+    extracted_text = ""
+    for sel, xpath in _CONTAINER_XPATHS:
+        found = xpath(root)
+        if found:
+            container = found[0]
+            for garbage in _CONTAINER_GARBAGE_XPATH(container):
+                garbage.drop_tree()
+
+            text = _get_text(container, ' ')
+            if len(text) > 100:
+                extracted_text = text
+                log.info(f"Scraped content using selector '{sel}': {len(text)} chars.")
+                break
+
+    # --- PHASE 2: Fallback "Vacuum" (If Phase 1 failed) ---
+    if len(extracted_text) < 100:
+        log.info(f"Targeted scraping failed for {url} (found {len(extracted_text)} chars). Initiating Fallback Vacuum...")
+        # libxml2 always synthesizes a <body>; html.parser only has one if the page does.
+        body = root.find('body') if _BODY_TAG_RE.search(content) else None
+        if body is not None:
+            for garbage in _BODY_GARBAGE_XPATH(body):
+                garbage.drop_tree()
+
+            vacuumed_text = " ".join(_vacuum_text(tag) for tag in _VALUABLE_XPATH(body))
+            if len(vacuumed_text) > 50:
+                extracted_text = vacuumed_text
+                log.info(f"Fallback Vacuum recovered {len(extracted_text)} chars from {url}.")
+            else:
+                log.warning(f"Fallback Vacuum also failed for {url}.")
+
+    return _truncate(extracted_text)
+
+# ---------- STREAMING PROBE ----------
+
+_PROBE_GARBAGE_TAGS = {sel for sel in CONTAINER_GARBAGE if sel[0] not in '.#'}
+_PROBE_GARBAGE_CLASSES = {sel[1:] for sel in CONTAINER_GARBAGE if sel.startswith('.')}
+_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+def _probe_matches(tag: str, classes: set, element_id: str | None) -> List[int]:
+    """Indexes into CONTAINER_SELECTORS of the selectors an element matches."""
+    return [i for i, sel in enumerate(CONTAINER_SELECTORS)
+            if (sel[1:] in classes if sel[0] == '.' else sel[1:] == element_id if sel[0] == '#' else sel == tag)]
+
+class ArticleProbe(HTMLParser):
+    """
+    Incremental HTML watcher for streamed article downloads.
+    Feed it decoded chunks; `done` turns True once the rest of the page cannot change the
+    extraction: it takes the first element of the highest-priority selector in
+    CONTAINER_SELECTORS with more than 100 characters, so the probe waits until that element
+    has closed and the first element of every selector before it has closed with too little text.
+    A page where a higher-priority selector could still appear is read to the end (or the byte cap).
+    Text inside script/style and the garbage selectors is not counted.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.done = False
+        self._stack: List[Tuple[str, List[int], bool]] = [] # (tag, selectors it is the first match of, is_garbage)
+        self._container_text: List[int] = [] # text counters for the open first matches
+        self._garbage_depth = 0
+        self._claimed: set = set() # selectors whose first match has been opened
+        self._closed: Dict[int, int] = {} # selector -> text length of its closed first match
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _VOID_TAGS:
+            return
+        attrs = dict(attrs)
+        classes = set((attrs.get('class') or '').split())
+        firsts = [i for i in _probe_matches(tag, classes, attrs.get('id')) if i not in self._claimed]
+        self._claimed.update(firsts)
+        is_garbage = tag in _PROBE_GARBAGE_TAGS or bool(classes & _PROBE_GARBAGE_CLASSES)
+        self._stack.append((tag, firsts, is_garbage))
+        if firsts:
+            self._container_text.append(0)
+        if is_garbage:
+            self._garbage_depth += 1
+
+    def handle_endtag(self, tag):
+        # Pop up to the matching open tag, tolerating unclosed children.
+        if not any(open_tag == tag for open_tag, _, _ in self._stack):
+            return
+        while self._stack:
+            open_tag, firsts, is_garbage = self._stack.pop()
+            if is_garbage:
+                self._garbage_depth -= 1
+            if firsts:
+                self._close_container(firsts, self._container_text.pop())
+            if open_tag == tag:
+                break
+
+    def _close_container(self, firsts: List[int], text_length: int):
+        for i in firsts:
+            self._closed[i] = text_length
+        for i in range(len(CONTAINER_SELECTORS)):
+            if i not in self._closed:
+                return # this selector may still match later in the page
+            if self._closed[i] > 100:
+                self.done = True
+                return
+
+    def handle_data(self, data):
+        if self._garbage_depth or not self._container_text:
+            return
+        length = len(data.strip())
+        if length:
+            # Text counts towards every open container (they are nested).
+            self._container_text = [n + length for n in self._container_text]
+
+# ---------- FEED ENTRIES ----------
+
+def parse_feed_entries(content: bytes) -> List[Dict[str, Any]]:
+    """
+    Parses an RSS/Atom document into plain entry dicts (title, link, guid, published epoch seconds).
+    Plain dicts keep the result cheap to send back from a parsing worker process.
+    """
+    entries = []
+    for entry in feedparser.parse(content).entries:
+        parsed = entry.get("published_parsed") or entry.get("updated_parsed")
+        entries.append({
+            "title": entry.get("title"),
+            "link": entry.get("link"),
+            "guid": entry.get("guid", entry.get("link")),
+            "published": float(calendar.timegm(parsed)) if parsed else None,
+        })
+    return entries
+
+# ---------- ENGINE SELECTION ----------
+
+EXTRACTORS: Dict[str, Callable[[bytes, str], str | None]] = {"bs4": extract_with_bs4}
+if lxml is not None:
+    EXTRACTORS["lxml"] = extract_with_lxml
+
+def get_extractor(name: str | None = None) -> Callable[[bytes, str], str | None]:
+    """Returns the configured extraction engine (HTML_EXTRACTOR), falling back to BeautifulSoup."""
+    name = name or config.HTML_EXTRACTOR
+    extractor = EXTRACTORS.get(name)
+    if extractor is None:
+        log.warning(f"HTML extractor '{name}' is not available. Falling back to 'bs4'.")
+        return extract_with_bs4
+    return extractor
+
+def extract_description(content: bytes, url: str) -> str | None:
+    """Extracts up to ~2000 characters of article text from raw HTML with the configured engine."""
+    return get_extractor()(content, url)
@@ -0,0 +1,83 @@
+# feed_cache.py
+import logging
+import hashlib
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Tuple
+
+import config
+from gcs_state import load_aux_json, save_aux_json
+
+log = logging.getLogger(__name__)
+
+# The cache document looks like:
+# {"feeds": {feed_url: {"etag": ..., "last_modified": ..., "sha256": ..., "entries": [[title, link, guid, published], ...],
+#                       "cursor": {"guid": ..., "published": epoch_seconds | None}, "checked_at": ...}}}
+# The entries are the whole parsed feed, not the posts picked from it: on a hit the caller
+# picks again against the current sent links and cursor, so posts past MAX_PER_DOMAIN come
+# out on later runs even while the feed does not change.
+# Hit/miss counters live on the loaded object only and are never persisted.
+
+def load_feed_cache() -> Dict[str, Any]:
+    """Loads the per-feed validator cache and resets the per-run hit/miss counters."""
+    data = load_aux_json(config.FEED_CACHE_FILE)
+    feeds = data.get("feeds") if isinstance(data.get("feeds"), dict) else {}
+    return {"feeds": feeds, "hits": 0, "misses": 0}
+
+def save_feed_cache(cache: Dict[str, Any]):
+    """Persists the validator cache (without the run counters)."""
+    save_aux_json(config.FEED_CACHE_FILE, {"feeds": cache.get("feeds", {})})
+
+def body_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def conditional_headers(cache: Dict[str, Any], url: str) -> Dict[str, str]:
+    """Returns If-None-Match / If-Modified-Since headers for a feed we have seen before."""
+    entry = cache["feeds"].get(url)
+    if not entry or "entries" not in entry:
+        return {}
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def cached_entries(cache: Dict[str, Any], url: str, digest: str | None = None) -> List[Dict[str, Any]] | None:
+    """
+    Returns the entries parsed on a previous run (as extractors.parse_feed_entries) if the feed
+    is unchanged, counting a hit. With digest=None (a 304 response) only the entry's existence
+    is checked; otherwise the stored body hash must match. Returns None on a miss.
+    """
+    entry = cache["feeds"].get(url)
+    if not entry or "entries" not in entry or (digest is not None and entry.get("sha256") != digest):
+        return None
+    cache["hits"] += 1
+    entry["checked_at"] = datetime.now(timezone.utc).isoformat()
+    return [{"title": title, "link": link, "guid": guid, "published": published} for title, link, guid, published in entry["entries"]]
+
+def get_cursor(cache: Dict[str, Any] | None, url: str) -> Dict[str, Any] | None:
+    """Returns the high-water mark recorded for a feed: every entry from it down is already processed."""
+    if cache is None:
+        return None
+    return cache["feeds"].get(url, {}).get("cursor")
+
+def update_cursor(cache: Dict[str, Any] | None, url: str, cursor: Dict[str, Any] | None):
+    """Moves a cached feed's cursor (no-op without a cache, a cached feed or a new cursor)."""
+    if cache is not None and cursor and url in cache["feeds"]:
+        cache["feeds"][url]["cursor"] = cursor
+
+def store_feed(cache: Dict[str, Any], url: str, headers, digest: str, entries: List[Dict[str, Any]], cursor: Dict[str, Any] | None = None):
+    """
+    Records the validators, body hash and parsed entries for a freshly parsed feed, counting a miss.
+    The previous cursor is kept when no new one is given.
+    """
+    cache["misses"] += 1
+    cursor = cursor or get_cursor(cache, url)
+    cache["feeds"][url] = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "sha256": digest,
+        "entries": [[e["title"], e["link"], e["guid"], e["published"]] for e in entries],
+        "cursor": cursor,
+        "checked_at": datetime.now(timezone.utc).isoformat(),
+    }
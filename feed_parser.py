@@ -3,41 +3,53 @@ import logging
 import asyncio
 import random
 import time
-import feedparser
+import codecs
+import weakref
 import httpx
-from curl_cffi import requests as cffi_requests
 from urllib.parse import urlparse
-from bs4 import BeautifulSoup
 from typing import List, Tuple, Dict
 
 import config
-from utils import make_async_client
+import cassette
+import rate_limiter
+import host_health
+import poll_scheduler
+import metrics
+import tracing
+from run_budget import RunBudget
+from url_canon import canonical_key, canonical_url
+from utils import make_impersonated_session, ImpersonatedSessionPool, ClientRegistry, DIRECT, PROXIED
+from extractors import extract_description, parse_feed_entries, ArticleProbe
+from parse_pool import run_parser, warm_up
+from article_cache import load_article_cache, save_article_cache, get_article, put_article
+from feed_cache import load_feed_cache, save_feed_cache, body_hash, conditional_headers, cached_entries, store_feed, get_cursor, update_cursor
 
 log = logging.getLogger(__name__)
 
 # --- Nuclear Option for Google News ---
-def fetch_with_cffi(url: str):
+IMPERSONATION_HOSTS = ["news.google.com", "google.com", "rushflights.com"]
+
+def _needs_impersonation(host: str) -> bool:
+    return any(domain in host for domain in IMPERSONATION_HOSTS)
+
+async def fetch_with_cffi(url: str, session_pool: ImpersonatedSessionPool | None = None):
     """
     Uses curl_cffi to impersonate a real browser's TLS fingerprint.
     Crucial for Google News RSS which blocks standard Python http clients (httpx/requests)
-    running from Cloud IPs.
+    running from Cloud IPs. Runs natively on the event loop; with a session_pool the
+    per-host session (and its connections) is reused across calls.
     """
+    # Jitter to look more human (not part of the latency fed to the host's circuit breaker)
+    await asyncio.sleep(random.uniform(0.5, 1.5))
+    started = time.monotonic()
     try:
-        # Jitter to look more human
-        time.sleep(random.uniform(0.5, 1.5))
-
         log.info(f"🚀 Launching curl_cffi (Chrome impersonation) for: {url}")
-        
-        response = cffi_requests.get(
-            url, 
-            impersonate="chrome120", 
-            headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'pl-PL,pl;q=0.9,en-US;q=0.8,en;q=0.7',
-            },
-            timeout=30
-        )
+        if session_pool is not None:
+            response = await session_pool.session_for(url).get(url)
+        else:
+            async with make_impersonated_session() as session:
+                response = await session.get(url)
+        _observe_response(url, response.status_code, response.headers.get("Retry-After"), started)
         
         if response.status_code == 200:
             log.info(f"✅ SUCCESS! {url} breached via curl_cffi.")
@@ -47,20 +59,34 @@ def fetch_with_cffi(url: str):
             return None
 
     except Exception as e:
+        _observe_error(url, started)
         log.error(f"❌ Error in curl_cffi: {e}", exc_info=True)
         return None
 
 # Concurrency & Rate Limiting Helpers
-_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+# Semaphores are per event loop: every /run executes in a fresh loop via asyncio.run.
+_host_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
 
 def _sem_for(url: str) -> asyncio.Semaphore:
     host = urlparse(url).netloc.lower()
-    if host not in _host_semaphores:
-        _host_semaphores[host] = asyncio.Semaphore(config.PER_HOST_CONCURRENCY)
-    return _host_semaphores[host]
+    semaphores = _host_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(config.PER_HOST_CONCURRENCY)
+    return semaphores[host]
 
-async def _jitter():
-    await asyncio.sleep(random.uniform(config.JITTER_MIN_MS/1000.0, config.JITTER_MAX_MS/1000.0))
+def _observe_response(url: str, status: int, retry_after: str | None, started: float):
+    """Feeds a response into the rate limiter and the host's circuit breaker."""
+    rate_limiter.record_response(url, status, retry_after)
+    latency_ms = (time.monotonic() - started) * 1000
+    if status >= 500 or status == 429:
+        host_health.record_failure(url, latency_ms)
+    else:
+        host_health.record_success(url, latency_ms)
+
+def _observe_error(url: str, started: float):
+    """Feeds a network error or timeout into the rate limiter and the host's circuit breaker."""
+    rate_limiter.record_error(url)
+    host_health.record_failure(url, (time.monotonic() - started) * 1000)
 
 def build_headers(url: str) -> Dict[str, str]:
     host = urlparse(url).netloc.lower().replace("www.", "")
@@ -91,197 +117,393 @@ def get_sources(filename: str) -> List[str]:
         log.warning(f"Source file not found: {filename}")
         return []
 
-async def fetch_feed(client: httpx.AsyncClient, url: str) -> List[Tuple[str, str, str, str]]:
-    """Fetches and parses a single RSS feed, using curl_cffi for specific domains."""
+def _collect_new_entries(entries, url: str, seen, cursor: Dict[str, any] | None) -> Tuple[List[Tuple[str, str, str, str]], Dict[str, any] | None]:
+    """
+    Walks parsed feed entries (see extractors.parse_feed_entries) newest-first and collects up to MAX_PER_DOMAIN unseen posts.
+    `seen` holds canonical keys (url_canon.canonical_key).
+    For reverse-chronological feeds the walk stops at the stored cursor (its GUID, or an entry
+    older than its timestamp) and skips already-seen entries on the way, so an older entry
+    that was never processed (held back by the run budget, a failed batch or audit) is offered
+    again. The cursor only moves up to the newest entry of the contiguous run of seen entries
+    that ends at the old cursor (or at the end of the feed): it never passes an unseen entry.
+    Feeds that are not ordered newest-first are scanned in full, skipping seen entries.
+    Returns (posts, new_cursor); new_cursor is None when the cursor does not move.
+    """
+    known = [e["published"] for e in entries if e["published"] is not None]
+    ordered = all(a >= b for a, b in zip(known, known[1:]))
+    cursor_guid = cursor.get("guid") if cursor else None
+    cursor_ts = cursor.get("published") if cursor else None
+
+    posts = []
+    seen_run = None # newest entry of the seen run directly above the cursor, if any
+    for entry in entries:
+        guid, published = entry["guid"], entry["published"]
+        if not (entry["title"] and entry["link"] and guid):
+            continue
+        if ordered and (guid == cursor_guid or (cursor_ts is not None and published is not None and published < cursor_ts)):
+            break
+        if guid == cursor_guid or (seen is not None and canonical_key(guid) in seen):
+            if seen_run is None:
+                seen_run = {"guid": guid, "published": published}
+            continue
+        seen_run = None
+        if len(posts) < config.MAX_PER_DOMAIN:
+            posts.append((entry["title"], entry["link"], guid, url))
+        elif not ordered:
+            break
+    return posts, seen_run if ordered else None
+
+async def fetch_feed(client: httpx.AsyncClient, url: str, feed_cache: Dict[str, any] | None = None, seen=None, session_pool: ImpersonatedSessionPool | None = None) -> List[Tuple[str, str, str, str]]:
+    """
+    Fetches and parses a single RSS feed, using curl_cffi for specific domains.
+    With a feed_cache, the request is conditional (ETag / Last-Modified) and an unchanged
+    feed (304 or identical body hash) is served from the cached entries without parsing;
+    the posts are picked from them again, so the next unseen ones come out.
+    `seen` (any container of already-processed GUIDs) lets the parser skip known entries,
+    so MAX_PER_DOMAIN only counts genuinely new posts (see _collect_new_entries).
+    """
     posts = []
     content = None
+    entries = None
+    response_headers = {}
+    if not host_health.allow(url):
+        return posts
     try:
         async with _sem_for(url):
-            await _jitter()
+            if not await rate_limiter.acquire(url):
+                return posts
             
             host = urlparse(url).netloc.lower()
             
             # Special routing for Google News and RushFlights (requires TLS impersonation)
-            if any(domain in host for domain in ["news.google.com", "google.com", "rushflights.com"]):
-                content = await asyncio.to_thread(fetch_with_cffi, url)
+            if _needs_impersonation(host):
+                with metrics.timed("feed_fetch"):
+                    content = await fetch_with_cffi(url, session_pool)
             else:
                 # Standard fetch for friendly RSS feeds
-                r = await client.get(url, headers=build_headers(url))
+                headers = build_headers(url)
+                if feed_cache is not None:
+                    headers.update(conditional_headers(feed_cache, url))
+                started = time.monotonic()
+                try:
+                    with metrics.timed("feed_fetch"):
+                        r = await client.get(url, headers=headers)
+                except httpx.TransportError:
+                    _observe_error(url, started)
+                    raise
+                _observe_response(url, r.status_code, r.headers.get("Retry-After"), started)
                 if r.status_code == 200:
                     content = r.content
+                    response_headers = r.headers
+                elif r.status_code == 304 and feed_cache is not None:
+                    entries = cached_entries(feed_cache, url)
+                    if entries is None:
+                        log.warning(f"Got 304 for {url} but no cached copy exists.")
                 else:
                     log.warning(f"HTTPX fetch for {url} failed with status code: {r.status_code}")
 
-        if content:
-            feed = feedparser.parse(content)
-            for entry in feed.entries:
-                guid = entry.get("guid", entry.get("link"))
-                if entry.get("title") and entry.get("link") and guid:
-                    posts.append((entry.title, entry.link, guid, url))
-            log.info(f"Fetched {len(posts)} posts from RSS: {url}")
-            return posts[:config.MAX_PER_DOMAIN]
+        if entries is not None:
+            log.info(f"Feed not modified (304), using {len(entries)} cached entries: {url}")
+        elif content:
+            digest = None
+            if feed_cache is not None:
+                digest = body_hash(content)
+                entries = cached_entries(feed_cache, url, digest)
+            if entries is not None:
+                log.info(f"Feed body unchanged, using {len(entries)} cached entries: {url}")
+            else:
+                entries = await run_parser(parse_feed_entries, content)
+                posts, cursor = _collect_new_entries(entries, url, seen, get_cursor(feed_cache, url))
+                log.info(f"Fetched {len(posts)} new posts from RSS: {url}")
+                poll_scheduler.record_poll(url, [e["published"] for e in entries])
+                if feed_cache is not None:
+                    store_feed(feed_cache, url, response_headers, digest, entries, cursor)
+                return posts
+
+        if entries is not None:
+            # Unchanged feed: pick again from the cached entries (earlier picks are in sent_links by now).
+            posts, cursor = _collect_new_entries(entries, url, seen, get_cursor(feed_cache, url))
+            update_cursor(feed_cache, url, cursor)
+            poll_scheduler.record_poll(url, [])
+            return posts
 
     except Exception as e:
         log.warning(f"Error processing RSS feed {url}: {e}", exc_info=True)
         
     return posts
 
-async def scrape_description(client: httpx.AsyncClient, url: str) -> str | None:
-    """Scrapes a short description from a given URL, using impersonation for restricted domains."""
+async def _read_article(response: httpx.Response, url: str) -> bytes:
+    """
+    Reads an article body. With SCRAPE_STREAMING the body is read chunk by chunk through an
+    ArticleProbe and the download stops as soon as enough article text has been seen or
+    SCRAPE_MAX_BYTES have arrived; the (possibly truncated) HTML is returned for extraction.
+    """
+    if not config.SCRAPE_STREAMING:
+        return await response.aread()
+
+    probe = ArticleProbe()
+    try:
+        decoder = codecs.getincrementaldecoder(response.charset_encoding or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    chunks = []
+    received = 0
+    async for chunk in response.aiter_bytes():
+        chunks.append(chunk)
+        received += len(chunk)
+        probe.feed(decoder.decode(chunk))
+        if probe.done or received >= config.SCRAPE_MAX_BYTES:
+            if config.DEBUG_FEEDS:
+                reason = "enough article text" if probe.done else "byte cap"
+                log.info(f"DEBUG: Stopped reading {url} after {received} bytes ({reason}).")
+            break
+    return b"".join(chunks)
+
+async def scrape_description(client: httpx.AsyncClient, url: str, article_cache: Dict[str, any] | None = None, session_pool: ImpersonatedSessionPool | None = None) -> str | None:
+    """
+    Scrapes a short description from a given URL, using impersonation for restricted domains.
+    With an article_cache, a fresh cached extraction is returned without any network call.
+    """
+    if article_cache is not None:
+        cached = get_article(article_cache, url)
+        if cached is not None:
+            if config.DEBUG_FEEDS:
+                log.info(f"DEBUG: Using cached description for {url} (fetched {cached.get('fetched_at')}).")
+            return cached.get("text")
+
+    if not host_health.allow(url):
+        return None
     try:
         host = urlparse(url).netloc.lower()
         content = None
+        status = None
 
         async with _sem_for(url):
-            await _jitter() # Add jitter to scraping requests
+            if not await rate_limiter.acquire(url):
+                return None
             
-            # Use TLS impersonation for specific domains
-            if any(domain in host for domain in ["news.google.com", "google.com", "rushflights.com"]):
-                content = await asyncio.to_thread(fetch_with_cffi, url)
-            else:
-                r = await client.get(url, headers=build_headers(url))
-                if r.status_code == 200:
-                    content = r.content
+            with metrics.timed("scrape"):
+                # Use TLS impersonation for specific domains
+                if _needs_impersonation(host):
+                    content = await fetch_with_cffi(url, session_pool)
+                    status = 200 if content else None
                 else:
-                    if config.DEBUG_FEEDS:
-                        log.info(f"DEBUG: HTTPX fetch for description at {url} failed: {r.status_code}")
+                    started = time.monotonic()
+                    try:
+                        async with client.stream("GET", url, headers=build_headers(url)) as r:
+                            _observe_response(url, r.status_code, r.headers.get("Retry-After"), started)
+                            status = r.status_code
+                            if r.status_code == 200:
+                                content = await _read_article(r, url)
+                            else:
+                                if config.DEBUG_FEEDS:
+                                    log.info(f"DEBUG: HTTPX fetch for description at {url} failed: {r.status_code}")
+                    except httpx.TransportError:
+                        if status is None:
+                            _observe_error(url, started)
+                        raise
 
         if not content:
             return None
 
-        soup = BeautifulSoup(content, "html.parser")
-        
-        # --- PHASE 1: Targeted Extraction (Preferred) ---
-        # Zmienione selektory na kontenery, aby łapać też listy <li>, nagłówki itp.
-        selectors = ['article', '.entry-content', '.post-content', '.post-body', 'main', '#content', '.content']
-        extracted_text = ""
-        
-        for sel in selectors:
-            container = soup.select_one(sel)
-            if container:
-                # OPTYMALIZACJA: Usuwamy śmieci ZANIM pobierzemy tekst
-                for garbage in container.select('script, style, nav, footer, form, iframe, .share-buttons, .related-posts, .comments, .sidebar, .ads, header'):
-                    garbage.decompose()
-
-                text = container.get_text(separator=' ', strip=True)
-                if len(text) > 100: # Minimum sensownej treści
-                    extracted_text = text
-                    log.info(f"Scraped content using selector '{sel}': {len(text)} chars.")
-                    break
-        
-        # --- PHASE 2: Fallback "Vacuum" (If Phase 1 failed) ---
-        if len(extracted_text) < 100:
-            log.info(f"Targeted scraping failed for {url} (found {len(extracted_text)} chars). Initiating Fallback Vacuum...")
-            if soup.body:
-                # 1. Clean the entire body
-                for garbage in soup.body.select('script, style, nav, footer, form, iframe, header, aside, .sidebar, .menu, .ads, .cookie-banner, .popup, .comments'):
-                    garbage.decompose()
-                
-                # 2. Gather text from content-heavy tags
-                # Szukamy akapitów, nagłówków i elementów list
-                valuable_tags = soup.body.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li'])
-                vacuumed_text = " ".join([tag.get_text(strip=True) for tag in valuable_tags])
-                
-                if len(vacuumed_text) > 50:
-                    extracted_text = vacuumed_text
-                    log.info(f"Fallback Vacuum recovered {len(extracted_text)} chars from {url}.")
-                else:
-                    log.warning(f"Fallback Vacuum also failed for {url}.")
-
-        # --- Final Processing ---
-        if extracted_text:
-            limit = 2000 # Zwiększamy limit dla bezpieczeństwa AI
-            if len(extracted_text) > limit:
-                last_space = extracted_text.rfind(' ', 0, limit)
-                return extracted_text[:last_space] + '...' if last_space != -1 else extracted_text[:limit] + '...'
-            else:
-                return extracted_text
+        description = await run_parser(extract_description, content, url)
+        if article_cache is not None:
+            put_article(article_cache, url, description, status)
+        return description
                 
     except Exception as e:
         if config.DEBUG_FEEDS:
             log.info(f"DEBUG: Could not scrape description for {url}: {e}")
     return None
 
-async def process_all_sources() -> List[Dict[str, any]]:
+def _client_for_host(clients: ClientRegistry, host: str, activity: str) -> httpx.AsyncClient:
+    """Picks the proxied client for PROXY_REQUIRED_HOSTS and the direct client for everything else."""
+    use_proxy = any(proxy_host in host for proxy_host in config.PROXY_REQUIRED_HOSTS)
+    if use_proxy:
+        log.info(f"Routing {activity} for {host} via proxy.")
+    return clients.get(PROXIED if use_proxy else DIRECT)
+
+def filter_new_posts(posts: List[Tuple[str, str, str, str]], sent_links, run_keys: set):
     """
-    Fetches all RSS feeds, identifies new posts, and enriches them with descriptions.
-    Returns a list of detailed candidates for AI analysis.
-    This version uses conditional proxying: some domains go through a proxy, others go direct.
+    Yields (title, link, dedup_key, source_url) for posts neither sent before nor already seen in this run.
+    Keys are canonical URLs, so tracking variants of one deal (also across feeds) collapse
+    into the first copy; a post is also skipped when its canonical link was already sent.
     """
-    from gcs_state import load_state # Defer import to avoid circular dependency issues at startup
+    for title, link, guid, source_url in posts:
+        dedup_key, link_key = canonical_key(guid), canonical_url(link)
+        if dedup_key in sent_links or link_key in sent_links or dedup_key in run_keys or link_key in run_keys:
+            continue
+        run_keys.update((dedup_key, link_key))
+        yield title, link, dedup_key, source_url
 
-    state, _ = load_state()
+def _candidate(candidate_id: int, title: str, link: str, dedup_key: str, source_url: str, description: str | None) -> Dict[str, any]:
+    host = urlparse(link).netloc.lower().replace("www.", "")
+    return {
+        "id": candidate_id,
+        "title": title,
+        "link": link,
+        "dedup_key": dedup_key,
+        "source_url": source_url,
+        "description": description,
+        "host": host,
+        "source_name": host
+    }
+
+async def stream_candidates(out: asyncio.Queue, clients: ClientRegistry, state: Dict[str, any], budget: RunBudget):
+    """
+    Producer half of the run pipeline:
+        due feeds (fetched concurrently) -> scrape queue -> SCRAPE_CONCURRENCY scrapers -> `out`
+    A post enters the bounded scrape queue (PIPELINE_QUEUE_SIZE) as soon as its feed is parsed
+    and passes dedup, and becomes a candidate on `out` as soon as its description is scraped.
+    Feed fetches are bounded by FEED_FETCH_DEADLINE_SECONDS and scrapes by SCRAPE_DEADLINE_SECONDS
+    (both counted from the start and shortened by the run budget); posts not scraped in time
+    continue without a description. Puts None on `out` once every candidate has been emitted.
+    With a cassette active, feeds are still fetched concurrently but admitted in source order and
+    candidates reach `out` in admission order, so a replay makes up the same AI batches as the recording.
+    """
     rss_sources = get_sources('rss_sources.txt')
     if not rss_sources:
         log.warning("No sources found in rss_sources.txt. The file is empty or missing.")
-        return []
+        await out.put(None)
+        return
 
     log.info(f"Loaded {len(rss_sources)} RSS feed(s) to process.")
-    
-    all_posts = []
-    direct_client_config = {
-        "timeout": config.HTTP_TIMEOUT,
-        "follow_redirects": True,
-        "http2": True # Can be enabled for direct connections
-    }
+    warm_up()
 
-    # Create two clients: one with proxy, one without.
-    async with make_async_client() as proxied_client, httpx.AsyncClient(**direct_client_config) as direct_client:
-        
-        # --- 1. Fetch all RSS feeds ---
-        tasks = []
-        for url in rss_sources:
-            host = urlparse(url).netloc.lower()
-            use_proxy = any(proxy_host in host for proxy_host in config.PROXY_REQUIRED_HOSTS)
-            client_to_use = proxied_client if use_proxy else direct_client
-            if use_proxy:
-                log.info(f"Routing feed fetch for {host} via proxy.")
-            tasks.append(fetch_feed(client_to_use, url))
-        
-        results = await asyncio.gather(*tasks)
-        for post_list in results:
-            if post_list:
-                all_posts.extend(post_list)
-
-        log.info(f"Total posts collected from all RSS feeds: {len(all_posts)}")
-
-        # --- 2. Filter out already seen posts ---
-        seen_guids = set(state.get("sent_links", {}).keys())
-        new_posts = []
-        for title, link, guid, source_url in all_posts:
-            if guid not in seen_guids:
-                new_posts.append((title, link, guid, source_url))
-
-        if config.MAX_POSTS_PER_RUN > 0:
-            new_posts = new_posts[:config.MAX_POSTS_PER_RUN]
-
-        if not new_posts:
-            log.info("No new posts to process after checking against sent links database.")
-            return []
-            
-        log.info(f"Found {len(new_posts)} new candidates to process. Scraping descriptions...")
+    rate_limiter.load_rate_limits()
+    host_health.load_host_health()
+    poll_scheduler.load_schedule()
+    feed_cache = load_feed_cache()
+    article_cache = load_article_cache()
+    scrape_queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, config.PIPELINE_QUEUE_SIZE))
+    metrics.watch_queue("scrape", scrape_queue)
+    sent_links = state.get("sent_links", {})
+    run_keys = set()
+    counts = {"collected": 0, "admitted": 0, "scraped": 0}
+    ordered = cassette.active()
+    ready, emitted, emit_lock = {}, {"next": 0}, asyncio.Lock() # ordered mode: scraped candidates by admission number
+    started = time.monotonic()
+    feed_deadline = started + budget.timeout(config.FEED_FETCH_DEADLINE_SECONDS)
+    scrape_deadline = started + budget.timeout(config.SCRAPE_DEADLINE_SECONDS)
 
-        # --- 3. Enrich new posts with descriptions ---
-        detailed_candidates = []
-        for i, (title, link, dedup_key, source_url) in enumerate(new_posts):
-            host = urlparse(link).netloc.lower().replace("www.", "")
-            
-            # Decide which client to use for scraping the article link
-            use_proxy = any(proxy_host in host for proxy_host in config.PROXY_REQUIRED_HOSTS)
-            client_to_use = proxied_client if use_proxy else direct_client
-            if use_proxy:
-                log.info(f"Routing description scrape for {host} via proxy.")
-            description = await scrape_description(client_to_use, link)
-            
-            detailed_candidates.append({
-                "id": i,
-                "title": title,
-                "link": link,
-                "dedup_key": dedup_key,
-                "source_url": source_url,
-                "description": description,
-                "host": host,
-                "source_name": host
-            })
-            
-    return detailed_candidates
+    async def _fetch_one(source_index: int, url: str, previous: asyncio.Event | None, admitted: asyncio.Event):
+        try:
+            posts, fetch_started, fetch_ended = await _fetch(url)
+            if previous is not None:
+                await previous.wait()
+            if posts is not None:
+                await _admit(source_index, url, posts, fetch_started, fetch_ended)
+        finally:
+            admitted.set()
+
+    async def _fetch(url: str):
+        host = urlparse(url).netloc.lower()
+        client_to_use = _client_for_host(clients, host, "feed fetch")
+        fetch_started = time.time_ns()
+        try:
+            with tracing.span("feed_fetch", feed=url):
+                posts = await asyncio.wait_for(fetch_feed(client_to_use, url, feed_cache, sent_links, clients.impersonated),
+                                               timeout=max(0.0, feed_deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            # Not recorded by the poll scheduler, so the feed stays due for the next run.
+            log.warning(f"Feed fetch deadline reached before {url} finished. Skipping it this run.")
+            return None, fetch_started, None
+        return posts, fetch_started, time.time_ns()
+
+    async def _admit(source_index: int, url: str, posts, fetch_started: int, fetch_ended: int):
+        counts["collected"] += len(posts)
+        position = {post[1]: index for index, post in enumerate(posts)}
+        for title, link, dedup_key, source_url in filter_new_posts(posts, sent_links, run_keys):
+            if 0 < config.MAX_POSTS_PER_RUN <= counts["admitted"]:
+                return
+            # Ids follow the source list, then the feed's entry order (a feed gives at most
+            # MAX_PER_DOMAIN posts), so they do not depend on which fetch finishes first.
+            candidate_id = source_index * max(1, config.MAX_PER_DOMAIN) + position[link]
+            admission = counts["admitted"]
+            counts["admitted"] += 1
+            # The feed's fetch also belongs to each of its candidates' traces.
+            tracing.record("feed_fetch", fetch_started, fetch_ended, [dedup_key], feed=url)
+            await scrape_queue.put((admission, candidate_id, title, link, dedup_key, source_url, time.time_ns()))
+
+    async def _scraper():
+        while (post := await scrape_queue.get()) is not None:
+            admission, candidate_id, title, link, dedup_key, source_url, queued_at = post
+            tracing.record("scrape_wait", queued_at, time.time_ns(), [dedup_key])
+            description = None
+            remaining = scrape_deadline - time.monotonic()
+            if remaining > 0:
+                host = urlparse(link).netloc.lower().replace("www.", "")
+                # Decide which client to use for scraping the article link
+                client_to_use = _client_for_host(clients, host, "description scrape")
+                try:
+                    with tracing.span("scrape", key=dedup_key, host=host):
+                        description = await asyncio.wait_for(scrape_description(client_to_use, link, article_cache, clients.impersonated), timeout=remaining)
+                except asyncio.TimeoutError:
+                    log.warning(f"Scrape deadline reached for {link}; it continues without a description.")
+            if description:
+                counts["scraped"] += 1
+            candidate = _candidate(candidate_id, title, link, dedup_key, source_url, description)
+            if not ordered:
+                await out.put(candidate)
+                continue
+            ready[admission] = candidate
+            async with emit_lock:
+                while emitted["next"] in ready:
+                    await out.put(ready.pop(emitted["next"]))
+                    emitted["next"] += 1
+
+    workers = max(1, config.SCRAPE_CONCURRENCY)
+    try:
+        with budget.track("ingestion"):
+            due = poll_scheduler.due_feeds(rss_sources)
+            async with asyncio.TaskGroup() as scrapers:
+                for _ in range(workers):
+                    scrapers.create_task(_scraper())
+                with budget.track("feed fetch"):
+                    source_index = {url: index for index, url in enumerate(rss_sources)}
+                    admitted = [asyncio.Event() for _ in due]
+                    await asyncio.gather(*(_fetch_one(source_index[url], url, admitted[i - 1] if ordered and i else None, admitted[i])
+                                           for i, url in enumerate(due)))
+                for _ in range(workers):
+                    await scrape_queue.put(None)
+        log.info(f"Feed cache: {feed_cache['hits']} hit(s), {feed_cache['misses']} miss(es).")
+        log.info(f"Article cache: {article_cache['hits']} hit(s), {article_cache['misses']} miss(es).")
+        log.info(f"Collected {counts['collected']} posts from RSS feeds; {counts['admitted']} new candidate(s), "
+                 f"descriptions scraped for {counts['scraped']} in {time.monotonic() - started:.1f}s.")
+        await out.put(None)
+    finally:
+        for stage, amount in counts.items():
+            metrics.count(stage, amount)
+        metrics.count_cache("feed", feed_cache)
+        metrics.count_cache("article", article_cache)
+        save_feed_cache(feed_cache)
+        save_article_cache(article_cache)
+        rate_limiter.save_rate_limits()
+        host_health.save_host_health()
+        poll_scheduler.save_schedule(rss_sources)
+
+async def process_all_sources(clients: ClientRegistry | None = None, state: Dict[str, any] | None = None, budget: RunBudget | None = None) -> List[Dict[str, any]]:
+    """
+    Fetches all RSS feeds, identifies new posts, and enriches them with descriptions.
+    Returns a list of detailed candidates for AI analysis.
+    This version uses conditional proxying: some domains go through a proxy, others go direct.
+    Uses the run's ClientRegistry when given, otherwise opens its own for the call.
+    Checks against the caller's already loaded state when given, otherwise loads it.
+    Collects the whole stream_candidates() pipeline; the scheduler consumes it incrementally instead.
+    Candidates are returned in id order (source list order, then entry order).
+    """
+    if clients is None:
+        async with ClientRegistry() as own_clients:
+            return await process_all_sources(own_clients, state, budget)
+
+    if state is None:
+        from gcs_state import load_state # Defer import to avoid circular dependency issues at startup
+        state, _ = load_state()
+
+    queue: asyncio.Queue = asyncio.Queue()
+    await stream_candidates(queue, clients, state, budget or RunBudget())
+    candidates = []
+    while (candidate := queue.get_nowait()) is not None:
+        candidates.append(candidate)
+    candidates.sort(key=lambda c: c["id"])
+    return candidates
@@ -1,49 +1,166 @@
 # gcs_state.py
 import logging
 import json
+import hashlib
+import os
 import time
 import random
 import re
 import asyncio # New import for async operations
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Tuple
 from datetime import datetime, timezone, timedelta # New imports for time calculations
 from google.cloud import storage
 
 import config
-from utils import make_async_client # New import for httpx client
+import cassette
+import metrics
+import state_codec
+from state_codec import LazyQueue
+from utils import client_for, ClientRegistry, TELEGRAM
+from url_canon import canonical_key, CANONICAL_KEY_VERSION
+from seen_set import SeenSet, FORMAT as SEEN_SET_FORMAT
 
 log = logging.getLogger(__name__)
 
 # ---------- LAZY GCS CLIENT INITIALIZATION ----------
 _storage_client = None
+_bucket = None
 _blob = None
 
+def _get_gcs_bucket():
+    """Initializes and returns the GCS bucket object, creating it only on first use. None with a cassette active."""
+    global _storage_client, _bucket
+    if cassette.active():
+        return None
+    if _bucket is None and config.BUCKET_NAME:
+        log.info("Performing first-time initialization of GCS client.")
+        _storage_client = storage.Client()
+        _bucket = _storage_client.bucket(config.BUCKET_NAME)
+    return _bucket
+
+class _LocalBlob:
+    """File in LOCAL_STATE_DIR with the parts of the GCS blob API used here (generation = mtime in ns)."""
+    def __init__(self, filename: str):
+        self.path = os.path.join(config.LOCAL_STATE_DIR, filename)
+        self.generation = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def reload(self):
+        self.generation = os.stat(self.path).st_mtime_ns
+
+    def download_as_bytes(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def delete(self, if_generation_match: int | None = None):
+        if if_generation_match is not None and (not self.exists() or os.stat(self.path).st_mtime_ns != if_generation_match):
+            raise RuntimeError("412 PreconditionFailed: local state file changed since it was listed")
+        os.remove(self.path)
+
+    def upload_from_string(self, payload: bytes, if_generation_match: int | None = None, content_type: str | None = None):
+        # Like GCS, a generation of 0 means "only if the object does not exist yet".
+        current = os.stat(self.path).st_mtime_ns if self.exists() else 0
+        if if_generation_match is not None and current != if_generation_match:
+            raise RuntimeError("412 PreconditionFailed: local state file changed since it was loaded")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+        self.reload()
+
 def _get_gcs_blob():
-    """Initializes and returns the GCS blob object, creating it only on first use."""
-    global _storage_client, _blob
+    """
+    Initializes and returns the GCS blob object, creating it only on first use.
+    With a cassette active (offline runs) the state lives in LOCAL_STATE_DIR instead.
+    """
+    global _blob
+    if cassette.active():
+        return _LocalBlob(config.SENT_LINKS_FILE)
     if _blob is None:
-        if config.BUCKET_NAME and config.SENT_LINKS_FILE:
-            log.info("Performing first-time initialization of GCS client.")
-            _storage_client = storage.Client()
-            _bucket = _storage_client.bucket(config.BUCKET_NAME)
-            _blob = _bucket.blob(config.SENT_LINKS_FILE)
+        bucket = _get_gcs_bucket()
+        if bucket is not None and config.SENT_LINKS_FILE:
+            _blob = bucket.blob(config.SENT_LINKS_FILE)
         else:
             log.warning("GCS BUCKET_NAME or SENT_LINKS_FILE not configured. State will not be persisted.")
             return None
     return _blob
 
+# ---------- AUXILIARY DOCUMENTS (CACHES) ----------
+
+def load_aux_json(filename: str) -> Dict[str, Any]:
+    """
+    Loads an auxiliary JSON document (e.g. a cache) stored next to the state blob.
+    Falls back to LOCAL_STATE_DIR when GCS is not configured. Returns {} if missing or unreadable.
+    """
+    try:
+        bucket = _get_gcs_bucket()
+        if bucket is not None:
+            blob = bucket.blob(filename)
+            if not blob.exists():
+                return {}
+            return json.loads(blob.download_as_bytes())
+
+        path = os.path.join(config.LOCAL_STATE_DIR, filename)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        log.warning(f"Failed to load auxiliary document '{filename}', starting empty. Error: {e}")
+        return {}
+
+def save_aux_json(filename: str, data: Dict[str, Any]):
+    """
+    Saves an auxiliary JSON document next to the state blob (or to LOCAL_STATE_DIR).
+    These documents are best-effort caches, so last writer wins and errors are only logged.
+    """
+    try:
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    except Exception as e:
+        log.warning(f"Failed to save auxiliary document '{filename}'. Error: {e}")
+        return
+    save_aux_bytes(filename, payload, "application/json")
+
+def save_aux_bytes(filename: str, payload: bytes, content_type: str = "application/octet-stream") -> str | None:
+    """
+    Saves an auxiliary object (a document or an artifact such as a profile) next to the state blob,
+    or to LOCAL_STATE_DIR. `filename` may contain "/" for a prefix. Last writer wins.
+    Returns where it was written (gs:// URL or local path), or None if the write failed (logged).
+    """
+    try:
+        bucket = _get_gcs_bucket()
+        if bucket is not None:
+            bucket.blob(filename).upload_from_string(payload, content_type=content_type)
+            return f"gs://{bucket.name}/{filename}"
+
+        path = os.path.join(config.LOCAL_STATE_DIR, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        return path
+    except Exception as e:
+        log.warning(f"Failed to save auxiliary document '{filename}'. Error: {e}")
+        return None
+
 # ---------- STATE MANAGEMENT FUNCTIONS ----------
 
 def _default_state() -> Dict[str, Any]:
     """Returns the default structure for the application state."""
     return {
-        "sent_links": {},
+        "sent_links": SeenSet(), # persisted via SeenSet.to_json()
         "delete_queue": [],
         "last_ai_analysis_time": "1970-01-01T00:00:00Z",
         "morning_digest_queue": [],
         "evening_digest_queue": [],
         "sztos_slots_used_today": [], # To track which time slots have been used for Sztos Alert today
         "last_sztos_alert_date": "1970-01-01",
+        "url_key_version": 0, # see migrate_canonical_keys
+        "near_dup_index": {}, # see near_dup.py
     }
 
 def _ensure_state_shapes(state: Dict[str, Any]):
@@ -64,12 +181,44 @@ def _ensure_state_shapes(state: Dict[str, Any]):
     for key, default_value in _default_state().items():
         state.setdefault(key, default_value)
 
+    # One-off upgrades of older documents: canonical dedup keys (needs the plain dict), then the compact seen-set.
+    migrated = migrate_canonical_keys(state) is not None
+    if not isinstance(state["sent_links"], SeenSet):
+        state["sent_links"] = SeenSet.from_json(state["sent_links"])
+    if migrated:
+        state["sent_links"].upgraded = state["sent_links"].changed = True # the caller saves the migrated document (url_key_version is in the sent_links shard)
+
+def _encode_state(value: Any) -> Any:
+    """json.dumps hook for the non-JSON objects kept in the state."""
+    if isinstance(value, SeenSet):
+        return value.to_json()
+    if isinstance(value, LazyQueue):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Kept per item in a binary document and decoded on access (see state_codec.py).
+_LAZY_KEYS = ("morning_digest_queue", "evening_digest_queue")
 
-def load_state() -> Tuple[Dict[str, Any], int | None]:
+def _encode_document(document: Dict[str, Any]) -> Tuple[bytes, str]:
+    """A state document (or part of one) as stored: payload and content type, per STATE_ENCODING."""
+    return state_codec.encode(document, _encode_state, _LAZY_KEYS)
+
+
+def load_state() -> Tuple[Dict[str, Any], Any]:
     """
     Loads the state from GCS. Returns a default state if the blob doesn't exist or on error.
-    Also returns the blob's generation number for optimistic locking.
+    Also returns the blob's generation number for optimistic locking (with STATE_LAYOUT=sharded,
+    an opaque per-shard token instead; either way it is only passed back to save_state_atomic).
     """
+    if config.STATE_LAYOUT == "sharded":
+        return _load_sharded_state()
+    if config.STATE_LAYOUT == "journal":
+        state, token = _load_journal_state()
+        state["sent_links"].track_journal = True # only this layout persists the seen-set's changes
+        return state, token
+    return _load_single_state()
+
+def _load_single_state() -> Tuple[Dict[str, Any], int | None]:
     blob = _get_gcs_blob()
     if not blob:
         log.warning("GCS blob not available. Returning default state.")
@@ -80,41 +229,440 @@ def load_state() -> Tuple[Dict[str, Any], int | None]:
             log.info("State file not found in GCS. Returning default state.")
             return _default_state(), None
         
-        blob.reload()
-        state_data = json.loads(blob.download_as_bytes())
+        with metrics.timed("gcs_load"):
+            blob.reload()
+            raw = blob.download_as_bytes()
+        state_data = state_codec.decode(raw)
         _ensure_state_shapes(state_data)
+        metrics.observe_state(state_data, len(raw))
         return state_data, blob.generation
     except Exception as e:
         log.warning(f"Failed to load state from GCS, returning default state. Error: {e}")
         return _default_state(), None
 
-def save_state_atomic(state: Dict[str, Any], gen: int | None):
+def save_state_atomic(state: Dict[str, Any], gen: Any):
     """
     Saves the state to GCS using a generation match to prevent race conditions.
     Retries on precondition failure.
     """
+    if config.STATE_LAYOUT == "sharded":
+        return _save_sharded_state(state, gen)
+    if config.STATE_LAYOUT == "journal":
+        return _save_journal_state(state, gen)
     blob = _get_gcs_blob()
     if not blob:
         log.error("Cannot save state, GCS blob not configured.")
         return
 
-    payload = json.dumps(state).encode('utf-8')
+    payload, content_type = _encode_document(state)
     for _ in range(10): # Retry loop for optimistic locking
         try:
-            blob.upload_from_string(payload, if_generation_match=gen, content_type="application/json")
+            with metrics.timed("gcs_save"):
+                blob.upload_from_string(payload, if_generation_match=gen, content_type=content_type)
             log.info(f"State successfully saved to GCS blob: {config.SENT_LINKS_FILE}")
+            metrics.observe_state(state, len(payload))
             return
         except Exception as e:
             if "PreconditionFailed" in str(e) or "412" in str(e):
                 log.warning("State save conflict (412 Precondition Failed). Reloading state and retrying.")
+                metrics.STATE_SAVE_CONFLICTS.inc()
                 time.sleep(random.uniform(0.3, 0.8))
-                _, gen = load_state()
+                _, gen = _load_single_state()
                 continue
             log.error(f"An unexpected error occurred during state save: {e}", exc_info=True)
             raise
     
     raise RuntimeError("Atomic state save failed after multiple retries.")
 
+# ---------- SHARDED LAYOUT ----------
+# With STATE_LAYOUT=sharded the state is split into separately versioned objects
+# STATE_SHARD_PREFIX + "<shard>.json", each with its own generation-match lock, and a save
+# uploads only the shards that changed: a digest publish rewrites the digest shard, not the
+# whole dedup history. sent_links is skipped without serializing when its seen-set reports no
+# change; the other shards are compared by content hash with what was loaded.
+# The token returned by load_state is {"shards": {shard: {"generation", "sha256", "size"}}}
+# (the digest shard also keeps its queues' dedup keys as loaded, "keys") and is updated in place
+# by every save, so later saves in the same run do not conflict. A shard saved by another run
+# meanwhile is merged, not overwritten (see _upload_shard).
+# Without any shard yet, the single SENT_LINKS_FILE blob is loaded and the first save writes
+# every shard (the old blob is left in place for a rollback).
+# Shards and the snapshot below use STATE_ENCODING like the single blob (the .json names stay).
+
+_SHARDS = {
+    "sent_links": ("sent_links", "url_key_version"),
+    "digest": ("morning_digest_queue", "evening_digest_queue"),
+    "delete_queue": ("delete_queue",),
+    "near_dup": ("near_dup_index",),
+}
+
+def _shard_keys() -> Dict[str, Tuple[str, ...]]:
+    """Shard name -> state keys. Keys not assigned to a shard (small scalars, slots) go to "meta"."""
+    assigned = {key for keys in _SHARDS.values() for key in keys}
+    return {**_SHARDS, "meta": tuple(key for key in _default_state() if key not in assigned)}
+
+def _get_state_object(name: str):
+    """A state object next to the main blob (a _LocalBlob with a cassette active), or None without GCS."""
+    if cassette.active():
+        return _LocalBlob(name)
+    bucket = _get_gcs_bucket()
+    return bucket.blob(name) if bucket is not None else None
+
+def _get_shard_blob(shard: str):
+    return _get_state_object(f"{config.STATE_SHARD_PREFIX}{shard}.json")
+
+def _load_sharded_state() -> Tuple[Dict[str, Any], Dict[str, Any] | None]:
+    token = {"shards": {}}
+    state_data: Dict[str, Any] = {}
+    try:
+        for shard in _shard_keys():
+            blob = _get_shard_blob(shard)
+            if blob is None:
+                log.warning("GCS blob not available. Returning default state.")
+                return _default_state(), None
+            if not blob.exists():
+                continue
+            with metrics.timed("gcs_load"):
+                blob.reload()
+                raw = blob.download_as_bytes()
+            document = state_codec.decode(raw)
+            state_data.update(document)
+            token["shards"][shard] = {"generation": blob.generation, "sha256": hashlib.sha256(raw).hexdigest(), "size": len(raw)}
+            if shard == "digest":
+                token["shards"][shard]["keys"] = {name: _queue_keys(document.get(name, [])) for name in _SHARDS["digest"]}
+    except Exception as e:
+        log.warning(f"Failed to load state shards from GCS, returning default state. Error: {e}")
+        return _default_state(), None
+
+    if not token["shards"]:
+        # Not migrated yet: start from the single-blob state; the first save writes every shard.
+        state_data, _ = _load_single_state()
+        log.info("No state shards found yet. Starting from the single state blob (if any); the next save writes the sharded layout.")
+        return state_data, token
+
+    _ensure_state_shapes(state_data)
+    metrics.observe_state(state_data, sum(entry["size"] for entry in token["shards"].values()))
+    return state_data, token
+
+def _save_sharded_state(state: Dict[str, Any], token: Dict[str, Any] | None):
+    if token is None:
+        token = {"shards": {}}
+    shards = token["shards"]
+    written = []
+    for shard, keys in _shard_keys().items():
+        entry = shards.setdefault(shard, {"generation": 0, "sha256": None, "size": 0})
+        if shard == "sent_links" and entry["sha256"] and not getattr(state.get("sent_links"), "changed", True):
+            continue
+        payload, content_type = _encode_document({key: state[key] for key in keys if key in state})
+        digest = hashlib.sha256(payload).hexdigest()
+        if digest == entry["sha256"]:
+            continue
+        blob = _get_shard_blob(shard)
+        if blob is None:
+            log.error("Cannot save state, GCS blob not configured.")
+            return
+        payload = _upload_shard(blob, shard, keys, state, payload, content_type, entry)
+        entry.update(sha256=hashlib.sha256(payload).hexdigest(), size=len(payload))
+        if shard == "digest":
+            entry["keys"] = {name: _queue_keys(state.get(name, [])) for name in keys}
+        written.append(f"{shard} ({len(payload)} B)")
+        if shard == "sent_links":
+            state["sent_links"].changed = False
+
+    if written:
+        log.info(f"State shards saved to GCS: {', '.join(written)}.")
+        metrics.observe_state(state, sum(entry["size"] for entry in shards.values()))
+    else:
+        log.info("No state shard changed. Nothing to upload.")
+
+def _upload_shard(blob, shard: str, keys: Tuple[str, ...], state: Dict[str, Any], payload: bytes, content_type: str, entry: Dict[str, Any]) -> bytes:
+    """
+    Uploads one shard under its generation match. On a precondition failure (another run saved the
+    shard since it was loaded) the stored copy is merged into the state and the result uploaded again:
+    sent_links as a union, the digest queues by dedup_key (see _merge_digest). The other shards
+    have no merge and fail the save rather than overwrite the other run's copy.
+    Returns the payload that was written.
+    """
+    for _ in range(10):
+        try:
+            with metrics.timed("gcs_save"):
+                blob.upload_from_string(payload, if_generation_match=entry["generation"], content_type=content_type)
+            entry["generation"] = blob.generation
+            return payload
+        except Exception as e:
+            if "PreconditionFailed" in str(e) or "412" in str(e):
+                metrics.STATE_SAVE_CONFLICTS.inc()
+                if shard not in ("sent_links", "digest"):
+                    raise RuntimeError(f"State shard '{shard}' was saved by another run since it was loaded. Not overwriting it.") from e
+                log.warning(f"State shard '{shard}' save conflict (412 Precondition Failed). Merging the stored copy and retrying.")
+                time.sleep(random.uniform(0.3, 0.8))
+                if blob.exists():
+                    with metrics.timed("gcs_load"):
+                        blob.reload()
+                        stored = state_codec.decode(blob.download_as_bytes())
+                    if shard == "sent_links":
+                        state["sent_links"].merge(SeenSet.from_json(stored.get("sent_links", {})))
+                    else:
+                        _merge_digest(state, stored, entry)
+                    entry["generation"] = blob.generation
+                else:
+                    entry["generation"] = 0
+                payload, content_type = _encode_document({key: state[key] for key in keys if key in state})
+                continue
+            log.error(f"An unexpected error occurred during state shard save: {e}", exc_info=True)
+            raise
+    raise RuntimeError(f"Atomic save of state shard '{shard}' failed after multiple retries.")
+
+def _queue_keys(queue) -> list:
+    """Dedup keys of a digest queue, without decoding a LazyQueue."""
+    if isinstance(queue, LazyQueue):
+        return queue.dedup_keys()
+    return [offer.get('dedup_key') if isinstance(offer, dict) else None for offer in queue]
+
+def _merge_digest(state: Dict[str, Any], stored: Dict[str, Any], entry: Dict[str, Any]):
+    """
+    Three-way merge of the digest queues by dedup_key: the stored queue, minus the offers this run
+    removed (published) since loading, plus the ones it added. entry["keys"] holds the keys as loaded.
+    """
+    loaded_keys = entry.get("keys", {})
+    for name in _SHARDS["digest"]:
+        loaded = set(loaded_keys.get(name, []))
+        local = state.get(name, [])
+        local_keys = _queue_keys(local)
+        removed = loaded - set(local_keys)
+        remote = stored.get(name, [])
+        merged = [offer for offer, key in zip(remote, _queue_keys(remote)) if key not in removed]
+        present = set(_queue_keys(merged))
+        merged += [offer for offer, key in zip(local, local_keys) if key not in loaded and key not in present]
+        state[name] = merged
+    entry["keys"] = {name: _queue_keys(stored.get(name, [])) for name in _SHARDS["digest"]}
+
+# ---------- JOURNAL LAYOUT ----------
+# With STATE_LAYOUT=journal the state is a snapshot (STATE_JOURNAL_PREFIX + "snapshot.json",
+# the single-blob document plus "journal_seq" and "journal_folded") and append-only deltas ("delta-<seq>.json"),
+# one per save, holding only what changed since the state was loaded:
+#   {"seq": n, "at": iso, "sent_links": SeenSet.journal(), "ops": {state key: op}}
+# where op is {"set": value}, {"drop": n, "append": [...]} for lists (queues: items removed
+# from the head, new ones appended) or {"merge": {...}, "delete": [...]} for dicts.
+# load_state folds into the snapshot every delta it does not already hold: the snapshot lists
+# the deltas it folded in as journal_folded {seq: object generation}, so a delta written later
+# under a reused seq (a slot freed by compaction) or skipped over by the compacting run is still
+# applied. A delta is written with if_generation_match=0, so two writers never share a seq: the
+# loser takes the next one. Before appending, a run whose snapshot was replaced meanwhile moves
+# its seq above the new snapshot's journal_seq, so seqs are not reused in the first place.
+# Once there are STATE_JOURNAL_MAX_DELTAS deltas or STATE_JOURNAL_MAX_BYTES of them, the save
+# also writes a new snapshot (generation-matched) and deletes the deltas it folded (also
+# generation-matched, so a delta rewritten meanwhile survives).
+# Without a snapshot yet, the single SENT_LINKS_FILE blob is loaded and the first save writes
+# the snapshot. The token returned by load_state is updated in place by every save.
+# Deltas are always JSON. The diff baseline is a plain copy of the state, so this layout decodes
+# the digest queues on every load: their lazy decoding only pays off with the other layouts.
+
+def _journal_name(seq: int) -> str:
+    return f"{config.STATE_JOURNAL_PREFIX}delta-{seq:010d}.json"
+
+def _list_deltas() -> List[Tuple[int, Any]]:
+    """(seq, blob) of every delta object, oldest first, with the blob's generation set."""
+    prefix = f"{config.STATE_JOURNAL_PREFIX}delta-"
+    if cassette.active():
+        folder = os.path.dirname(prefix)
+        directory = os.path.join(config.LOCAL_STATE_DIR, folder)
+        files = os.listdir(directory) if os.path.isdir(directory) else []
+        named = [(name, _LocalBlob(os.path.join(folder, name))) for name in files if name.startswith("delta-") and name.endswith(".json")]
+        for _, blob in named:
+            blob.reload() # list_blobs() fills in the generation
+    else:
+        bucket = _get_gcs_bucket()
+        named = [(blob.name.rsplit("/", 1)[-1], blob) for blob in bucket.list_blobs(prefix=prefix)] if bucket is not None else []
+    deltas = []
+    for name, blob in named:
+        try:
+            deltas.append((int(name[len("delta-"):-len(".json")]), blob))
+        except ValueError:
+            log.warning(f"Ignoring unexpected object in the state journal: {name}")
+    return sorted(deltas, key=lambda item: item[0])
+
+def _plain_copy(state: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON round-tripped copy of everything but sent_links: the baseline the next delta is computed against."""
+    return json.loads(json.dumps({key: value for key, value in state.items() if key != "sent_links"}, default=_encode_state))
+
+def _diff(old: Any, new: Any) -> Dict[str, Any] | None:
+    if old == new:
+        return None
+    if isinstance(old, list) and isinstance(new, list):
+        for drop in range(len(old) + 1):
+            kept = len(old) - drop
+            if new[:kept] == old[drop:]:
+                return {"drop": drop, "append": new[kept:]}
+    if isinstance(old, dict) and isinstance(new, dict):
+        return {"merge": {k: v for k, v in new.items() if old.get(k, object()) != v}, "delete": [k for k in old if k not in new]}
+    return {"set": new}
+
+def _apply(state: Dict[str, Any], key: str, op: Dict[str, Any]):
+    if "set" in op:
+        state[key] = op["set"]
+    elif "drop" in op:
+        state[key] = list(state.get(key) or [])[op["drop"]:] + op["append"]
+    else:
+        target = state.setdefault(key, {})
+        target.update(op["merge"])
+        for k in op["delete"]:
+            target.pop(k, None)
+
+def _load_journal_state() -> Tuple[Dict[str, Any], Dict[str, Any] | None]:
+    snapshot = _get_state_object(f"{config.STATE_JOURNAL_PREFIX}snapshot.json")
+    if snapshot is None:
+        log.warning("GCS blob not available. Returning default state.")
+        return _default_state(), None
+    try:
+        if not snapshot.exists():
+            state_data, _ = _load_single_state()
+            log.info("No state snapshot found yet. Starting from the single state blob (if any); the next save writes the snapshot.")
+            return state_data, {"seq": 0, "snapshot_generation": 0, "deltas": 0, "delta_bytes": 0, "base": None, "folded": {}}
+
+        with metrics.timed("gcs_load"):
+            snapshot.reload()
+            raw = snapshot.download_as_bytes()
+        state_data = state_codec.decode(raw)
+        seq = state_data.pop("journal_seq", 0)
+        folded = state_data.pop("journal_folded", None)
+        token = {"seq": seq, "snapshot_generation": snapshot.generation, "deltas": 0, "delta_bytes": 0, "base": None, "folded": {}}
+        _ensure_state_shapes(state_data)
+
+        for delta_seq, blob in _list_deltas():
+            # Snapshots written before journal_folded existed folded every delta up to journal_seq.
+            if (delta_seq <= seq) if folded is None else (folded.get(str(delta_seq)) == blob.generation):
+                token["folded"][str(delta_seq)] = blob.generation # left over from a compaction: delete it at the next one
+                continue
+            with metrics.timed("gcs_load"):
+                delta_raw = blob.download_as_bytes()
+            delta = json.loads(delta_raw)
+            if delta.get("sent_links"):
+                state_data["sent_links"].apply_journal(delta["sent_links"])
+            for key, op in delta.get("ops", {}).items():
+                _apply(state_data, key, op)
+            token["seq"] = max(token["seq"], delta_seq)
+            token["folded"][str(delta_seq)] = blob.generation
+            token["deltas"] += 1
+            token["delta_bytes"] += len(delta_raw)
+    except Exception as e:
+        log.warning(f"Failed to load the state journal from GCS, returning default state. Error: {e}")
+        return _default_state(), None
+
+    _ensure_state_shapes(state_data)
+    token["base"] = _plain_copy(state_data)
+    if token["deltas"]:
+        log.info(f"Loaded state snapshot and folded {token['deltas']} delta(s) ({token['delta_bytes']} B) up to seq {token['seq']}.")
+    metrics.observe_state(state_data, len(raw) + token["delta_bytes"])
+    return state_data, token
+
+def _save_journal_state(state: Dict[str, Any], token: Dict[str, Any] | None):
+    if token is None or token["base"] is None:
+        # Nothing to diff against (first save of this layout, or the load failed): write a full snapshot.
+        token = token or {"seq": 0, "snapshot_generation": 0, "deltas": 0, "delta_bytes": 0, "base": None, "folded": {}}
+        _compact_journal(state, token)
+        return
+    if state["sent_links"].upgraded:
+        # load_state upgraded the document before taking the base, which a delta would miss: write a full
+        # snapshot. If another run compacted meanwhile, it loaded and upgraded the same document; append as usual.
+        if _compact_journal(state, token):
+            return
+        state["sent_links"].upgraded = False
+
+    current = _plain_copy(state)
+    ops = {key: op for key in current if (op := _diff(token["base"].get(key), current[key])) is not None}
+    seen_journal = state["sent_links"].journal()
+    if not ops and not seen_journal:
+        log.info("No state changes since the last save. Nothing to append to the journal.")
+        return
+
+    _raise_seq_floor(token)
+    for _ in range(10):
+        seq = token["seq"] + 1
+        delta = {"seq": seq, "at": datetime.now(timezone.utc).isoformat(), "sent_links": seen_journal, "ops": ops}
+        payload = json.dumps(delta).encode('utf-8')
+        blob = _get_state_object(_journal_name(seq))
+        if blob is None:
+            log.error("Cannot save state, GCS blob not configured.")
+            return
+        try:
+            with metrics.timed("gcs_save"):
+                blob.upload_from_string(payload, if_generation_match=0, content_type="application/json")
+            break
+        except Exception as e:
+            if "PreconditionFailed" in str(e) or "412" in str(e):
+                log.warning(f"State journal seq {seq} already written by another run. Retrying with the next one.")
+                metrics.STATE_SAVE_CONFLICTS.inc()
+                token["seq"] = seq
+                continue
+            log.error(f"An unexpected error occurred during state journal save: {e}", exc_info=True)
+            raise
+    else:
+        raise RuntimeError("Appending to the state journal failed after multiple retries.")
+
+    token["folded"][str(seq)] = blob.generation
+    token.update(seq=seq, base=current, deltas=token["deltas"] + 1, delta_bytes=token["delta_bytes"] + len(payload))
+    state["sent_links"].clear_journal()
+    log.info(f"State delta {seq} saved ({len(payload)} B: {len(ops)} key(s) changed).")
+    if token["deltas"] >= config.STATE_JOURNAL_MAX_DELTAS or token["delta_bytes"] >= config.STATE_JOURNAL_MAX_BYTES:
+        _compact_journal(state, token)
+
+def _raise_seq_floor(token: Dict[str, Any]):
+    """Moves the token's seq above the journal_seq of a snapshot written since the state was loaded."""
+    snapshot = _get_state_object(f"{config.STATE_JOURNAL_PREFIX}snapshot.json")
+    if snapshot is None or not snapshot.exists():
+        return
+    snapshot.reload()
+    if snapshot.generation == token["snapshot_generation"]:
+        return
+    with metrics.timed("gcs_load"):
+        floor = state_codec.decode(snapshot.download_as_bytes()).get("journal_seq", 0)
+    if floor > token["seq"]:
+        log.info(f"State snapshot was compacted up to seq {floor} since the state was loaded. Appending after it.")
+        token["seq"] = floor
+
+def _compact_journal(state: Dict[str, Any], token: Dict[str, Any]):
+    """
+    Writes the whole state as the new snapshot and deletes the deltas it folds in.
+    Returns False when another run wrote a snapshot since this state was loaded.
+    """
+    snapshot = _get_state_object(f"{config.STATE_JOURNAL_PREFIX}snapshot.json")
+    if snapshot is None:
+        log.error("Cannot save state, GCS blob not configured.")
+        return
+    document = {**state, "journal_seq": token["seq"], "journal_folded": token["folded"]}
+    payload, content_type = _encode_document(document)
+    try:
+        with metrics.timed("gcs_save"):
+            snapshot.upload_from_string(payload, if_generation_match=token["snapshot_generation"], content_type=content_type)
+    except Exception as e:
+        if "PreconditionFailed" in str(e) or "412" in str(e):
+            # Another run compacted in the meantime; its snapshot plus the deltas already cover this run.
+            log.warning("State snapshot changed since it was loaded. Leaving compaction to the next run.")
+            metrics.STATE_SAVE_CONFLICTS.inc()
+            if token["base"] is None:
+                raise
+            return False
+        log.error(f"An unexpected error occurred during state snapshot save: {e}", exc_info=True)
+        raise
+
+    state["sent_links"].clear_journal()
+    state["sent_links"].upgraded = False
+    deleted = 0
+    for delta_seq, blob in _list_deltas():
+        generation = token["folded"].get(str(delta_seq))
+        if generation is None or blob.generation != generation:
+            continue # not in this snapshot: written by another run meanwhile, it stays and is applied on load
+        try:
+            blob.delete(if_generation_match=generation)
+            del token["folded"][str(delta_seq)]
+            deleted += 1
+        except Exception as e:
+            log.warning(f"Could not delete folded state delta {delta_seq}. Error: {e}")
+    token.update(snapshot_generation=snapshot.generation, base=_plain_copy(state), deltas=0, delta_bytes=0)
+    log.info(f"State snapshot saved at seq {token['seq']} ({len(payload)} B); {deleted} folded delta(s) deleted.")
+    metrics.observe_state(state, len(payload))
+    return True
+
 def sanitizing_startup_check(state: Dict[str, Any]) -> int:
     """
     Checks and repairs the 'delete_queue' for corrupted chat_id entries.
@@ -155,6 +703,61 @@ def sanitizing_startup_check(state: Dict[str, Any]) -> int:
 
     return fixed_entries_count
 
+def _entry_timestamp(value: Any) -> str:
+    if isinstance(value, dict):
+        value = value.get('timestamp')
+    return value if isinstance(value, str) else ""
+
+def migrate_canonical_keys(state: Dict[str, Any]) -> int | None:
+    """
+    Rekeys sent_links and the digest queues' dedup keys to url_canon.canonical_key().
+    Links that collapse onto the same canonical key keep the newest timestamp, and queued
+    offers that become duplicates are dropped. Runs once per CANONICAL_KEY_VERSION.
+    Returns the number of changed entries, or None when the state is already migrated.
+    """
+    if state.get("url_key_version") == CANONICAL_KEY_VERSION:
+        return None
+
+    changed = 0
+    kept = "no legacy"
+    links = state.get("sent_links")
+    # A seen-set (persisted or loaded) only holds hashes, which cannot be rekeyed; it never held pre-canonical keys.
+    if isinstance(links, dict) and links.get("format") != SEEN_SET_FORMAT:
+        migrated_links = {}
+        for key, value in state["sent_links"].items():
+            new_key = canonical_key(key)
+            if new_key != key:
+                changed += 1
+            existing = migrated_links.get(new_key)
+            if existing is None or _entry_timestamp(value) > _entry_timestamp(existing):
+                migrated_links[new_key] = value
+        state["sent_links"] = migrated_links
+        kept = len(migrated_links)
+    elif links and (not isinstance(links, dict) or links.get("keys")):
+        log.warning(f"sent_links is a hashed seen-set and cannot be rekeyed to canonical key version {CANONICAL_KEY_VERSION}. "
+                    "Links sent before the change may be posted again once.")
+
+    for queue_name in ("morning_digest_queue", "evening_digest_queue"):
+        migrated_queue = []
+        queued_keys = set()
+        for offer in state.get(queue_name, []):
+            if isinstance(offer, dict) and offer.get('dedup_key'):
+                new_key = canonical_key(offer['dedup_key'])
+                if new_key != offer['dedup_key']:
+                    offer['dedup_key'] = new_key
+                    changed += 1
+                if new_key in queued_keys:
+                    changed += 1
+                    continue
+                queued_keys.add(new_key)
+            migrated_queue.append(offer)
+        state[queue_name] = migrated_queue
+
+    state["url_key_version"] = CANONICAL_KEY_VERSION
+    log.info(f"Migrated dedup keys to canonical URLs (version {CANONICAL_KEY_VERSION}): {changed} entries changed, "
+             f"{kept} sent links kept.")
+    return changed
+
 def remember_for_deletion(state: Dict[str, Any], chat_id: str, message_id: int, source_url: str):
     """
     Adds a message to the deletion queue in the state file.
@@ -173,9 +776,10 @@ def remember_for_deletion(state: Dict[str, Any], chat_id: str, message_id: int,
         "source_url": source_url
     })
 
-async def perform_delete_sweep(state: Dict[str, Any]) -> int:
+async def perform_delete_sweep(state: Dict[str, Any], clients: ClientRegistry | None = None) -> int:
     """
     Processes the deletion queue, removing old messages from Telegram.
+    Reuses the run's Telegram client when a ClientRegistry is passed.
     """
     if not state.get("delete_queue"):
         return 0
@@ -202,7 +806,7 @@ async def perform_delete_sweep(state: Dict[str, Any]) -> int:
     cleaned_from_queue_count = 0
     final_queue = keep_for_later.copy()
 
-    async with make_async_client() as client:
+    async with client_for(clients, TELEGRAM) as client:
         tasks = []
         for item in process_now:
             url = f"https://api.telegram.org/bot{config.TG_TOKEN}/deleteMessage"
@@ -254,37 +858,9 @@ def prune_sent_links(state: Dict[str, Any]) -> int:
         return 0
         
     prune_before = datetime.now(timezone.utc) - timedelta(hours=config.DEDUP_TTL_HOURS)
-    original_count = len(state["sent_links"])
-    
-    links_to_keep = {}
-    for key, value in state["sent_links"].items():
-        timestamp_str = None
-        
-        # Gracefully handle both old string format and new dictionary format
-        if isinstance(value, str):
-            timestamp_str = value
-        elif isinstance(value, dict) and 'timestamp' in value:
-            timestamp_str = value['timestamp']
-
-        # If we have a timestamp string, try to parse it
-        if timestamp_str and isinstance(timestamp_str, str):
-            try:
-                # Check if the link is NOT stale
-                if datetime.fromisoformat(timestamp_str.replace('Z', '+00:00')) >= prune_before:
-                    links_to_keep[key] = value
-                # If it is stale, we just don't add it to links_to_keep
-            except (ValueError, TypeError):
-                # If timestamp is malformed, treat as stale and do not keep
-                log.warning(f"Pruning malformed entry for key {key}. Value: {value}")
-                pass
-        else:
-            # If value is not a string or a valid dict, prune it
-            log.warning(f"Pruning entry with unexpected format for key {key}. Value: {value}")
-
-    pruned_count = original_count - len(links_to_keep)
+    pruned_count = state["sent_links"].prune(prune_before)
 
     if pruned_count > 0:
         log.info(f"Pruned {pruned_count} old links from state.")
-        state["sent_links"] = links_to_keep
         
-    return pruned_count
\ No newline at end of file
+    return pruned_count
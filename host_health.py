@@ -0,0 +1,118 @@
+# host_health.py
+import logging
+import time
+from typing import Dict, Any, List
+from urllib.parse import urlparse
+
+import config
+from gcs_state import load_aux_json, save_aux_json
+
+log = logging.getLogger(__name__)
+
+# Per-host circuit breaker:
+# - closed:    requests flow; CIRCUIT_FAILURE_THRESHOLD consecutive failures open the circuit.
+# - open:      requests are skipped instantly for CIRCUIT_OPEN_SECONDS.
+# - half_open: after the cool-down one probe request per run is let through;
+#              success closes the circuit, failure re-opens it.
+# Persisted in HOST_HEALTH_FILE:
+# {"hosts": {host: {"state": ..., "failures": n, "opened_at": epoch, "ok": n, "failed": n, "latency_ms": ewma}}}
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+_hosts: Dict[str, Dict[str, Any]] = {}
+_run: Dict[str, Dict[str, Any]] = {} # per-run scoreboard: {"ok": n, "failed": n, "skipped": n, "latencies": [ms]}
+_probing: set = set()
+_last_summary: List[Dict[str, Any]] = []
+
+def _host(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+def _entry(host: str) -> Dict[str, Any]:
+    if host not in _hosts:
+        _hosts[host] = {"state": CLOSED, "failures": 0, "opened_at": 0.0, "ok": 0, "failed": 0, "latency_ms": None}
+    return _hosts[host]
+
+def _scoreboard(host: str) -> Dict[str, Any]:
+    return _run.setdefault(host, {"ok": 0, "failed": 0, "skipped": 0, "latencies": []})
+
+def load_host_health():
+    """Loads persisted breaker states and resets the per-run scoreboard."""
+    global _hosts, _run, _probing
+    data = load_aux_json(config.HOST_HEALTH_FILE)
+    _hosts = data.get("hosts") if isinstance(data.get("hosts"), dict) else {}
+    _run = {}
+    _probing = set()
+
+def save_host_health():
+    """Persists breaker states and logs the run's per-host summary."""
+    global _last_summary
+    save_aux_json(config.HOST_HEALTH_FILE, {"hosts": _hosts})
+    _last_summary = run_summary()
+    for row in _last_summary:
+        log.info(f"Host health: {row['host']:<28} state={row['state']:<9} ok={row['ok']} failed={row['failed']} skipped={row['skipped']} "
+                 f"success={row['success_rate']} avg={row['avg_latency_ms']}ms")
+
+def allow(url: str) -> bool:
+    """Returns False when the host's circuit is open, so the caller skips the request instantly."""
+    host = _host(url)
+    entry = _entry(host)
+    if entry["state"] == CLOSED:
+        return True
+    if entry["state"] == OPEN and time.time() - entry["opened_at"] >= config.CIRCUIT_OPEN_SECONDS:
+        entry["state"] = HALF_OPEN
+    if entry["state"] == HALF_OPEN and host not in _probing:
+        _probing.add(host)
+        log.info(f"Circuit for {host} is half-open. Sending a probe request.")
+        return True
+    _scoreboard(host)["skipped"] += 1
+    if config.DEBUG_FEEDS:
+        log.info(f"DEBUG: Circuit for {host} is {entry['state']}. Skipping {url}.")
+    return False
+
+def _observe_latency(entry: Dict[str, Any], board: Dict[str, Any], latency_ms: float):
+    board["latencies"].append(latency_ms)
+    previous = entry.get("latency_ms")
+    entry["latency_ms"] = latency_ms if previous is None else round(0.8 * previous + 0.2 * latency_ms, 1)
+
+def record_success(url: str, latency_ms: float):
+    host = _host(url)
+    entry, board = _entry(host), _scoreboard(host)
+    if entry["state"] != CLOSED:
+        log.info(f"Circuit for {host} closed again after a successful request.")
+    entry.update(state=CLOSED, failures=0)
+    entry["ok"] += 1
+    board["ok"] += 1
+    _observe_latency(entry, board, latency_ms)
+
+def record_failure(url: str, latency_ms: float):
+    host = _host(url)
+    entry, board = _entry(host), _scoreboard(host)
+    entry["failures"] += 1
+    entry["failed"] += 1
+    board["failed"] += 1
+    _observe_latency(entry, board, latency_ms)
+    if entry["state"] == HALF_OPEN or entry["failures"] >= config.CIRCUIT_FAILURE_THRESHOLD:
+        if entry["state"] != OPEN:
+            log.warning(f"Circuit for {host} opened after {entry['failures']} consecutive failure(s). Skipping it for {config.CIRCUIT_OPEN_SECONDS}s.")
+        entry.update(state=OPEN, opened_at=time.time())
+
+def run_summary() -> List[Dict[str, Any]]:
+    """Per-host success rate and latency for the current run, worst hosts first."""
+    rows = []
+    for host, board in _run.items():
+        attempts = board["ok"] + board["failed"]
+        latencies = board["latencies"]
+        rows.append({
+            "host": host,
+            "state": _entry(host)["state"],
+            "ok": board["ok"],
+            "failed": board["failed"],
+            "skipped": board["skipped"],
+            "success_rate": round(board["ok"] / attempts, 2) if attempts else None,
+            "avg_latency_ms": round(sum(latencies) / len(latencies)) if latencies else None,
+        })
+    rows.sort(key=lambda r: (r["success_rate"] if r["success_rate"] is not None else -1, -(r["avg_latency_ms"] or 0)))
+    return rows
+
+def last_summary() -> List[Dict[str, Any]]:
+    """The summary logged by the most recent save_host_health()."""
+    return _last_summary
@@ -0,0 +1,82 @@
+# metrics.py
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Any
+
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+log = logging.getLogger(__name__)
+
+# Prometheus metrics served by app.py on /metrics.
+# Everything lives in the default in-process registry; gunicorn runs a single worker, so no
+# multiprocess mode is needed. Recording is a lock and a few additions per event; the text
+# exposition is only rendered when /metrics is scraped.
+
+# Buckets from a cache hit (~ms) to a slow Perplexity audit (~2 min).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_LATENCY = Histogram(
+    "travelbot_stage_latency_seconds",
+    "Latency of one external call per stage: feed_fetch, scrape, gemini, perplexity, telegram, gcs_load, gcs_save.",
+    ["stage"], buckets=LATENCY_BUCKETS)
+CANDIDATES = Counter(
+    "travelbot_candidates_total",
+    "Offers passing through each stage of the run pipeline.",
+    ["stage"])
+CACHE_LOOKUPS = Counter(
+    "travelbot_cache_lookups_total",
+    "Feed and article cache lookups by result (hit or miss).",
+    ["cache", "result"])
+STATE_SAVE_CONFLICTS = Counter(
+    "travelbot_state_save_conflicts_total",
+    "State saves rejected by the GCS generation precondition (412) and retried.")
+STATE_SIZE_BYTES = Gauge(
+    "travelbot_state_size_bytes",
+    "Size of the serialized state document at the last load or save.")
+STATE_ENTRIES = Gauge(
+    "travelbot_state_entries",
+    "Entries per state collection (sent_links, digest queues, delete_queue, near_dup_index).",
+    ["key"])
+QUEUE_LENGTH = Gauge(
+    "travelbot_queue_length",
+    "Items waiting in the run pipeline queues (scrape, candidates, audits).",
+    ["queue"])
+
+_STATE_COLLECTIONS = ("sent_links", "morning_digest_queue", "evening_digest_queue", "delete_queue", "near_dup_index")
+
+@contextmanager
+def timed(stage: str):
+    """Observes the duration of the block in the stage latency histogram, also when it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
+def count(stage: str, amount: int = 1):
+    if amount > 0:
+        CANDIDATES.labels(stage).inc(amount)
+
+def count_cache(cache: str, stats: Dict[str, Any]):
+    """Adds the hit/miss counters a cache collected during the run."""
+    CACHE_LOOKUPS.labels(cache, "hit").inc(stats.get("hits", 0))
+    CACHE_LOOKUPS.labels(cache, "miss").inc(stats.get("misses", 0))
+
+def observe_state(state: Dict[str, Any], size_bytes: int | None = None):
+    """Updates the state gauges after a load or save."""
+    if size_bytes is not None:
+        STATE_SIZE_BYTES.set(size_bytes)
+    for key in _STATE_COLLECTIONS:
+        try:
+            STATE_ENTRIES.labels(key).set(len(state.get(key) or ()))
+        except TypeError:
+            log.debug(f"State key '{key}' has no length; not exported.")
+
+def watch_queue(name: str, queue):
+    """Reports the queue's current length whenever /metrics is scraped (the last run's queue stays registered)."""
+    QUEUE_LENGTH.labels(name).set_function(queue.qsize)
+
+def exposition() -> tuple[bytes, str]:
+    """The /metrics response body and content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
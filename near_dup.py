@@ -0,0 +1,177 @@
+# near_dup.py
+import logging
+import re
+from hashlib import blake2b
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, List, Tuple
+
+import config
+
+log = logging.getLogger(__name__)
+
+# Near-duplicate detection across sources with 64-bit SimHash.
+# The index lives in state["near_dup_index"]:
+# {fingerprint_hex: {"key": dedup_key, "host": host, "at": iso}}
+# Lookups use LSH banding: the 64 bits are split into NEAR_DUP_MAX_DISTANCE + 1 bands, so by the
+# pigeonhole principle two fingerprints within the max distance share at least one whole band.
+# Only fingerprints in the same band buckets are compared bit by bit.
+
+FINGERPRINT_BITS = 64
+MIN_FEATURES = 8 # shorter texts give unstable fingerprints and are never collapsed
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def _hash64(feature: str) -> int:
+    # blake2b instead of hash(): fingerprints are persisted, so they must be stable across processes.
+    return int.from_bytes(blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+
+def _features(title: str, description: str | None) -> Dict[str, int]:
+    """Weighted features: title words count double, numbers (prices, dates) triple."""
+    weights: Dict[str, int] = {}
+    for text, weight in ((title or "", 2), (description or "", 1)):
+        tokens = [t for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1 or t.isdigit()]
+        for token in tokens:
+            weights[token] = weights.get(token, 0) + (weight * 3 if token.isdigit() else weight)
+        for first, second in zip(tokens, tokens[1:]):
+            bigram = f"{first} {second}"
+            weights[bigram] = weights.get(bigram, 0) + weight
+    return weights
+
+def fingerprint(title: str, description: str | None) -> int | None:
+    """64-bit SimHash of a candidate's title and description, or None when there is too little text."""
+    features = _features(title, description)
+    if len(features) < MIN_FEATURES:
+        return None
+    vector = [0] * FINGERPRINT_BITS
+    for feature, weight in features.items():
+        h = _hash64(feature)
+        for bit in range(FINGERPRINT_BITS):
+            vector[bit] += weight if h >> bit & 1 else -weight
+    return sum(1 << bit for bit, total in enumerate(vector) if total > 0)
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+class NearDupIndex:
+    """Band-bucketed view over the persisted fingerprint dict (mutated in place)."""
+
+    def __init__(self, entries: Dict[str, Dict[str, Any]], max_distance: int | None = None):
+        self.entries = entries
+        self.max_distance = config.NEAR_DUP_MAX_DISTANCE if max_distance is None else max_distance
+        bands = min(FINGERPRINT_BITS, max(1, self.max_distance + 1))
+        width = FINGERPRINT_BITS // bands
+        # (shift, mask) per band; the last band takes the leftover bits.
+        self._bands = [(i * width, (1 << (width if i < bands - 1 else FINGERPRINT_BITS - i * width)) - 1) for i in range(bands)]
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in self._bands]
+        for fp_hex in entries:
+            self._bucket(int(fp_hex, 16))
+
+    def _bucket(self, fp: int):
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            buckets.setdefault(fp >> shift & mask, []).append(fp)
+
+    def find(self, fp: int) -> Dict[str, Any] | None:
+        """Returns the indexed entry closest to fp within max_distance, if any."""
+        exact = self.entries.get(f"{fp:016x}")
+        if exact is not None:
+            return exact
+        best, best_distance = None, self.max_distance + 1
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            for other in buckets.get(fp >> shift & mask, ()):
+                d = distance(fp, other)
+                if d < best_distance:
+                    best, best_distance = other, d
+        return self.entries.get(f"{best:016x}") if best is not None else None
+
+    def add(self, fp: int, dedup_key: str, host: str, at: str):
+        fp_hex = f"{fp:016x}"
+        if fp_hex not in self.entries:
+            self._bucket(fp)
+        self.entries[fp_hex] = {"key": dedup_key, "host": host, "at": at}
+
+def prune_index(entries: Dict[str, Dict[str, Any]]) -> int:
+    """Drops fingerprints older than NEAR_DUP_TTL_HOURS. Returns the number removed."""
+    expire_before = datetime.now(timezone.utc) - timedelta(hours=config.NEAR_DUP_TTL_HOURS)
+    stale = []
+    for fp_hex, entry in entries.items():
+        try:
+            if datetime.fromisoformat(entry["at"]) < expire_before:
+                stale.append(fp_hex)
+        except (KeyError, TypeError, ValueError):
+            stale.append(fp_hex)
+    for fp_hex in stale:
+        del entries[fp_hex]
+    return len(stale)
+
+def _source_rank(candidate: Dict[str, Any]) -> Tuple[int, int]:
+    """Lower is better: position in NEAR_DUP_SOURCE_PRIORITY, then the longer description."""
+    host = candidate.get("host") or ""
+    rank = next((i for i, preferred in enumerate(config.NEAR_DUP_SOURCE_PRIORITY) if host == preferred or host.endswith("." + preferred)),
+                len(config.NEAR_DUP_SOURCE_PRIORITY))
+    return rank, -len(candidate.get("description") or "")
+
+class RunCollapser:
+    """
+    Collapses near-duplicates across all the candidates of one run, whichever batch they land in.
+    Candidates wait in the pending batch until take(); a near-duplicate of a pending candidate
+    replaces it when it comes from a better source (_source_rank), and is held back otherwise.
+    A candidate matching a fingerprint of an analyzed deal (committed in this or an earlier
+    run) is rejected at once. commit() indexes a taken batch once it has been analyzed and
+    returns the duplicates it held back; release() forgets a batch that was not analyzed.
+    """
+
+    def __init__(self, state: Dict[str, Any]):
+        entries = state.setdefault("near_dup_index", {})
+        self.pruned = prune_index(entries)
+        if self.pruned:
+            log.info(f"Near-duplicate index: expired {self.pruned} fingerprints.")
+        self.index = NearDupIndex(entries)
+        self.collapsed = 0
+        self._pending: List[Tuple[int | None, Dict[str, Any], List[Dict[str, Any]]]] = [] # (fingerprint, candidate, held-back duplicates)
+        self._taken: List[Tuple[int | None, Dict[str, Any], List[Dict[str, Any]]]] = []
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, candidate: Dict[str, Any]) -> bool:
+        """Adds a candidate to the pending batch. Returns False when it duplicates an analyzed deal."""
+        fp = fingerprint(candidate.get("title"), candidate.get("description")) if config.NEAR_DUP_ENABLED else None
+        if fp is not None:
+            match = self.index.find(fp)
+            if match is not None and match["key"] != candidate["dedup_key"]:
+                log.info(f"Near-duplicate: '{candidate.get('title', '')[:50]}' from {candidate.get('host')} matches {match['host']} ({match['key']}). Dropping it.")
+                self.collapsed += 1
+                return False
+            for i, (other_fp, other, duplicates) in enumerate(self._pending):
+                if other_fp is None or distance(fp, other_fp) > self.index.max_distance or other["dedup_key"] == candidate["dedup_key"]:
+                    continue
+                self.collapsed += 1
+                if _source_rank(candidate) < _source_rank(other):
+                    log.info(f"Near-duplicate: '{candidate.get('title', '')[:50]}' from {candidate.get('host')} replaces the copy from {other.get('host')}.")
+                    self._pending[i] = (fp, candidate, duplicates + [other])
+                else:
+                    log.info(f"Near-duplicate: '{candidate.get('title', '')[:50]}' from {candidate.get('host')} matches {other.get('host')} ({other['dedup_key']}). Dropping it.")
+                    duplicates.append(candidate)
+                return True
+        self._pending.append((fp, candidate, []))
+        return True
+
+    def take(self) -> List[Dict[str, Any]]:
+        """Moves the pending batch out for analysis, in arrival order."""
+        self._taken, self._pending = self._pending, []
+        return [candidate for _, candidate, _ in self._taken]
+
+    def commit(self) -> List[Dict[str, Any]]:
+        """Indexes the taken batch as analyzed. Returns the duplicates its candidates held back."""
+        now_iso = datetime.now(timezone.utc).isoformat()
+        duplicates = []
+        for fp, candidate, held_back in self._taken:
+            if fp is not None:
+                self.index.add(fp, candidate["dedup_key"], candidate.get("host"), now_iso)
+            duplicates.extend(held_back)
+        self._taken = []
+        return duplicates
+
+    def release(self):
+        """Forgets the taken batch without indexing it: it and its duplicates come back on a later run."""
+        self._taken = []
@@ -0,0 +1,106 @@
+# parse_pool.py
+import logging
+import logging.handlers
+import asyncio
+import atexit
+import multiprocessing
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+import config
+
+log = logging.getLogger(__name__)
+
+# ---------- LAZY EXECUTOR INITIALIZATION ----------
+_executor: Executor | None = None
+_warmed_up = False
+# Spawned workers start without the app's logging setup: their records come back over this
+# queue and are handled by the parent's logger of the same name.
+_log_listener: logging.handlers.QueueListener | None = None
+# One queue-depth semaphore per event loop (every /run gets a fresh loop from asyncio.run).
+_queue_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+class _ParentLogHandler(logging.Handler):
+    """Hands a worker's log record to the parent's logger of the same name."""
+    def emit(self, record: logging.LogRecord):
+        logging.getLogger(record.name).handle(record)
+
+def _init_worker(log_queue, level: int):
+    """Process pool initializer: sends the worker's log records to the parent."""
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+def _get_executor() -> Executor | None:
+    """Creates the parsing executor configured by PARSE_POOL on first use. Returns None when disabled."""
+    global _executor, _log_listener
+    if _executor is None and config.PARSE_POOL in ("process", "thread"):
+        workers = max(1, config.PARSE_POOL_WORKERS)
+        if config.PARSE_POOL == "process":
+            # spawn: the app runs gunicorn threads, and forking a threaded process is unsafe.
+            context = multiprocessing.get_context("spawn")
+            log_queue = context.Queue()
+            _log_listener = logging.handlers.QueueListener(log_queue, _ParentLogHandler())
+            _log_listener.start()
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                            initargs=(log_queue, logging.getLogger().getEffectiveLevel()))
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parse")
+        log.info(f"Started {config.PARSE_POOL} parsing pool with {workers} worker(s).")
+    return _executor
+
+def _slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _queue_slots:
+        _queue_slots[loop] = asyncio.Semaphore(max(1, config.PARSE_POOL_MAX_QUEUE))
+    return _queue_slots[loop]
+
+def _warm_worker() -> bool:
+    """Imports the parsing stack inside a worker so the first real job does not pay for it."""
+    import extractors # noqa: F401 (pulls in feedparser, bs4 and lxml)
+    return True
+
+def warm_up():
+    """Starts the pool and pre-imports the parsers in every worker. Safe to call on every run."""
+    global _warmed_up
+    executor = _get_executor()
+    if executor is None or _warmed_up:
+        return
+    _warmed_up = True
+    for _ in range(max(1, config.PARSE_POOL_WORKERS)):
+        executor.submit(_warm_worker)
+
+def shutdown():
+    global _executor, _warmed_up, _log_listener
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    if _log_listener is not None:
+        _log_listener.stop()
+    _executor = None
+    _warmed_up = False
+    _log_listener = None
+
+atexit.register(shutdown)
+
+# ---------- PUBLIC API ----------
+
+async def run_parser(fn: Callable[..., Any], *args) -> Any:
+    """
+    Runs a CPU-bound parsing function off the event loop.
+    At most PARSE_POOL_MAX_QUEUE jobs are queued at once; further callers wait for a slot.
+    Runs fn inline when the pool is disabled, and falls back to inline if the pool breaks.
+    `fn` and its arguments must be picklable for the process pool.
+    """
+    executor = _get_executor()
+    if executor is None:
+        return fn(*args)
+
+    async with _slots():
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            log.error("Parsing pool is broken. Restarting it and parsing inline for this job.")
+            shutdown()
+            return fn(*args)
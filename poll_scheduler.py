@@ -0,0 +1,77 @@
+# poll_scheduler.py
+import logging
+import time
+from statistics import median
+from typing import Dict, Any, List
+
+import config
+from gcs_state import load_aux_json, save_aux_json
+
+log = logging.getLogger(__name__)
+
+# Adaptive per-feed polling:
+# - after every successful poll the feed's publish cadence is learned from its entry timestamps
+#   (median gap between the most recent posts);
+# - the next poll is due FEED_POLL_FACTOR * that gap later, clamped to
+#   [FEED_POLL_MIN_SECONDS, FEED_POLL_MAX_SECONDS], so no feed goes unpolled longer than the max;
+# - failed or unknown feeds stay due, so they are retried on the next run.
+# Persisted in FEED_SCHEDULE_FILE:
+# {"feeds": {feed_url: {"published": [epoch, ...], "interval": seconds, "polled_at": epoch, "next_due": epoch}}}
+
+KEEP_TIMESTAMPS = 20
+
+_feeds: Dict[str, Dict[str, Any]] = {}
+
+def load_schedule():
+    """Loads the learned per-feed schedule for this run."""
+    global _feeds
+    data = load_aux_json(config.FEED_SCHEDULE_FILE)
+    _feeds = data.get("feeds") if isinstance(data.get("feeds"), dict) else {}
+
+def save_schedule(sources: List[str] | None = None):
+    """Persists the schedule, forgetting feeds no longer listed in `sources`."""
+    global _feeds
+    if sources is not None:
+        listed = set(sources)
+        _feeds = {url: entry for url, entry in _feeds.items() if url in listed}
+    save_aux_json(config.FEED_SCHEDULE_FILE, {"feeds": _feeds})
+
+def is_due(url: str, now: float | None = None) -> bool:
+    if not config.FEED_POLL_ADAPTIVE:
+        return True
+    entry = _feeds.get(url)
+    if not entry:
+        return True
+    now = time.time() if now is None else now
+    return entry.get("next_due", 0) <= now + config.FEED_POLL_GRACE_SECONDS
+
+def due_feeds(sources: List[str]) -> List[str]:
+    """Filters the source list down to feeds due for a poll in this run."""
+    now = time.time()
+    due = [url for url in sources if is_due(url, now)]
+    if len(due) < len(sources):
+        upcoming = sorted((_feeds[url]["next_due"] - now, url) for url in sources if url not in due)
+        log.info(f"Poll scheduler: {len(due)}/{len(sources)} feed(s) due this run. Next one up in {upcoming[0][0] / 60:.0f} min ({upcoming[0][1]}).")
+    return due
+
+def _interval(published: List[float]) -> float:
+    gaps = [a - b for a, b in zip(published, published[1:]) if a > b]
+    if not gaps:
+        return config.FEED_POLL_MIN_SECONDS
+    return min(config.FEED_POLL_MAX_SECONDS, max(config.FEED_POLL_MIN_SECONDS, median(gaps) * config.FEED_POLL_FACTOR))
+
+def record_poll(url: str, published: List[float | None]):
+    """
+    Records a successful poll. `published` are the entry timestamps from the feed, or an empty
+    list when the feed was unchanged (the cadence learned so far is kept).
+    """
+    entry = _feeds.setdefault(url, {"published": [], "interval": config.FEED_POLL_MIN_SECONDS})
+    if published:
+        merged = set(entry.get("published", [])) | {ts for ts in published if ts is not None}
+        entry["published"] = sorted(merged, reverse=True)[:KEEP_TIMESTAMPS]
+        entry["interval"] = round(_interval(entry["published"]))
+    now = time.time()
+    entry["polled_at"] = now
+    entry["next_due"] = now + entry["interval"]
+    if config.DEBUG_FEEDS:
+        log.info(f"DEBUG: Next poll of {url} in {entry['interval'] / 60:.0f} min.")
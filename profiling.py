@@ -0,0 +1,125 @@
+# profiling.py
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import marshal
+import pstats
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from statistics import median
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import config
+from gcs_state import save_aux_bytes
+
+log = logging.getLogger(__name__)
+
+# On-demand profiling of one run (POST /run?profile=1 with the X-Bot-Secret-Token header).
+# The run executes under cProfile (deterministic, this thread only: the event loop and every
+# coroutine on it, not parse-pool worker processes) and tracemalloc, while a sampler task
+# measures event-loop lag (how late a short sleep wakes up). Artifacts go next to the state
+# blob (or to LOCAL_STATE_DIR) under PROFILE_PREFIX/<run id>/:
+#   profile.pstats      raw cProfile data (python -m pstats, snakeviz, ...)
+#   profile.txt         top functions by cumulative and by own time
+#   allocations.txt     top allocation sites still alive at the end, and the peak
+#   loop_lag.json       lag samples [seconds since start, lag ms] and a summary
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 30
+
+async def _sample_loop_lag(samples: List[Tuple[float, float]], started: float):
+    interval = config.PROFILE_LOOP_LAG_INTERVAL
+    while True:
+        before = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = time.perf_counter() - before - interval
+        samples.append((round(before - started, 3), round(max(0.0, lag) * 1000, 2)))
+
+def _lag_summary(samples: List[Tuple[float, float]]) -> Dict[str, Any]:
+    lags = sorted(lag for _, lag in samples)
+    if not lags:
+        return {"samples": 0}
+    return {
+        "samples": len(lags),
+        "p50_ms": median(lags),
+        "p95_ms": lags[min(len(lags) - 1, int(len(lags) * 0.95))],
+        "max_ms": lags[-1],
+        "over_100ms": sum(1 for lag in lags if lag > 100),
+    }
+
+def _profile_text(profiler: cProfile.Profile) -> str:
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs()
+    out.write("=== By cumulative time ===\n")
+    stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+    out.write("\n=== By own time ===\n")
+    stats.sort_stats("tottime").print_stats(TOP_FUNCTIONS)
+    return out.getvalue()
+
+def _marshalled(profiler: cProfile.Profile) -> bytes:
+    """The profile in the format written by Profile.dump_stats(), without a temporary file."""
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
+
+def _allocations_text(snapshot: tracemalloc.Snapshot, peak: int) -> str:
+    lines = [f"Peak traced memory: {peak / 1024 / 1024:.1f} MiB", "", f"Top {TOP_ALLOCATIONS} allocation sites alive at the end of the run:"]
+    for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  {frame.filename}:{frame.lineno}")
+    return "\n".join(lines) + "\n"
+
+def run_profiled(fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Runs the coroutine function `fn` in a fresh event loop (like asyncio.run) under the profilers.
+    Returns its result and a summary with the artifact locations.
+    """
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lag_samples: List[Tuple[float, float]] = []
+    started = time.perf_counter()
+
+    async def _main():
+        sampler = asyncio.create_task(_sample_loop_lag(lag_samples, started))
+        try:
+            return await fn()
+        finally:
+            sampler.cancel()
+
+    profiler = cProfile.Profile()
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(config.PROFILE_TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    log.info(f"Profiling run {run_id}.")
+    profiler.enable()
+    try:
+        result = asyncio.run(_main())
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if not already_tracing:
+            tracemalloc.stop()
+        elapsed = time.perf_counter() - started
+
+        lag = _lag_summary(lag_samples)
+        prefix = f"{config.PROFILE_PREFIX}/{run_id}"
+        artifacts = [
+            save_aux_bytes(f"{prefix}/profile.pstats", _marshalled(profiler)),
+            save_aux_bytes(f"{prefix}/profile.txt", _profile_text(profiler).encode("utf-8"), "text/plain"),
+            save_aux_bytes(f"{prefix}/allocations.txt", _allocations_text(snapshot, peak).encode("utf-8"), "text/plain"),
+            save_aux_bytes(f"{prefix}/loop_lag.json", json.dumps({"interval_s": config.PROFILE_LOOP_LAG_INTERVAL, "summary": lag,
+                                                                  "samples": lag_samples}).encode("utf-8"), "application/json"),
+        ]
+        summary = {
+            "run_id": run_id,
+            "elapsed_s": round(elapsed, 1),
+            "peak_mib": round(peak / 1024 / 1024, 1),
+            "loop_lag": lag,
+            "artifacts": [a for a in artifacts if a],
+        }
+        log.info(f"Profiled run {run_id}: {summary}")
+    return result, summary
@@ -10,7 +10,10 @@ from telegraph import Telegraph
 from datetime import datetime # Keep datetime for strftime
 
 import config
-from utils import make_async_client
+import cassette
+import metrics
+import tracing
+from utils import client_for, ClientRegistry, TELEGRAM
 from gcs_state import load_state, save_state_atomic
 
 _TRAVEL_IMAGES = list(set([
@@ -74,9 +77,9 @@ def escape_markdown_legacy(text: str) -> str:
     return "".join(escaped_parts)
 
 
-async def send_photo_with_button_async(chat_id: str, photo_url: str, caption: str, button_text: str, button_url: str) -> int | None:
+async def send_photo_with_button_async(chat_id: str, photo_url: str, caption: str, button_text: str, button_url: str, clients: ClientRegistry | None = None) -> int | None:
     """Sends a photo with a caption and an inline button."""
-    async with make_async_client() as client:
+    async with client_for(clients, TELEGRAM) as client:
         try:
             # Tworzymy listę przycisków
             keyboard = [[{"text": button_text, "url": button_url}]]
@@ -92,7 +95,8 @@ async def send_photo_with_button_async(chat_id: str, photo_url: str, caption: st
             }
             url = f"https://api.telegram.org/bot{config.TG_TOKEN}/sendPhoto"
             
-            r = await client.post(url, json=payload, timeout=config.HTTP_TIMEOUT)
+            with metrics.timed("telegram"):
+                r = await client.post(url, json=payload, timeout=config.HTTP_TIMEOUT)
             r.raise_for_status()
             body = r.json()
 
@@ -105,9 +109,12 @@ async def send_photo_with_button_async(chat_id: str, photo_url: str, caption: st
             log.error(f"Telegram sendPhoto error to {chat_id} (URL: {photo_url}): {e}", exc_info=True)
     return None
 
-async def send_telegram_message_async(message_content: str, link: str, chat_id: str) -> int | None:
-    """Sends a standard offer message, with a fallback from Markdown to plain text."""
-    
+async def send_telegram_message_async(message_content: str, link: str, chat_id: str, clients: ClientRegistry | None = None, dedup_key: str | None = None) -> int | None:
+    """Sends a standard offer message, with a fallback from Markdown to plain text. Traced as the offer's 'telegram' span."""
+    with tracing.span("telegram", key=dedup_key, chat_id=chat_id):
+        return await _send_telegram_message(message_content, link, chat_id, clients)
+
+async def _send_telegram_message(message_content: str, link: str, chat_id: str, clients: ClientRegistry | None) -> int | None:
     # Escape content for Markdown, preserving **bold** as *bold*
     escaped_content = escape_markdown_legacy(message_content)
 
@@ -124,10 +131,11 @@ async def send_telegram_message_async(message_content: str, link: str, chat_id:
     
     url = f"https://api.telegram.org/bot{config.TG_TOKEN}/sendMessage"
     
-    async with make_async_client() as client:
+    async with client_for(clients, TELEGRAM) as client:
         try:
             # --- First Attempt: Send with Markdown ---
-            r = await client.post(url, json=payload, timeout=config.HTTP_TIMEOUT)
+            with metrics.timed("telegram"):
+                r = await client.post(url, json=payload, timeout=config.HTTP_TIMEOUT)
             
             # Check for "can't parse entities" specifically, which returns a 400
             if r.status_code == 400 and "can't parse entities" in r.text:
@@ -155,7 +163,8 @@ async def send_telegram_message_async(message_content: str, link: str, chat_id:
                 payload["text"] = message_content
                 payload.pop("parse_mode", None)
                 
-                r_fallback = await client.post(url, json=payload, timeout=config.HTTP_TIMEOUT)
+                with metrics.timed("telegram"):
+                    r_fallback = await client.post(url, json=payload, timeout=config.HTTP_TIMEOUT)
                 r_fallback.raise_for_status()
                 
                 body_fallback = r_fallback.json()
@@ -170,7 +179,7 @@ async def send_telegram_message_async(message_content: str, link: str, chat_id:
     return None
 
 
-async def publish_digest_async(state: Dict[str, Any] | None = None, generation: int | None = None, queue_name: str | None = None) -> str:
+async def publish_digest_async(state: Dict[str, Any] | None = None, generation: int | None = None, queue_name: str | None = None, clients: ClientRegistry | None = None) -> str:
     """
     Generates and publishes the digest of top offers to Telegraph and posts a link to Telegram.
     Processes a specific queue ('morning_digest_queue' or 'evening_digest_queue').
@@ -259,10 +268,11 @@ async def publish_digest_async(state: Dict[str, Any] | None = None, generation:
         else:
             digest_title = f"Popołudniowy Przegląd Ofert ({current_time.strftime('%d-%m-%Y')})"
 
-        response = telegraph.create_page(
-            title=digest_title,
-            html_content=content_html,
-            author_name="Travel Bot",
+        response = await cassette.recorded_call(
+            "telegraph",
+            {"title": digest_title, "html_content": content_html},
+            lambda: telegraph.create_page(title=digest_title, html_content=content_html, author_name="Travel Bot"),
+            strict=False, # the title carries the date
         )
         page_url = response['url']
         log.info(f"Successfully created Telegra.ph page for '{queue_name}': {page_url}")
@@ -278,7 +288,8 @@ async def publish_digest_async(state: Dict[str, Any] | None = None, generation:
                 photo_url=selected_photo_url,
                 caption=engaging_caption,
                 button_text=digest_button_text,
-                button_url=page_url
+                button_url=page_url,
+                clients=clients
             )
 
         state[queue_name] = []
@@ -0,0 +1,112 @@
+# rate_limiter.py
+import logging
+import asyncio
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any
+from urllib.parse import urlparse
+
+import config
+from gcs_state import load_aux_json, save_aux_json
+
+log = logging.getLogger(__name__)
+
+# Adaptive per-host token buckets (AIMD):
+# - every successful response adds RATE_LIMIT_STEP_RPS to the host's rate, up to RATE_LIMIT_MAX_RPS;
+# - 429/503 halve the rate and block the host for Retry-After (or an exponential backoff);
+# - network errors and timeouts cut the rate by a quarter.
+# Learned rates and blocks persist across runs in RATE_LIMITS_FILE:
+# {"hosts": {host: {"rate": rps, "blocked_until": epoch, "strikes": n, "updated_at": epoch}}}
+
+_hosts: Dict[str, Dict[str, Any]] = {}
+_buckets: Dict[str, Dict[str, float]] = {} # runtime only: {"tokens": float, "refilled_at": monotonic}
+
+STALE_AFTER_SECONDS = 7 * 24 * 3600
+
+def _host(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+def _entry(host: str) -> Dict[str, Any]:
+    if host not in _hosts:
+        _hosts[host] = {"rate": config.RATE_LIMIT_INITIAL_RPS, "blocked_until": 0.0, "strikes": 0, "updated_at": time.time()}
+    return _hosts[host]
+
+def load_rate_limits():
+    """Loads the learned per-host rates for this run, forgetting hosts not seen for a week."""
+    global _hosts, _buckets
+    data = load_aux_json(config.RATE_LIMITS_FILE)
+    hosts = data.get("hosts") if isinstance(data.get("hosts"), dict) else {}
+    now = time.time()
+    _hosts = {h: e for h, e in hosts.items() if isinstance(e, dict) and now - e.get("updated_at", 0) < STALE_AFTER_SECONDS}
+    _buckets = {}
+
+def save_rate_limits():
+    """Persists the learned per-host rates."""
+    save_aux_json(config.RATE_LIMITS_FILE, {"hosts": _hosts})
+    slow = {h: round(e["rate"], 2) for h, e in _hosts.items() if e["rate"] < config.RATE_LIMIT_INITIAL_RPS}
+    if slow:
+        log.info(f"Rate limiter: hosts below the initial rate: {slow}")
+
+async def acquire(url: str) -> bool:
+    """
+    Waits until the host has a free token. Returns False (without waiting) when the host
+    is blocked by a Retry-After for longer than RATE_LIMIT_MAX_WAIT_SECONDS, so the caller skips it.
+    """
+    host = _host(url)
+    entry = _entry(host)
+
+    blocked_for = entry["blocked_until"] - time.time()
+    if blocked_for > config.RATE_LIMIT_MAX_WAIT_SECONDS:
+        log.info(f"Rate limiter: {host} is backing off for another {blocked_for:.0f}s. Skipping {url}.")
+        return False
+    if blocked_for > 0:
+        await asyncio.sleep(blocked_for)
+
+    bucket = _buckets.setdefault(host, {"tokens": float(config.RATE_LIMIT_BURST), "refilled_at": time.monotonic()})
+    while True:
+        now = time.monotonic()
+        rate = max(entry["rate"], config.RATE_LIMIT_MIN_RPS)
+        bucket["tokens"] = min(float(config.RATE_LIMIT_BURST), bucket["tokens"] + (now - bucket["refilled_at"]) * rate)
+        bucket["refilled_at"] = now
+        if bucket["tokens"] >= 1.0:
+            bucket["tokens"] -= 1.0
+            return True
+        await asyncio.sleep((1.0 - bucket["tokens"]) / rate)
+
+def _retry_after_seconds(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def record_response(url: str, status: int, retry_after: str | None = None):
+    """Feeds a response status (and its Retry-After header) back into the host's rate."""
+    entry = _entry(_host(url))
+    entry["updated_at"] = time.time()
+    if status in (429, 503):
+        entry["strikes"] += 1
+        entry["rate"] = max(config.RATE_LIMIT_MIN_RPS, entry["rate"] / 2)
+        wait = _retry_after_seconds(retry_after)
+        if wait is None:
+            wait = 2 ** min(entry["strikes"], 8)
+        wait = min(wait, config.RATE_LIMIT_MAX_BACKOFF_SECONDS)
+        entry["blocked_until"] = time.time() + wait
+        log.warning(f"Rate limiter: {_host(url)} answered {status}. Backing off {wait:.0f}s, rate now {entry['rate']:.2f} req/s.")
+    elif status < 500:
+        entry["strikes"] = 0
+        entry["rate"] = min(config.RATE_LIMIT_MAX_RPS, entry["rate"] + config.RATE_LIMIT_STEP_RPS)
+    else:
+        entry["rate"] = max(config.RATE_LIMIT_MIN_RPS, entry["rate"] * 0.75)
+
+def record_error(url: str):
+    """Network errors and timeouts slow the host down without blocking it."""
+    entry = _entry(_host(url))
+    entry["updated_at"] = time.time()
+    entry["rate"] = max(config.RATE_LIMIT_MIN_RPS, entry["rate"] * 0.75)
@@ -0,0 +1,70 @@
+# run_budget.py
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, List
+
+import config
+
+log = logging.getLogger(__name__)
+
+class RunBudget:
+    """
+    Wall-clock budget for one /run, shared by all stages.
+    RUN_BUDGET_RESERVE_SECONDS are never handed out, so the final state save always has time
+    even when a stage overruns. Stages ask `allows()` before each unit of work (a Gemini chunk,
+    a Perplexity batch, ...) and defer the rest to the next run when it returns False;
+    open-ended stages bound themselves with `timeout()`.
+    """
+
+    def __init__(self, total_seconds: float | None = None, reserve_seconds: float | None = None):
+        self.started = time.monotonic()
+        self.total = config.RUN_BUDGET_SECONDS if total_seconds is None else total_seconds
+        self.reserve = config.RUN_BUDGET_RESERVE_SECONDS if reserve_seconds is None else reserve_seconds
+        self._durations: Dict[str, List[float]] = {}
+        self.shed: Dict[str, int] = {}
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        """Seconds left for work, excluding the reserve."""
+        return max(0.0, self.total - self.reserve - self.elapsed())
+
+    def timeout(self, cap: float | None = None) -> float:
+        """A stage timeout: the stage's own cap, shortened to what is left of the budget."""
+        return self.remaining() if cap is None else min(cap, self.remaining())
+
+    def typical(self, stage: str) -> float:
+        """Longest duration of a unit of this stage seen so far in the run (0 before the first one)."""
+        return max(self._durations.get(stage, [0.0]))
+
+    def allows(self, stage: str, estimate: float | None = None, units: int = 1) -> bool:
+        """
+        True when the next unit of `stage` fits in the remaining budget. The estimate defaults
+        to the stage's slowest unit so far. `units` is the amount of work deferred on False.
+        """
+        needed = self.typical(stage) if estimate is None else estimate
+        if self.remaining() > needed:
+            return True
+        if stage not in self.shed:
+            log.warning(f"Run budget: {self.remaining():.0f}s left (need ~{needed:.0f}s). Deferring '{stage}' to the next run.")
+        self.shed[stage] = self.shed.get(stage, 0) + units
+        return False
+
+    @contextmanager
+    def track(self, stage: str):
+        """Records how long one unit of a stage took, for later `allows()` estimates."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._durations.setdefault(stage, []).append(time.monotonic() - started)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "elapsed_s": round(self.elapsed(), 1),
+            "budget_s": self.total,
+            "stages_s": {stage: round(sum(d), 1) for stage, d in self._durations.items()},
+            "deferred": dict(self.shed),
+        }
@@ -0,0 +1,170 @@
+# seen_set.py
+import base64
+import logging
+import sys
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from datetime import datetime, timezone
+from typing import Any, Dict, Set
+
+log = logging.getLogger(__name__)
+
+# Compact replacement for the sent_links dict (dedup key -> ISO timestamp).
+# Every key is stored as a 64-bit hash in a sorted array('Q'), with a parallel array('I') of
+# "hours since the epoch" for TTL pruning: 12 bytes per link instead of a URL plus a timestamp.
+# Keys added during a run go to a small overlay dict and are merged on compact().
+# With 64-bit hashes a false "seen" needs a collision: ~n / 2**64, about 1e-14 for 100k links.
+#
+# Persisted form inside the state JSON (little-endian arrays, base64-encoded):
+# {"format": "seen64-v1", "keys": "...", "hours": "..."}
+# With track_journal set (by the journal state layout, the only one that needs it), changes
+# since loading are also kept as a journal (hashes added with their hour, hashes pruned),
+# so that layout can persist just those: see journal()/apply_journal().
+
+FORMAT = "seen64-v1"
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+def _hour(value: Any) -> int:
+    """Hours since the epoch for an ISO timestamp (or a legacy {"timestamp": ...} entry); now if unparsable."""
+    if isinstance(value, dict):
+        value = value.get("timestamp")
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+    except (AttributeError, TypeError, ValueError):
+        moment = datetime.now(timezone.utc)
+    return int(moment.timestamp() // 3600)
+
+def _pack(values: array) -> str:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+def _unpack(typecode: str, data: str) -> array:
+    values = array(typecode)
+    values.frombytes(base64.b64decode(data))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+class SeenSet:
+    """Set of already-processed dedup keys with a timestamp per key. Supports `in`, item assignment and len()."""
+
+    def __init__(self):
+        self._keys = array("Q")
+        self._hours = array("I")
+        self._overlay: Dict[int, int] = {}
+        self.upgraded = False # True when load_state upgraded the document (legacy dict, key migration), so the caller knows to save
+        self.changed = False # True after an assignment or a pruning removal; the sharded state layout clears it on save
+        self.track_journal = False # record added/removed hashes for journal()
+        self._added: Dict[int, int] = {}
+        self._removed: Set[int] = set()
+
+    @classmethod
+    def from_json(cls, value: Any) -> "SeenSet":
+        """Loads the persisted form, or converts a legacy {key: timestamp} dict."""
+        seen = cls()
+        if isinstance(value, dict) and value.get("format") == FORMAT:
+            seen._keys = _unpack("Q", value.get("keys", ""))
+            seen._hours = _unpack("I", value.get("hours", ""))
+            if len(seen._keys) != len(seen._hours):
+                log.warning("Seen-set arrays have different lengths. Starting with an empty seen-set.")
+                return cls()
+        elif isinstance(value, dict):
+            for key, timestamp in value.items():
+                seen[key] = timestamp
+            seen.compact()
+            seen.clear_journal()
+            seen.upgraded = seen.changed = True
+            log.info(f"Converted {len(value)} sent links to the compact seen-set.")
+        return seen
+
+    def to_json(self) -> Dict[str, str]:
+        self.compact()
+        return {"format": FORMAT, "keys": _pack(self._keys), "hours": _pack(self._hours)}
+
+    def _find(self, h: int) -> int:
+        i = bisect_left(self._keys, h)
+        return i if i < len(self._keys) and self._keys[i] == h else -1
+
+    def __contains__(self, key: str) -> bool:
+        h = hash_key(key)
+        return h in self._overlay or self._find(h) != -1
+
+    def __setitem__(self, key: str, timestamp: Any):
+        h, hour = hash_key(key), _hour(timestamp)
+        self._overlay[h] = hour
+        if self.track_journal:
+            self._added[h] = hour
+            self._removed.discard(h)
+        self.changed = True
+
+    def __len__(self) -> int:
+        return len(self._keys) + sum(1 for h in self._overlay if self._find(h) == -1)
+
+    def compact(self):
+        """Merges the overlay into the sorted arrays (newer timestamps win)."""
+        if not self._overlay:
+            return
+        merged = dict(zip(self._keys, self._hours))
+        for h, hour in self._overlay.items():
+            merged[h] = max(hour, merged.get(h, 0))
+        self._keys = array("Q", sorted(merged))
+        self._hours = array("I", (merged[h] for h in self._keys))
+        self._overlay = {}
+
+    def prune(self, before: datetime) -> int:
+        """Drops keys last seen before `before`. Returns the number removed."""
+        self.compact()
+        cutoff = int(before.timestamp() // 3600)
+        keep = [i for i, hour in enumerate(self._hours) if hour >= cutoff]
+        removed = len(self._keys) - len(keep)
+        if removed:
+            if self.track_journal:
+                for h, hour in zip(self._keys, self._hours):
+                    if hour < cutoff:
+                        self._added.pop(h, None)
+                        self._removed.add(h)
+            self._keys = array("Q", (self._keys[i] for i in keep))
+            self._hours = array("I", (self._hours[i] for i in keep))
+            self.changed = True
+        return removed
+
+    def merge(self, other: "SeenSet"):
+        """Adds every key of `other` (newer timestamps win), e.g. a copy saved by another run meanwhile."""
+        other.compact()
+        for h, hour in zip(other._keys, other._hours):
+            self._overlay[h] = max(hour, self._overlay.get(h, 0))
+        self.compact()
+        self.changed = True
+
+    def journal(self) -> Dict[str, str] | None:
+        """Hashes added (with their hours) and removed since loading or the last clear_journal(); None if there are none."""
+        if not self._added and not self._removed:
+            return None
+        added = sorted(self._added)
+        return {
+            "added": _pack(array("Q", added)),
+            "hours": _pack(array("I", (self._added[h] for h in added))),
+            "removed": _pack(array("Q", sorted(self._removed))),
+        }
+
+    def clear_journal(self):
+        self._added = {}
+        self._removed = set()
+
+    def apply_journal(self, journal: Dict[str, str]):
+        """Replays a journal() from another run (without recording it in this set's own journal)."""
+        for h, hour in zip(_unpack("Q", journal.get("added", "")), _unpack("I", journal.get("hours", ""))):
+            self._overlay[h] = max(hour, self._overlay.get(h, 0))
+        removed = set(_unpack("Q", journal.get("removed", "")))
+        if removed:
+            self.compact()
+            keep = [i for i, h in enumerate(self._keys) if h not in removed]
+            self._keys = array("Q", (self._keys[i] for i in keep))
+            self._hours = array("I", (self._hours[i] for i in keep))
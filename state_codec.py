@@ -0,0 +1,178 @@
+# state_codec.py
+import gzip
+import json
+import logging
+from collections.abc import MutableSequence
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+import config
+
+try:
+    import msgpack
+except ImportError: # optional, the binary encoding falls back to a JSON body
+    msgpack = None
+try:
+    import zstandard
+except ImportError: # optional, the binary encoding falls back to gzip
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+# Encoding of the state documents (the single blob, the shards, the journal snapshot).
+# STATE_ENCODING=json writes plain JSON, as before. STATE_ENCODING=binary writes
+#   b"TBST" | version (1 byte) | serializer (b"m" msgpack, b"j" JSON) | compression (b"z" zstd, b"g" gzip, b"n" none) | body
+# using msgpack and zstd when installed, JSON and gzip otherwise. Reading detects the format
+# from the header, so old JSON documents (no header) keep loading under either setting.
+#
+# In a binary document the lazy keys (the digest queues, whose offers carry the description,
+# internal_log and telegram_message) hold each offer serialized on its own:
+#   {"format": "lazy-queue-v1", "keys": [dedup_key, ...], "items": [packed offer, ...]}
+# and load as a LazyQueue that decodes an offer only when it is read. Routing an offer into the
+# queue needs only the dedup keys, so a run that does not publish a digest never decodes them,
+# and saving it again reuses the packed bytes of the offers it did not read.
+
+MAGIC = b"TBST"
+VERSION = 1
+LAZY_FORMAT = "lazy-queue-v1"
+
+_PACKED = object() # placeholder for an item that has not been decoded yet
+
+def _json_dumps(value: Any, default: Callable | None = None) -> str:
+    return json.dumps(value, default=default, ensure_ascii=False, separators=(',', ':'))
+
+if msgpack is not None:
+    def _msgpack_dumps(value: Any, default: Callable | None = None) -> bytes:
+        return msgpack.packb(value, default=default, use_bin_type=True)
+
+    def _msgpack_loads(raw: bytes) -> Any:
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+# Serializer tag -> (dumps, loads). Inside a JSON body a packed offer is the JSON text (str), in msgpack it is bytes.
+_SERIALIZERS: Dict[bytes, Tuple[Callable, Callable]] = {b"j": (_json_dumps, json.loads)}
+if msgpack is not None:
+    _SERIALIZERS[b"m"] = (_msgpack_dumps, _msgpack_loads)
+
+def _compress(tag: bytes, body: bytes) -> bytes:
+    if tag == b"z":
+        return zstandard.ZstdCompressor(level=10).compress(body)
+    if tag == b"g":
+        return gzip.compress(body, mtime=0) # mtime=0: equal documents give equal bytes (shard hashes)
+    return body
+
+def _decompress(tag: bytes, data: bytes) -> bytes:
+    if tag == b"z":
+        if zstandard is None:
+            raise RuntimeError("State document is zstd-compressed but the zstandard package is not installed.")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=1 << 30)
+    if tag == b"g":
+        return gzip.decompress(data)
+    if tag == b"n":
+        return data
+    raise ValueError(f"Unknown state compression {tag!r}.")
+
+class LazyQueue(MutableSequence):
+    """
+    A digest queue loaded from a binary document: a list of offers decoded on first access.
+    dedup_keys() answers from the stored keys without decoding anything.
+    Not a list subclass on purpose: json's C encoder would read the packed items directly.
+    """
+
+    def __init__(self, keys: Iterable[str | None], packed: Iterable[Any], serializer: bytes):
+        self._packed = list(packed)
+        self._keys = list(keys)
+        self._items = [_PACKED] * len(self._packed)
+        self._serializer = serializer
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = self._items[index]
+        if item is _PACKED:
+            item = self._items[index] = _SERIALIZERS[self._serializer][1](self._packed[index])
+        return item
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            items = list(self)
+            items[index] = value
+            self._packed, self._keys, self._items = [None] * len(items), [None] * len(items), items
+            return
+        self._items[index] = value
+
+    def __delitem__(self, index):
+        del self._items[index]
+        del self._packed[index]
+        del self._keys[index]
+
+    def insert(self, index: int, value: Any):
+        self._items.insert(index, value)
+        self._packed.insert(index, None)
+        self._keys.insert(index, None)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, (list, LazyQueue)) and list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        decoded = sum(1 for item in self._items if item is not _PACKED)
+        return f"LazyQueue({len(self)} items, {decoded} decoded)"
+
+    def dedup_keys(self) -> list:
+        """The offers' dedup keys; decoded offers are read, as they may have been changed."""
+        return [key if item is _PACKED else (item.get('dedup_key') if isinstance(item, dict) else None)
+                for key, item in zip(self._keys, self._items)]
+
+    def packed(self, serializer: bytes) -> Tuple[list, list]:
+        """(keys, packed items) for a binary document; undecoded items are reused as they were loaded."""
+        dumps = _SERIALIZERS[serializer][0]
+        reuse = serializer == self._serializer
+        items = [packed if reuse and item is _PACKED else dumps(self[i]) for i, (item, packed) in enumerate(zip(self._items, self._packed))]
+        return self.dedup_keys(), items
+
+def _pack_queue(value: Any, serializer: bytes) -> Any:
+    if isinstance(value, LazyQueue):
+        keys, items = value.packed(serializer)
+    elif isinstance(value, list):
+        dumps = _SERIALIZERS[serializer][0]
+        keys = [item.get('dedup_key') if isinstance(item, dict) else None for item in value]
+        items = [dumps(item) for item in value]
+    else:
+        return value
+    return {"format": LAZY_FORMAT, "keys": keys, "items": items}
+
+def encode(document: Dict[str, Any], default: Callable, lazy_keys: Iterable[str] = ()) -> Tuple[bytes, str]:
+    """
+    Serializes a state document per STATE_ENCODING; `default` converts the non-JSON objects
+    kept in the state (as for json.dumps). Returns the payload and its content type.
+    """
+    if config.STATE_ENCODING != "binary":
+        return json.dumps(document, default=default).encode('utf-8'), "application/json"
+
+    serializer = b"m" if msgpack is not None else b"j"
+    compression = b"z" if zstandard is not None else b"g"
+    lazy_keys = set(lazy_keys)
+    document = {key: _pack_queue(value, serializer) if key in lazy_keys else value for key, value in document.items()}
+    body = _SERIALIZERS[serializer][0](document, default)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return MAGIC + bytes([VERSION]) + serializer + compression + _compress(compression, body), "application/octet-stream"
+
+def decode(raw: bytes) -> Dict[str, Any]:
+    """Reads a state document in either encoding; packed queues come back as LazyQueue."""
+    if not raw.startswith(MAGIC):
+        return json.loads(raw)
+
+    version, serializer, compression = raw[4], raw[5:6], raw[6:7]
+    if version > VERSION:
+        raise ValueError(f"State document has encoding version {version}, newer than this code ({VERSION}).")
+    if serializer not in _SERIALIZERS:
+        raise RuntimeError(f"State document uses serializer {serializer!r}, which is not available (is msgpack installed?).")
+    document = _SERIALIZERS[serializer][1](_decompress(compression, raw[7:]))
+    for key, value in document.items():
+        if isinstance(value, dict) and value.get("format") == LAZY_FORMAT:
+            document[key] = LazyQueue(value["keys"], value["items"], serializer)
+    return document
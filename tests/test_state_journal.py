@@ -0,0 +1,172 @@
+# tests/test_state_journal.py
+"""
+State layouts against an in-memory bucket: the journal's compaction racing with delta writes,
+seen-set change tracking, and the sharded/journal layouts falling back to the single blob.
+"""
+from datetime import datetime, timezone
+
+import pytest
+
+import config
+import gcs_state
+from url_canon import CANONICAL_KEY_VERSION
+
+
+class FakeBlob:
+    """The parts of google.cloud.storage.Blob used by gcs_state, backed by FakeBucket.objects."""
+
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def exists(self) -> bool:
+        return self.name in self.bucket.objects
+
+    def reload(self):
+        if not self.exists():
+            raise Exception(f"404 NotFound: {self.name}")
+        self.generation = self.bucket.objects[self.name][1]
+
+    def download_as_bytes(self) -> bytes:
+        if not self.exists():
+            raise Exception(f"404 NotFound: {self.name}")
+        return self.bucket.objects[self.name][0]
+
+    def upload_from_string(self, payload: bytes, if_generation_match: int | None = None, content_type: str | None = None):
+        current = self.bucket.objects[self.name][1] if self.exists() else 0
+        if if_generation_match is not None and current != if_generation_match:
+            raise Exception(f"412 PreconditionFailed: {self.name} is at generation {current}")
+        self.bucket.next_generation += 1
+        self.bucket.objects[self.name] = (payload, self.bucket.next_generation)
+        self.generation = self.bucket.next_generation
+
+    def delete(self, if_generation_match: int | None = None):
+        if not self.exists():
+            raise Exception(f"404 NotFound: {self.name}")
+        if if_generation_match is not None and self.bucket.objects[self.name][1] != if_generation_match:
+            raise Exception(f"412 PreconditionFailed: {self.name} changed")
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {} # name -> (payload, generation)
+        self.next_generation = 1000
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix: str = ""):
+        blobs = [self.blob(name) for name in sorted(self.objects) if name.startswith(prefix)]
+        for blob in blobs:
+            blob.reload()
+        return blobs
+
+    def deltas(self):
+        return sorted(name for name in self.objects if name.startswith(f"{config.STATE_JOURNAL_PREFIX}delta-"))
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    fake = FakeBucket()
+    monkeypatch.setattr(config, "CASSETTE_MODE", "off")
+    monkeypatch.setattr(config, "STATE_ENCODING", "json")
+    monkeypatch.setattr(config, "STATE_JOURNAL_MAX_DELTAS", 50)
+    monkeypatch.setattr(config, "STATE_JOURNAL_MAX_BYTES", 1_000_000)
+    monkeypatch.setattr(gcs_state, "_bucket", fake)
+    monkeypatch.setattr(gcs_state, "_blob", None)
+    return fake
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _seed_journal(monkeypatch):
+    """An empty, already migrated journal layout: just a snapshot."""
+    monkeypatch.setattr(config, "STATE_LAYOUT", "journal")
+    state = gcs_state._default_state()
+    state["url_key_version"] = CANONICAL_KEY_VERSION # otherwise every load migrates and saves a full snapshot
+    gcs_state.save_state_atomic(state, None)
+
+
+def test_delta_written_before_a_compaction_survives_it(bucket, monkeypatch):
+    _seed_journal(monkeypatch)
+    state_a, token_a = gcs_state.load_state()
+    state_b, token_b = gcs_state.load_state()
+
+    # B appends delta-1 while A is still running.
+    state_b["sent_links"]["https://b.example/deal"] = _now()
+    gcs_state.save_state_atomic(state_b, token_b)
+
+    # A appends after it (seq 1 is taken) and compacts: its snapshot does not hold B's delta.
+    monkeypatch.setattr(config, "STATE_JOURNAL_MAX_DELTAS", 1)
+    state_a["sent_links"]["https://a.example/deal"] = _now()
+    gcs_state.save_state_atomic(state_a, token_a)
+
+    assert bucket.deltas() == [gcs_state._journal_name(1)] # A only deleted the delta it folded
+    state, _ = gcs_state.load_state()
+    assert "https://a.example/deal" in state["sent_links"]
+    assert "https://b.example/deal" in state["sent_links"]
+
+
+def test_delta_appended_after_a_compaction_is_applied(bucket, monkeypatch):
+    _seed_journal(monkeypatch)
+    state_a, token_a = gcs_state.load_state()
+    state_b, token_b = gcs_state.load_state()
+
+    monkeypatch.setattr(config, "STATE_JOURNAL_MAX_DELTAS", 1)
+    state_a["sent_links"]["https://a.example/deal"] = _now()
+    gcs_state.save_state_atomic(state_a, token_a) # delta-1, folded into the snapshot and deleted
+    assert bucket.deltas() == []
+
+    monkeypatch.setattr(config, "STATE_JOURNAL_MAX_DELTAS", 50)
+    state_b["sent_links"]["https://b.example/deal"] = _now()
+    state_b["morning_digest_queue"].append({"dedup_key": "https://b.example/deal", "title": "B"})
+    gcs_state.save_state_atomic(state_b, token_b)
+
+    assert bucket.deltas() == [gcs_state._journal_name(2)] # appended after the snapshot's seq
+    state, _ = gcs_state.load_state()
+    assert "https://a.example/deal" in state["sent_links"]
+    assert "https://b.example/deal" in state["sent_links"]
+    assert [offer["title"] for offer in state["morning_digest_queue"]] == ["B"]
+
+
+def test_seen_set_changes_are_tracked_only_for_the_journal_layout(bucket, monkeypatch):
+    _seed_journal(monkeypatch)
+    state, token = gcs_state.load_state()
+    assert state["sent_links"].track_journal
+    state["sent_links"]["https://a.example/deal"] = _now()
+    assert state["sent_links"].journal() is not None
+    gcs_state.save_state_atomic(state, token)
+    assert state["sent_links"].journal() is None # cleared once written as a delta
+    assert "https://a.example/deal" in gcs_state.load_state()[0]["sent_links"]
+
+    for layout in ("single", "sharded"):
+        monkeypatch.setattr(config, "STATE_LAYOUT", layout)
+        state, _ = gcs_state.load_state()
+        state["sent_links"][f"https://{layout}.example/deal"] = _now()
+        assert not state["sent_links"].track_journal
+        assert state["sent_links"].journal() is None
+
+
+@pytest.mark.parametrize("layout", ["sharded", "journal"])
+def test_layout_falls_back_to_the_single_blob(bucket, monkeypatch, layout):
+    monkeypatch.setattr(config, "STATE_LAYOUT", "single")
+    state = gcs_state._default_state()
+    state["sent_links"]["https://old.example/deal"] = _now()
+    gcs_state.save_state_atomic(state, None)
+
+    monkeypatch.setattr(config, "STATE_LAYOUT", layout)
+    state, token = gcs_state.load_state()
+    assert "https://old.example/deal" in state["sent_links"]
+    state["sent_links"]["https://new.example/deal"] = _now()
+    gcs_state.save_state_atomic(state, token) # first save writes the new layout in full
+
+    prefix = config.STATE_SHARD_PREFIX if layout == "sharded" else config.STATE_JOURNAL_PREFIX
+    assert any(name.startswith(prefix) for name in bucket.objects)
+    assert config.SENT_LINKS_FILE in bucket.objects # left in place for a rollback
+    state, _ = gcs_state.load_state()
+    assert "https://old.example/deal" in state["sent_links"]
+    assert "https://new.example/deal" in state["sent_links"]
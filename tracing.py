@@ -0,0 +1,176 @@
+# tracing.py
+import contextvars
+import json
+import logging
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable, List
+
+import httpx
+
+import config
+
+log = logging.getLogger(__name__)
+
+# Lightweight per-run tracing, for finding where a given offer spent its time.
+# master_scheduler opens a trace per run; stages record spans keyed by the candidate's
+# dedup_key (a batch stage records one span per candidate in the batch, with the same times).
+# The current trace and parent span live in contextvars, so they follow the pipeline's tasks.
+# Without an open trace (TRACE_EXPORT=off, or a stage called on its own) span() does nothing.
+#
+# TRACE_EXPORT=jsonl appends one span per line to TRACE_FILE:
+# {"trace_id", "span_id", "parent_id", "name", "key", "start_ns", "end_ns", "attrs"}
+# TRACE_EXPORT=otlp posts the run as OTLP/HTTP JSON to TRACE_OTLP_ENDPOINT (a local collector).
+#
+# Waterfall of the last run in the file:  python tracing.py [traces.jsonl] [trace_id]
+
+_trace: contextvars.ContextVar[Dict[str, Any] | None] = contextvars.ContextVar("trace", default=None)
+_parent: contextvars.ContextVar[str | None] = contextvars.ContextVar("trace_parent", default=None)
+
+def enabled() -> bool:
+    return config.TRACE_EXPORT in ("jsonl", "otlp")
+
+def start_run(name: str = "run") -> Dict[str, Any] | None:
+    """Opens the trace of a run in the current context. Returns None when tracing is off."""
+    if not enabled():
+        return None
+    root_id = secrets.token_hex(8)
+    trace = {"trace_id": secrets.token_hex(16), "root_id": root_id, "name": name, "start_ns": time.time_ns(), "spans": []}
+    _trace.set(trace)
+    _parent.set(root_id)
+    return trace
+
+def _add(trace: Dict[str, Any], name: str, start_ns: int, end_ns: int, key: str | None, parent_id: str | None, attrs: Dict[str, Any],
+         span_id: str | None = None) -> str:
+    span_id = span_id or secrets.token_hex(8)
+    trace["spans"].append({"trace_id": trace["trace_id"], "span_id": span_id, "parent_id": parent_id, "name": name,
+                           "key": key, "start_ns": start_ns, "end_ns": end_ns, "attrs": attrs})
+    return span_id
+
+@contextmanager
+def span(name: str, key: str | None = None, keys: Iterable[str] | None = None, **attrs):
+    """
+    Records the block as a span named `name`: for one candidate (`key`), for every candidate of
+    a batch (`keys`), or for the run itself (neither). Spans opened inside become its children.
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = secrets.token_hex(8)
+    token = _parent.set(span_id)
+    start_ns = time.time_ns()
+    try:
+        yield
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        end_ns = time.time_ns()
+        _parent.reset(token)
+        parent_id = _parent.get()
+        keys = list(keys or [])
+        if not keys:
+            _add(trace, name, start_ns, end_ns, key, parent_id, attrs, span_id)
+        for batch_key in keys:
+            _add(trace, name, start_ns, end_ns, batch_key, parent_id, {**attrs, "batch_size": len(keys)})
+
+def record(name: str, start_ns: int, end_ns: int, keys: Iterable[str], **attrs):
+    """Records an already finished interval for candidates known only afterwards (e.g. the posts of a fetched feed)."""
+    trace = _trace.get()
+    if trace is None:
+        return
+    for key in keys:
+        _add(trace, name, start_ns, end_ns, key, _parent.get(), dict(attrs))
+
+# ---------- EXPORT ----------
+
+def _root(trace: Dict[str, Any]) -> Dict[str, Any]:
+    return {"trace_id": trace["trace_id"], "span_id": trace["root_id"], "parent_id": None, "name": trace["name"],
+            "key": None, "start_ns": trace["start_ns"], "end_ns": trace["end_ns"], "attrs": trace.get("attrs", {})}
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_payload(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    otlp_spans = []
+    for s in spans:
+        attributes = {**s["attrs"], **({"dedup_key": s["key"]} if s["key"] else {})}
+        otlp_spans.append({
+            "traceId": s["trace_id"],
+            "spanId": s["span_id"],
+            **({"parentSpanId": s["parent_id"]} if s["parent_id"] else {}),
+            "name": s["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(s["start_ns"]),
+            "endTimeUnixNano": str(s["end_ns"]),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()],
+            **({"status": {"code": 2, "message": s["attrs"]["error"]}} if "error" in s["attrs"] else {}),
+        })
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "travel-bot"}}]},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": otlp_spans}],
+    }]}
+
+async def finish_run(**attrs):
+    """Closes the current run's trace and exports it. Export errors are only logged."""
+    trace = _trace.get()
+    if trace is None:
+        return
+    _trace.set(None)
+    _parent.set(None)
+    trace["end_ns"] = time.time_ns()
+    trace["attrs"] = attrs
+    spans = [_root(trace)] + trace["spans"]
+    try:
+        if config.TRACE_EXPORT == "jsonl":
+            with open(config.TRACE_FILE, "a", encoding="utf-8") as f:
+                for s in spans:
+                    f.write(json.dumps(s, ensure_ascii=False, default=str) + "\n")
+            log.info(f"Trace {trace['trace_id']}: {len(spans)} span(s) appended to {config.TRACE_FILE}.")
+        else:
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                r = await client.post(config.TRACE_OTLP_ENDPOINT, json=_otlp_payload(spans))
+                r.raise_for_status()
+            log.info(f"Trace {trace['trace_id']}: {len(spans)} span(s) sent to {config.TRACE_OTLP_ENDPOINT}.")
+    except Exception as e:
+        log.warning(f"Failed to export trace {trace['trace_id']}. Error: {e}")
+
+# ---------- WATERFALL ----------
+
+def waterfall(spans: List[Dict[str, Any]]) -> str:
+    """Text waterfall of one trace: per candidate, each stage's offset and duration from the run start."""
+    root = next(s for s in spans if s["parent_id"] is None)
+    by_key: Dict[str, List[Dict[str, Any]]] = {}
+    for s in spans:
+        if s["key"]:
+            by_key.setdefault(s["key"], []).append(s)
+    ms = lambda ns: ns / 1e6
+    lines = [f"{root['name']} {root['trace_id']}: {ms(root['end_ns'] - root['start_ns']):.0f} ms, {len(by_key)} candidate(s)"]
+    for key, candidate_spans in sorted(by_key.items(), key=lambda item: min(s["start_ns"] for s in item[1])):
+        candidate_spans.sort(key=lambda s: s["start_ns"])
+        total = max(s["end_ns"] for s in candidate_spans) - root["start_ns"]
+        lines.append(f"\n{key}  (done at {ms(total):.0f} ms)")
+        for s in candidate_spans:
+            offset = ms(s["start_ns"] - root["start_ns"])
+            lines.append(f"  {s['name']:<12} +{offset:>9.0f} ms  {ms(s['end_ns'] - s['start_ns']):>9.0f} ms")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else config.TRACE_FILE
+    if not os.path.exists(path):
+        sys.exit(f"No trace file at {path}.")
+    with open(path, "r", encoding="utf-8") as f:
+        all_spans = [json.loads(line) for line in f if line.strip()]
+    trace_id = sys.argv[2] if len(sys.argv) > 2 else all_spans[-1]["trace_id"]
+    print(waterfall([s for s in all_spans if s["trace_id"] == trace_id]))
@@ -0,0 +1,57 @@
+# url_canon.py
+import re
+from functools import lru_cache
+from urllib.parse import parse_qsl, urlencode
+
+import config
+
+# Bumped whenever canonical_key() changes, so stored keys get migrated (see gcs_state.migrate_canonical_keys).
+# Only the digest queues and a legacy {key: timestamp} sent_links can be rekeyed: the compact seen-set
+# keeps hashes of the old keys, so after a bump links sent before it are not recognised under their new
+# key and may be posted again once (until they age out of the seen-set).
+CANONICAL_KEY_VERSION = 1
+
+_DROP_PARAMS = frozenset(p.lower() for p in config.DROP_PARAMS)
+_DROP_PREFIXES = ("utm_",)
+_URL_RE = re.compile(r'^(https?)://([^/?#]+)([^?#]*)(?:\?([^#]*))?(?:#.*)?$', re.IGNORECASE)
+_DEFAULT_PORTS = (":80", ":443")
+
+def _keep_param(name: str) -> bool:
+    name = name.lower()
+    return name not in _DROP_PARAMS and not name.startswith(_DROP_PREFIXES)
+
+@lru_cache(maxsize=65536)
+def canonical_url(url: str) -> str:
+    """
+    Normalizes a URL so the same page reached via different links maps to one string:
+    https scheme, lower-case host without `www.` or default port, no trailing slash (except the root),
+    tracking parameters (DROP_PARAMS, utm_*) removed, remaining query sorted, no fragment.
+    Non-http(s) strings are returned stripped but otherwise unchanged.
+    """
+    url = url.strip()
+    match = _URL_RE.match(url)
+    if not match:
+        return url
+    _, host, path, query = match.groups()
+
+    host = host.lower()
+    if "@" in host: # credentials never identify the page
+        host = host.rsplit("@", 1)[1]
+    if host.endswith(_DEFAULT_PORTS):
+        host = host.rsplit(":", 1)[0]
+    if host.startswith("www."):
+        host = host[4:]
+
+    path = path.rstrip("/") or "/"
+
+    if query:
+        params = sorted((k, v) for k, v in parse_qsl(query, keep_blank_values=True) if _keep_param(k))
+        query = urlencode(params)
+
+    return f"https://{host}{path}" + (f"?{query}" if query else "")
+
+def canonical_key(guid_or_url: str) -> str:
+    """Dedup key for sent_links, the scrape cache and digest queues (a canonical URL, or the raw GUID)."""
+    if not isinstance(guid_or_url, str):
+        return guid_or_url
+    return canonical_url(guid_or_url)
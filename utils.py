@@ -1,12 +1,24 @@
 # utils.py
 import httpx
 import config
+import cassette
 import logging
+from typing import Dict
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+from curl_cffi.requests import AsyncSession
 from httpx_socks import AsyncProxyTransport
 
 log = logging.getLogger(__name__)
 
-def make_async_client() -> httpx.AsyncClient:
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+    )
+
+def make_async_client(timeout: float | None = None) -> httpx.AsyncClient:
     """
     Creates a pre-configured httpx.AsyncClient.
     If NORD_USER and NORD_PASS are set, it configures the client to use the
@@ -17,12 +29,117 @@ def make_async_client() -> httpx.AsyncClient:
         host = "socks-us29.nordvpn.com"
         port = 1080
         proxy_url = f"socks5://{config.NORD_USER}:{config.NORD_PASS}@{host}:{port}"
-        transport = AsyncProxyTransport.from_url(proxy_url)
+        transport = AsyncProxyTransport.from_url(proxy_url, limits=_pool_limits())
         log.info(f"HTTP client configured to use SOCKS5 proxy transport at {host}:{port}")
     
     return httpx.AsyncClient(
-        transport=transport,
-        timeout=config.HTTP_TIMEOUT, 
+        transport=cassette.wrap_transport(transport, limits=_pool_limits()),
+        timeout=timeout or config.HTTP_TIMEOUT, 
         follow_redirects=True,
+        limits=_pool_limits(),
         http2=False  # http2 must be False when using a proxy transport
     )
+
+def make_direct_client() -> httpx.AsyncClient:
+    """Creates a client that never uses the proxy (HTTP/2 enabled) for friendly feed and article hosts."""
+    return httpx.AsyncClient(
+        transport=cassette.wrap_transport(None, limits=_pool_limits(), http2=True),
+        timeout=config.HTTP_TIMEOUT,
+        follow_redirects=True,
+        limits=_pool_limits(),
+        http2=True # Can be enabled for direct connections
+    )
+
+# --- Run-scoped client registry ---
+DIRECT, PROXIED, TELEGRAM, PERPLEXITY = "direct", "proxied", "telegram", "perplexity"
+
+def make_client(purpose: str) -> httpx.AsyncClient:
+    """Creates a fresh client for a purpose; Telegram and Perplexity keep going through make_async_client."""
+    if purpose == DIRECT:
+        return make_direct_client()
+    if purpose == PERPLEXITY:
+        return make_async_client(timeout=120.0)
+    return make_async_client()
+
+class ClientRegistry:
+    """
+    Run-scoped registry of long-lived clients keyed by purpose (direct, proxied,
+    telegram, perplexity) plus the impersonated session pool. Created once per run
+    and passed through the pipeline so keep-alive connections are reused across stages.
+    Use as `async with ClientRegistry() as clients:`.
+    """
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self.impersonated = ImpersonatedSessionPool()
+
+    def get(self, purpose: str) -> httpx.AsyncClient:
+        if purpose not in self._clients:
+            self._clients[purpose] = make_client(purpose)
+        return self._clients[purpose]
+
+    async def aclose(self):
+        for purpose, client in self._clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                log.warning(f"Error closing '{purpose}' HTTP client: {e}")
+        self._clients.clear()
+        await self.impersonated.close()
+
+    async def __aenter__(self) -> "ClientRegistry":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+@asynccontextmanager
+async def client_for(clients: ClientRegistry | None, purpose: str):
+    """Yields the registry's client for purpose, or a one-off client when no registry is passed."""
+    if clients is not None:
+        yield clients.get(purpose)
+    else:
+        async with make_client(purpose) as client:
+            yield client
+
+# --- TLS impersonation (curl_cffi) ---
+IMPERSONATE_PROFILE = "chrome120"
+IMPERSONATE_HEADERS: Dict[str, str] = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'pl-PL,pl;q=0.9,en-US;q=0.8,en;q=0.7',
+}
+
+def make_impersonated_session() -> AsyncSession:
+    """Creates a curl_cffi AsyncSession that impersonates Chrome's TLS fingerprint (wrapped when a cassette is active)."""
+    if cassette.active():
+        return cassette.CassetteSession(lambda: AsyncSession(impersonate=IMPERSONATE_PROFILE, headers=IMPERSONATE_HEADERS, timeout=30))
+    return AsyncSession(impersonate=IMPERSONATE_PROFILE, headers=IMPERSONATE_HEADERS, timeout=30)
+
+class ImpersonatedSessionPool:
+    """
+    Run-scoped pool of impersonating sessions, one per host, so TLS connections
+    to hosts like news.google.com are reused instead of re-handshaked per URL.
+    Use as `async with ImpersonatedSessionPool() as pool:`.
+    """
+    def __init__(self):
+        self._sessions: Dict[str, AsyncSession] = {}
+
+    def session_for(self, url: str) -> AsyncSession:
+        host = urlparse(url).netloc.lower()
+        if host not in self._sessions:
+            self._sessions[host] = make_impersonated_session()
+        return self._sessions[host]
+
+    async def close(self):
+        for session in self._sessions.values():
+            try:
+                await session.close()
+            except Exception as e:
+                log.warning(f"Error closing impersonated session: {e}")
+        self._sessions.clear()
+
+    async def __aenter__(self) -> "ImpersonatedSessionPool":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()